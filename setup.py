@@ -59,7 +59,6 @@ install_requires = [
     "authlib>=0.11.0",
     # "python-pushover==0.4",
     "twilio>=6.29",
-    "flask-restplus>=0.12.1",
     "pendulum>=2.0",
     "click>=7.0",
     "coloredlogs>=10.0",
@@ -69,6 +68,14 @@ install_requires = [
 tests_require = [
 ]
 
+extras_require = {
+    "tests": tests_require,
+    # SMS_STORAGE_BACKEND=s3
+    "s3": ["boto3>=1.9"],
+    # shortage web --async
+    "async": ["aiohttp>=3.8"],
+}
+
 
 setup(
     name="shortage-app",
@@ -88,7 +95,7 @@ setup(
     author="Shortage Inc.",
     author_email="dev@shortage.com",
     install_requires=install_requires,
-    extras_require={"tests": tests_require},
+    extras_require=extras_require,
     tests_require=tests_require,
     dependency_links=[],
 )
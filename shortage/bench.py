@@ -0,0 +1,221 @@
+import json
+import time
+import random
+import string
+import logging
+import threading
+from pathlib import Path
+from collections import Counter
+from urllib.parse import urlencode, urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from shortage.web.signature import TwilioSignature
+
+logger = logging.getLogger(__name__)
+
+
+WORDS = (
+    "ahoy shortage inbox message reply later call code verify your "
+    "account please thanks ok yes no tomorrow meeting late running"
+).split()
+
+
+def load_template(path: [Path, str]) -> dict:
+    """reads a ``.request.json``-style file of twilio webhook fields"""
+    return json.loads(Path(path).read_text())
+
+
+def payloads(template: dict, seed: int = None):
+    """yields copies of ``template`` with a new sid, a random sender
+    and a random body, forever"""
+    rng = random.Random(seed)
+    while True:
+        sid = "SM" + "".join(rng.choices("0123456789abcdef", k=32))
+        fields = dict(template)
+        fields["From"] = "+1555" + "".join(rng.choices(string.digits, k=7))
+        fields["Body"] = " ".join(rng.choices(WORDS, k=rng.randint(1, 24)))
+        fields["MessageSid"] = sid
+        for name in ("SmsSid", "SmsMessageSid"):
+            if name in fields:
+                fields[name] = sid
+        yield fields
+
+
+class HTTPTarget(object):
+    """posts webhooks to a running instance"""
+
+    def __init__(self, base_url: str, pool_size: int = 16):
+        self.base_url = base_url
+        self.http = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0
+        )
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+
+    def url(self, path: str) -> str:
+        return urljoin(self.base_url, path)
+
+    def post(self, path: str, body: bytes, headers: dict) -> int:
+        response = self.http.post(self.url(path), data=body, headers=headers)
+        return response.status_code
+
+
+class WSGITarget(object):
+    """posts webhooks to a WSGI app of this process, without a
+    server in between"""
+
+    def __init__(self, app, base_url: str = "http://localhost/"):
+        self.app = app
+        self.base_url = base_url
+        self.local = threading.local()
+
+    def url(self, path: str) -> str:
+        return urljoin(self.base_url, path)
+
+    @property
+    def client(self):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            from werkzeug.test import Client
+
+            client = self.local.client = Client(self.app)
+        return client
+
+    def post(self, path: str, body: bytes, headers: dict) -> int:
+        response = self.client.post(
+            self.url(path), data=body, headers=headers
+        )
+        response.close()
+        return response.status_code
+
+
+class Benchmark(object):
+    """sends signed webhooks to a target and measures how long each one
+    takes to be answered.
+
+    In the fixed-concurrency mode every worker sends its next request
+    as soon as the previous one was answered. In the open-loop mode
+    requests are started at a fixed rate whether or not the previous
+    ones were answered, and latencies are measured from the time each
+    request was due, so a server that falls behind is not hidden by a
+    client that slows down with it.
+    """
+
+    def __init__(
+        self,
+        target,
+        payloads,
+        path: str = "/sms/in",
+        signature: TwilioSignature = None,
+    ):
+        self.target = target
+        self.payloads = payloads
+        self.path = path
+        self.signature = signature
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = Counter()
+        self.failures = 0
+
+    def prepare(self, fields: dict):
+        body = urlencode(fields).encode("utf-8")
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if self.signature is not None:
+            params = {name: [value] for name, value in fields.items()}
+            url = self.target.url(self.path)
+            headers["X-Twilio-Signature"] = self.signature.compute(
+                url, params
+            )
+        return body, headers
+
+    def send(self, body: bytes, headers: dict, due: float):
+        try:
+            status = self.target.post(self.path, body, headers)
+        except Exception as e:
+            logger.debug(f"request failed: {e}")
+            status = None
+
+        latency = time.perf_counter() - due
+        with self.lock:
+            self.latencies.append(latency)
+            if status is None:
+                self.failures += 1
+            else:
+                self.statuses[status] += 1
+
+    def requests(self, total: int):
+        """the prepared requests, signed ahead of time so that signing
+        is not measured"""
+        return [self.prepare(next(self.payloads)) for _ in range(total)]
+
+    def run_concurrent(self, total: int, concurrency: int) -> dict:
+        pending = iter(self.requests(total))
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    prepared = next(pending, None)
+                if prepared is None:
+                    return
+                self.send(*prepared, time.perf_counter())
+
+        started = time.perf_counter()
+        workers = [
+            threading.Thread(target=work, daemon=True)
+            for _ in range(concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.report(time.perf_counter() - started, concurrency)
+
+    def run_rate(self, total: int, rate: float, concurrency: int) -> dict:
+        prepared = self.requests(total)
+        interval = 1.0 / rate
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for number, (body, headers) in enumerate(prepared):
+                due = started + number * interval
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, body, headers, due)
+
+        report = self.report(time.perf_counter() - started, concurrency)
+        report["rate"] = rate
+        return report
+
+    def report(self, elapsed: float, concurrency: int) -> dict:
+        latencies = sorted(self.latencies)
+        errors = self.failures + sum(
+            count for status, count in self.statuses.items() if status >= 400
+        )
+
+        def percentile(fraction):
+            if not latencies:
+                return 0.0
+            position = min(len(latencies) - 1, int(len(latencies) * fraction))
+            return round(latencies[position] * 1000, 3)
+
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "statuses": {str(s): c for s, c in sorted(self.statuses.items())},
+            "concurrency": concurrency,
+            "elapsed": round(elapsed, 3),
+            "per_second": round(len(latencies) / elapsed, 3)
+            if elapsed
+            else 0.0,
+            "latency_ms": {
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            },
+        }
@@ -0,0 +1,216 @@
+import os
+import csv
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from shortage.networking.messaging import TwilioUnknownOutcome
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """allows ``rate`` acquisitions per second on average and bursts
+    of up to ``capacity``"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError(f"rate must be greater than 0, not {rate}")
+        if capacity is not None and capacity < 1:
+            raise ValueError(f"capacity must be at least 1, not {capacity}")
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.sleep = time.sleep
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate,
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            self.sleep(wait)
+
+
+def read_recipients(path: [Path, str]):
+    """yields ``(line number, row)`` from a csv file with a header or
+    from a newline-delimited json file, one row at a time"""
+    path = Path(path)
+    with path.open(newline="", encoding="utf-8") as fd:
+        if path.suffix.lower() == ".csv":
+            for number, row in enumerate(csv.DictReader(fd), start=1):
+                yield number, row
+            return
+
+        for number, line in enumerate(fd, start=1):
+            if line.strip():
+                yield number, json.loads(line)
+
+
+class Checkpoint(object):
+    """remembers which rows were sent, in an append-only file.
+
+    Each sent row costs one small ``O_APPEND`` write, done right after
+    twilio accepted the message or may have, so an interrupted run
+    resumes without sending a row twice. Sent rows are kept in memory
+    as a bitmap, one bit per row.
+    """
+
+    def __init__(self, path: [Path, str]):
+        self.path = Path(path)
+        self.bitmap = bytearray()
+        self.done = 0
+        self.fd = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.path.exists():
+            with self.path.open() as fd:
+                for line in fd:
+                    number, _, _ = line.partition("\t")
+                    if number.strip().isdigit():
+                        self.set(int(number))
+        return self
+
+    def set(self, number: int):
+        byte, bit = divmod(number, 8)
+        if byte >= len(self.bitmap):
+            self.bitmap.extend(bytes(byte + 1 - len(self.bitmap)))
+        if not self.bitmap[byte] & (1 << bit):
+            self.bitmap[byte] |= 1 << bit
+            self.done += 1
+
+    def __contains__(self, number: int):
+        byte, bit = divmod(number, 8)
+        return byte < len(self.bitmap) and bool(self.bitmap[byte] & (1 << bit))
+
+    def mark(self, number: int, sid: str):
+        with self.lock:
+            if self.fd is None:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+                self.fd = os.open(self.path, flags, 0o644)
+            os.write(self.fd, f"{number}\t{sid}\n".encode("utf-8"))
+            self.set(number)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Broadcast(object):
+    """sends every row of a recipients file through a pool of threads
+    sharing one client, no faster than the token bucket allows"""
+
+    # failures reported in the summary, the log has all of them
+    max_failures = 100
+
+    def __init__(
+        self,
+        client,
+        bucket: TokenBucket,
+        checkpoint: Checkpoint,
+        workers: int = 8,
+        from_: str = None,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.checkpoint = checkpoint
+        self.workers = int(workers)
+        self.from_ = from_
+        self.lock = threading.Lock()
+        self.counters = {"sent": 0, "failed": 0, "unknown": 0, "skipped": 0}
+        self.failures = []
+        self.unknown = []
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def report(self, failures: list, number: int, to: str, error):
+        with self.lock:
+            if len(failures) < self.max_failures:
+                failures.append({"row": number, "to": to, "error": str(error)})
+
+    def send(self, number: int, row: dict):
+        to = row.get("to") or row.get("To")
+        body = row.get("body") or row.get("Body")
+        from_ = row.get("from") or row.get("From") or self.from_
+        try:
+            if not (to and body and from_):
+                raise ValueError("rows need a to, a body and a from number")
+
+            sid = self.client.send(
+                to=to, body=body, from_=from_, bucket=self.bucket
+            )
+        except TwilioUnknownOutcome as e:
+            # twilio may have queued it: checkpointed so that a resumed
+            # run doesn't send it again, to be checked by hand
+            logger.error(f"row {number} to {to} may have been sent: {e}")
+            self.checkpoint.mark(number, "unknown")
+            self.count("unknown")
+            self.report(self.unknown, number, to, e)
+            return
+        except Exception as e:
+            logger.error(f"failed to send row {number} to {to}: {e}")
+            self.count("failed")
+            self.report(self.failures, number, to, e)
+            return
+
+        self.checkpoint.mark(number, sid)
+        self.count("sent")
+
+    def run(self, rows) -> dict:
+        started = time.perf_counter()
+        # bounds the rows read ahead of the workers, so that files of
+        # any size are sent in constant memory
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def send(number, row):
+            try:
+                self.send(number, row)
+            finally:
+                slots.release()
+
+        with self.checkpoint, ThreadPoolExecutor(self.workers) as executor:
+            for number, row in rows:
+                if number in self.checkpoint:
+                    self.count("skipped")
+                    continue
+
+                slots.acquire()
+                executor.submit(send, number, row)
+
+        return self.summary(time.perf_counter() - started)
+
+    def summary(self, elapsed: float) -> dict:
+        summary = dict(self.counters)
+        summary["elapsed"] = round(elapsed, 3)
+        summary["per_second"] = round(
+            summary["sent"] / elapsed if elapsed else 0.0, 3
+        )
+        summary["latency"] = self.client.stats.to_dict()
+        summary["failures"] = self.failures
+        # rows twilio may or may not have accepted, check them by hand
+        summary["check_manually"] = self.unknown
+        return summary
@@ -1,14 +1,28 @@
+import json
 import click
-import coloredlogs
+import itertools
 import logging
-from twilio.rest import Client
-from shortage.web.backend.api import app
+
+# only what the command line itself needs is imported here, every
+# command imports its own dependencies, see tests/unit/test_imports.py
+from shortage.config import (
+    SMS_SQLITE_PATH,
+    SMS_STORAGE_BACKEND,
+    SMS_STORAGE_CODEC,
+    SMS_RETENTION_DAYS,
+    TWILIO_ACCOUNT_SID,
+    TWILIO_API_URL,
+    TWILIO_AUTH_TOKEN,
+    TWILIO_RATE_LIMIT,
+)
 
 logger = logging.getLogger(__name__)
 
 
 @click.group()
 def shortage():
+    import coloredlogs
+
     coloredlogs.install(level="DEBUG", logger=logging.getLogger())
 
 
@@ -16,8 +30,24 @@ def shortage():
 @click.option("--host", type=str, default="127.0.0.1")
 @click.option("--port", type=int, default=3000)
 @click.option("--debug", is_flag=True, default=False)
-def run(debug=False, port=3000, host="0.0.0.0"):
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    default=False,
+    help="serve the twilio webhooks from an asyncio event loop",
+)
+def run(debug=False, port=3000, host="0.0.0.0", use_async=False):
     """runs the web app"""
+    if use_async:
+        from shortage.web import aio
+
+        aio.run(host=host, port=port)
+        return
+
+    from shortage.web.backend.api import app, notifications
+
+    notifications.start()
     app.run(debug=debug, port=port, host=host)
 
 
@@ -26,19 +56,412 @@ def run(debug=False, port=3000, host="0.0.0.0"):
 @click.option("--to", type=str, default="+18482259319")
 @click.argument("body")
 def sms(receiver, to, body):
-    """runs the web app"""
-    coloredlogs.install(level="DEBUG", logger=logging.getLogger())
+    """sends an SMS"""
+    from shortage.networking.messaging import TwilioMessagesClient
 
-    account_sid = app.config.get("TWILIO_ACCOUNT_SID")
-    auth_token = app.config.get("TWILIO_AUTH_TOKEN")
-
-    if not account_sid:
+    if not TWILIO_ACCOUNT_SID:
         logger.error("TWILIO_ACCOUNT_SID is not configured")
         raise SystemExit(1)
 
-    if not auth_token:
+    if not TWILIO_AUTH_TOKEN:
         logger.error("TWILIO_AUTH_TOKEN is not configured")
         raise SystemExit(1)
 
-    client = Client(account_sid, auth_token)
-    print(client.messages.create(body=body, from_=receiver, to=to))
+    client = TwilioMessagesClient(
+        TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, base_url=TWILIO_API_URL
+    )
+    print(client.send(to=to, body=body, from_=receiver))
+
+
+def sample_messages(limit):
+    from shortage.filesystem import default_storage
+
+    storage = default_storage()
+    blobs = (
+        data
+        for key_name in storage.keys()
+        for _, data in storage.scan(key_name)
+    )
+    return list(itertools.islice(blobs, limit))
+
+
+@shortage.command(name="train-zdict")
+@click.option("--samples", type=int, default=10000)
+@click.option("--size", type=int, default=32 * 1024)
+def train_zdict(samples, size):
+    """trains a zlib dictionary from stored messages"""
+    from shortage import serialization
+    from shortage.filesystem import get_dictionaries_path
+
+    messages = sample_messages(samples)
+    if not messages:
+        logger.error("there are no stored messages to train from")
+        raise SystemExit(1)
+
+    zdict = serialization.train_zdict(messages, size=size)
+    path = get_dictionaries_path()
+    path.mkdir(parents=True, exist_ok=True)
+    target = path.joinpath(f"{serialization.dictionary_id(zdict):08x}.zdict")
+    target.write_bytes(zdict)
+    print(f"wrote {len(zdict)} bytes from {len(messages)} messages to {target}")
+
+
+@shortage.command(name="codec-benchmark")
+@click.option("--samples", type=int, default=1000)
+@click.option("--rounds", type=int, default=3)
+def codec_benchmark(samples, rounds):
+    """compares the size and speed of the storage codecs"""
+    from shortage import serialization
+
+    messages = sample_messages(samples)
+    if not messages:
+        logger.error("there are no stored messages to benchmark with")
+        raise SystemExit(1)
+
+    zdict = serialization.train_zdict(messages[: len(messages) // 2 or 1])
+    codecs = [
+        serialization.JSONCodec(indent=2),
+        serialization.JSONCodec(),
+        serialization.BinaryCodec(),
+        serialization.ZlibJSONCodec(),
+        serialization.ZlibJSONCodec(zdict),
+    ]
+    for codec in codecs:
+        result = serialization.benchmark(codec, messages, rounds=rounds)
+        if isinstance(codec, serialization.ZlibJSONCodec) and codec.zdict:
+            result["codec"] = "zlib+zdict"
+        print(json.dumps(result))
+
+
+@shortage.command(name="migrate-sqlite")
+@click.option("--source", type=click.Path(file_okay=False), default=None)
+@click.option("--target", type=click.Path(dir_okay=False), default=None)
+@click.option("--batch-size", type=int, default=1000)
+def migrate_sqlite(source, target, batch_size):
+    """bulk-loads a FileStorage tree into a SQLiteStorage database"""
+    from shortage.filesystem import FileStorage, get_storage_path
+    from shortage.sqlstorage import SQLiteStorage
+
+    source = FileStorage(source or get_storage_path())
+    if not source.base_path.is_dir():
+        logger.error(f"{source.base_path} is not a directory")
+        raise SystemExit(1)
+
+    target = SQLiteStorage(target or SMS_SQLITE_PATH)
+    total = target.migrate(source, batch_size=batch_size)
+    print(f"migrated {total} messages from {source.base_path}")
+    print(f"to {target.path}")
+
+
+@shortage.command(name="migrate-records")
+@click.option("--source", type=click.Path(file_okay=False), default=None)
+@click.option("--workers", type=int, default=None)
+@click.option("--chunk-size", type=int, default=500)
+def migrate_records(source, workers, chunk_size):
+    """rewrites the blobs of a FileStorage tree with the compact
+    message schema"""
+    from shortage.filesystem import (
+        FileStorage,
+        get_storage_path,
+        get_dictionaries_path,
+    )
+    from shortage.records import migrate_storage
+
+    source = FileStorage(source or get_storage_path())
+    if not source.base_path.is_dir():
+        logger.error(f"{source.base_path} is not a directory")
+        raise SystemExit(1)
+
+    totals = migrate_storage(
+        source,
+        codec_name=SMS_STORAGE_CODEC,
+        dictionaries_path=get_dictionaries_path(),
+        workers=workers,
+        chunk_size=chunk_size,
+    )
+    print(json.dumps(totals))
+
+
+@shortage.command(name="export")
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(["ndjson", "csv"]),
+    default="ndjson",
+)
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(dir_okay=False, allow_dash=True),
+    default="-",
+)
+@click.option(
+    "--gzip",
+    "compress",
+    is_flag=True,
+    default=False,
+    help="gzip the output, implied by an --output ending with .gz",
+)
+@click.option(
+    "--since", type=str, default=None, help="timestamp or ISO 8601 date"
+)
+@click.option(
+    "--until", type=str, default=None, help="timestamp or ISO 8601 date"
+)
+@click.option("--to", "recipients", type=str, multiple=True)
+@click.option("--from", "senders", type=str, multiple=True)
+@click.option("--limit", type=int, default=None)
+@click.option("--workers", type=int, default=8)
+def export(
+    format_,
+    output,
+    compress,
+    since,
+    until,
+    recipients,
+    senders,
+    limit,
+    workers,
+):
+    """streams the stored messages out as ndjson or csv, in constant
+    memory, key by key in the order of the storage"""
+    import time
+    from shortage.filesystem import default_storage
+    from shortage.export import WRITERS, Export, parse_time
+    from shortage.export import output as open_output
+
+    exporter = Export(
+        default_storage(),
+        since=parse_time(since),
+        until=parse_time(until),
+        recipients=recipients,
+        senders=senders,
+        limit=limit,
+        workers=workers,
+    )
+    compress = compress or str(output).endswith(".gz")
+    started = time.perf_counter()
+    with open_output(output, compress) as fd:
+        WRITERS[format_](exporter.rows(), fd)
+
+    summary = dict(
+        exporter.counts, elapsed=round(time.perf_counter() - started, 3)
+    )
+    logger.info(f"export: {json.dumps(summary)}")
+
+
+@shortage.command(name="reindex")
+@click.option("--source", type=click.Path(file_okay=False), default=None)
+@click.option("--workers", type=int, default=None)
+@click.option("--chunk-size", type=int, default=500)
+@click.option(
+    "--restart",
+    is_flag=True,
+    default=False,
+    help="start over instead of resuming an interrupted run",
+)
+@click.option(
+    "--report",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="ndjson file listing the corrupt and partial blob files",
+)
+def reindex(source, workers, chunk_size, restart, report):
+    """rebuilds the message index and the dedup filter from every blob
+    of a FileStorage tree, in a pool of processes"""
+    from shortage.dedup import default_deduplicator
+    from shortage.filesystem import (
+        FileStorage,
+        get_storage_path,
+        get_dictionaries_path,
+    )
+    from shortage.indexes import default_index
+    from shortage.reindex import Reindex, ReindexState
+
+    if source is None and SMS_STORAGE_BACKEND != "file":
+        # the index would be cleared before finding no blob files
+        logger.error(
+            f"reindex only reads file storage, not {SMS_STORAGE_BACKEND}: "
+            "use `shortage search --rebuild` instead"
+        )
+        raise SystemExit(1)
+
+    source = FileStorage(source or get_storage_path())
+    if not source.base_path.is_dir():
+        logger.error(f"{source.base_path} is not a directory")
+        raise SystemExit(1)
+
+    index = default_index()
+    state = ReindexState(index.path.with_name("reindex.json"))
+    if restart:
+        state.remove()
+
+    summary = Reindex(
+        source,
+        index,
+        state,
+        report=report or index.path.with_name("reindex-problems.ndjson"),
+        bloom=default_deduplicator().bloom,
+        codec_name=SMS_STORAGE_CODEC,
+        dictionaries_path=get_dictionaries_path(),
+        workers=workers,
+        chunk_size=chunk_size,
+    ).run()
+    print(json.dumps(summary, indent=2))
+
+
+@shortage.command(name="search")
+@click.option("--limit", type=int, default=20)
+@click.option("--page", type=int, default=1)
+@click.option("--rebuild", is_flag=True, default=False)
+@click.argument("query", nargs=-1)
+def search(query, limit, page, rebuild):
+    """finds stored messages whose body contains every word of QUERY"""
+    from shortage.filesystem import default_storage
+    from shortage.indexes import default_index
+
+    index = default_index()
+    if rebuild:
+        index.rebuild(default_storage())
+
+    text = " ".join(query)
+    if not text:
+        return
+
+    offset = (max(page, 1) - 1) * limit
+    for entry, snippet in index.search(text, limit=limit, offset=offset):
+        print(
+            json.dumps(
+                {
+                    "sid": entry.sid,
+                    "from": entry.sender,
+                    "to": entry.recipient,
+                    "received_at": entry.received_at,
+                    "snippet": snippet,
+                }
+            )
+        )
+
+
+@shortage.command(name="compact")
+@click.option("--retention-days", type=int, default=SMS_RETENTION_DAYS)
+def compact(retention_days):
+    """rolls closed partitions into archives and drops expired ones"""
+    from shortage.filesystem import default_storage
+    from shortage.indexes import default_index
+    from shortage.partitions import PartitionedStorage
+
+    storage = default_storage()
+    if not isinstance(storage, PartitionedStorage):
+        logger.error("SMS_STORAGE_BACKEND is not set to partitioned")
+        raise SystemExit(1)
+
+    if retention_days > 0:
+        expired = storage.expire(retention_days, index=default_index())
+        print(f"expired {expired} partitions")
+    print(f"compacted {storage.compact()} partitions")
+
+
+@shortage.command(name="broadcast")
+@click.option("--from", "from_", type=str, default="+18482259204")
+@click.option("--rate", type=float, default=TWILIO_RATE_LIMIT)
+@click.option("--burst", type=float, default=None)
+@click.option("--workers", type=int, default=8)
+@click.option("--api-url", type=str, default=TWILIO_API_URL)
+@click.option("--checkpoint", type=click.Path(dir_okay=False), default=None)
+@click.argument("recipients", type=click.Path(exists=True, dir_okay=False))
+def broadcast(recipients, from_, rate, burst, workers, api_url, checkpoint):
+    """sends the messages of a csv or ndjson file of to,body rows"""
+    from shortage.broadcast import (
+        Broadcast,
+        Checkpoint,
+        TokenBucket,
+        read_recipients,
+    )
+    from shortage.networking.messaging import TwilioMessagesClient
+
+    if rate <= 0:
+        raise click.BadParameter("must be greater than 0", param_hint="--rate")
+    if burst is not None and burst < 1:
+        raise click.BadParameter("must be at least 1", param_hint="--burst")
+    if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
+        logger.error("TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN are required")
+        raise SystemExit(1)
+
+    client = TwilioMessagesClient(
+        TWILIO_ACCOUNT_SID,
+        TWILIO_AUTH_TOKEN,
+        base_url=api_url,
+        pool_size=workers,
+    )
+    checkpoint = Checkpoint(checkpoint or f"{recipients}.checkpoint").load()
+    if checkpoint.done:
+        logger.info(f"resuming, {checkpoint.done} rows were sent")
+
+    summary = Broadcast(
+        client,
+        TokenBucket(rate, burst),
+        checkpoint,
+        workers=workers,
+        from_=from_,
+    ).run(read_recipients(recipients))
+    print(json.dumps(summary, indent=2))
+    if summary["failed"] or summary["unknown"]:
+        raise SystemExit(1)
+
+
+@shortage.command(name="bench")
+@click.option(
+    "--url",
+    type=str,
+    default=None,
+    help="base url of a running instance, the in-process app otherwise",
+)
+@click.option("--path", type=str, default="/sms/in")
+@click.option("--requests", "total", type=int, default=1000)
+@click.option("--concurrency", type=int, default=8)
+@click.option(
+    "--rate",
+    type=float,
+    default=None,
+    help="requests per second, starts requests at a fixed rate",
+)
+@click.option(
+    "--template",
+    type=click.Path(exists=True, dir_okay=False),
+    default=".request.json",
+)
+@click.option("--auth-token", type=str, default=None)
+@click.option("--seed", type=int, default=None)
+def bench(url, path, total, concurrency, rate, template, auth_token, seed):
+    """replays twilio webhooks and reports throughput and latency"""
+    from shortage.bench import (
+        Benchmark,
+        HTTPTarget,
+        WSGITarget,
+        load_template,
+        payloads,
+    )
+    from shortage.web.signature import TwilioSignature
+
+    if url:
+        target = HTTPTarget(url, pool_size=concurrency)
+    else:
+        from shortage.web.backend.api import app
+
+        target = WSGITarget(app)
+
+    auth_token = auth_token or TWILIO_AUTH_TOKEN
+    benchmark = Benchmark(
+        target,
+        payloads(load_template(template), seed),
+        path=path,
+        signature=TwilioSignature(auth_token) if auth_token else None,
+    )
+    if rate:
+        report = benchmark.run_rate(total, rate, concurrency)
+    else:
+        report = benchmark.run_concurrent(total, concurrency)
+
+    report["target"] = url or "in-process"
+    print(json.dumps(report, indent=2))
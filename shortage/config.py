@@ -1,7 +1,129 @@
 import os
+from pathlib import Path
+
+
+def env_flag(name: str) -> bool:
+    return os.getenv(name, "").lower() in ("1", "true", "yes", "on")
+
 
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+# webhooks answered with 403 unless signed with TWILIO_AUTH_TOKEN
+TWILIO_SIGNED_PATHS = (
+    os.getenv("TWILIO_SIGNED_PATHS") or "/sms/in,/sms/status,/sms/fallback"
+).split(",")
+TWILIO_API_URL = os.getenv("TWILIO_API_URL") or "https://api.twilio.com/"
+# messages per second allowed by the twilio account, used by
+# `shortage broadcast`
+TWILIO_RATE_LIMIT = float(os.getenv("TWILIO_RATE_LIMIT") or 1)
 SMS_STORAGE_PATH = os.getenv("SMS_STORAGE_PATH")
 PUSHOVER_API_TOKEN = os.getenv("PUSHOVER_API_TOKEN")
 PUSHOVER_API_USER_KEY = os.getenv("PUSHOVER_API_USER_KEY")
+
+# "file" writes one json file per message, "log" appends them to
+# rotating segment files, "partitioned" writes them into one directory
+# per day that `shortage compact` rolls into archives, "sqlite" inserts
+# them into SMS_SQLITE_PATH and "s3" uploads them to SMS_S3_BUCKET in
+# batches
+SMS_STORAGE_BACKEND = os.getenv("SMS_STORAGE_BACKEND") or "file"
+# "json", "binary" or "zlib" (primed with the newest trained dictionary)
+SMS_STORAGE_CODEC = os.getenv("SMS_STORAGE_CODEC") or "json"
+# coalesce concurrent FileStorage writes into batches made durable
+# with a single sync, see shortage.groupcommit. SQLiteStorage always
+# batches its transactions with the same settings
+SMS_GROUP_COMMIT = env_flag("SMS_GROUP_COMMIT")
+SMS_GROUP_COMMIT_BATCH_SIZE = int(
+    os.getenv("SMS_GROUP_COMMIT_BATCH_SIZE") or 64
+)
+SMS_GROUP_COMMIT_MAX_WAIT = float(
+    os.getenv("SMS_GROUP_COMMIT_MAX_WAIT") or 0.002
+)
+# how many key directories FileStorage keeps open per process
+SMS_DIRECTORY_CACHE_SIZE = int(os.getenv("SMS_DIRECTORY_CACHE_SIZE") or 1024)
+SMS_LOG_SEGMENT_SIZE = int(os.getenv("SMS_LOG_SEGMENT_SIZE") or 64 * 1024 ** 2)
+SMS_LOG_INDEX_INTERVAL = int(os.getenv("SMS_LOG_INDEX_INTERVAL") or 4096)
+# days of messages kept by `shortage compact`, 0 keeps them forever
+SMS_RETENTION_DAYS = int(os.getenv("SMS_RETENTION_DAYS") or 0)
+SMS_S3_BUCKET = os.getenv("SMS_S3_BUCKET")
+SMS_S3_PREFIX = os.getenv("SMS_S3_PREFIX") or "shortage"
+SMS_S3_ENDPOINT_URL = os.getenv("SMS_S3_ENDPOINT_URL")
+SMS_S3_POOL_SIZE = int(os.getenv("SMS_S3_POOL_SIZE") or 16)
+SMS_S3_BATCH_SIZE = int(os.getenv("SMS_S3_BATCH_SIZE") or 100)
+# seconds an upload waits for more messages, with 0 a batch only holds
+# the messages that arrived while the previous one was uploading
+SMS_S3_MAX_WAIT = float(os.getenv("SMS_S3_MAX_WAIT") or 0)
+
+
+def next_to_storage_path(name: str) -> str:
+    storage_path = Path(SMS_STORAGE_PATH or "~/.shortage/data")
+    return str(storage_path.expanduser().absolute().with_name(name))
+
+
+SMS_INDEX_PATH = os.getenv("SMS_INDEX_PATH") or next_to_storage_path("index")
+# drop twilio retries of messages that were already stored, by sid
+SMS_DEDUP = not env_flag("SMS_DEDUP_DISABLED")
+SMS_DEDUP_CAPACITY = int(os.getenv("SMS_DEDUP_CAPACITY") or 10 ** 7)
+SMS_DEDUP_ERROR_RATE = float(os.getenv("SMS_DEDUP_ERROR_RATE") or 0.001)
+SMS_DEDUP_LRU_SIZE = int(os.getenv("SMS_DEDUP_LRU_SIZE") or 10000)
+SMS_SQLITE_PATH = os.getenv("SMS_SQLITE_PATH") or next_to_storage_path(
+    "messages.db"
+)
+# per-process files of metric values summed by GET /metrics
+SMS_METRICS = not env_flag("SMS_METRICS_DISABLED")
+SMS_METRICS_PATH = os.getenv("SMS_METRICS_PATH") or next_to_storage_path(
+    "metrics"
+)
+# where `POST /admin/profile` and PROFILE_SIGNAL write profiles
+SMS_PROFILES_PATH = os.getenv("SMS_PROFILES_PATH") or next_to_storage_path(
+    "profiles"
+)
+# bearer token of the /admin routes, they answer 404 without one
+ADMIN_TOKEN = os.getenv("SHORTAGE_ADMIN_TOKEN")
+# bearer token of the routes serving messages, which also accept
+# ADMIN_TOKEN and answer 404 without either
+API_TOKEN = os.getenv("SHORTAGE_API_TOKEN")
+# name of the signal that starts a profile of the receiving process,
+# empty to not install a handler
+PROFILE_SIGNAL = os.getenv("PROFILE_SIGNAL", "SIGUSR2")
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS") or 10)
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS") or 300)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL") or 0.005)
+
+# events kept for the GET /sms/stream subscribers of each process, a
+# subscriber that falls further behind is disconnected and resumes
+# from the index with Last-Event-ID
+SMS_STREAM_BUFFER = int(os.getenv("SMS_STREAM_BUFFER") or 1024)
+# most messages replayed to a resuming subscriber
+SMS_STREAM_REPLAY = int(os.getenv("SMS_STREAM_REPLAY") or 1000)
+# seconds between the comments keeping idle streams open
+SMS_STREAM_KEEPALIVE = float(os.getenv("SMS_STREAM_KEEPALIVE") or 15)
+# open GET /sms/stream connections per process of the flask app, each
+# holds a worker thread: keep it below the threads of uwsgi.conf so that
+# webhooks always find one. `shortage web --async` has no limit.
+SMS_STREAM_LIMIT = int(os.getenv("SMS_STREAM_LIMIT") or 4)
+
+# threads doing the blocking storage writes of `shortage web --async`
+WEB_ASYNC_STORAGE_WORKERS = int(os.getenv("WEB_ASYNC_STORAGE_WORKERS") or 32)
+
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS") or 2)
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE") or 1000)
+NOTIFICATION_DRAIN_TIMEOUT = float(
+    os.getenv("NOTIFICATION_DRAIN_TIMEOUT") or 5
+)
+# failed notifications are retried 30s, 60s, 120s... later, capped at
+# an hour, then moved to the "dead" directory of the spool
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv("NOTIFICATION_MAX_ATTEMPTS") or 10)
+NOTIFICATION_RETRY_BACKOFF = float(
+    os.getenv("NOTIFICATION_RETRY_BACKOFF") or 30
+)
+NOTIFICATION_SPOOL_PATH = os.getenv(
+    "NOTIFICATION_SPOOL_PATH"
+) or next_to_storage_path("spool")
+
+PUSHOVER_API_URL = os.getenv("PUSHOVER_API_URL") or "https://api.pushover.net/"
+PUSHOVER_POOL_SIZE = int(
+    os.getenv("PUSHOVER_POOL_SIZE") or NOTIFICATION_WORKERS
+)
+PUSHOVER_MAX_RETRIES = int(os.getenv("PUSHOVER_MAX_RETRIES") or 3)
+PUSHOVER_BACKOFF_FACTOR = float(os.getenv("PUSHOVER_BACKOFF_FACTOR") or 0.5)
+PUSHOVER_TIMEOUT = float(os.getenv("PUSHOVER_TIMEOUT") or 10)
@@ -0,0 +1,229 @@
+import os
+import math
+import mmap
+import fcntl
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from shortage.config import (
+    SMS_INDEX_PATH,
+    SMS_DEDUP_CAPACITY,
+    SMS_DEDUP_ERROR_RATE,
+    SMS_DEDUP_LRU_SIZE,
+)
+from shortage.indexes import default_index
+
+logger = logging.getLogger(__name__)
+
+
+class LRUSet(object):
+    """a set that forgets its least recently used members beyond
+    ``capacity``"""
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = int(capacity)
+        self.members = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, member):
+        with self.lock:
+            if member not in self.members:
+                return False
+            self.members.move_to_end(member)
+            return True
+
+    def add(self, member):
+        with self.lock:
+            self.members[member] = None
+            self.members.move_to_end(member)
+            while len(self.members) > self.capacity:
+                self.members.popitem(last=False)
+
+    def discard(self, member):
+        with self.lock:
+            self.members.pop(member, None)
+
+    def __len__(self):
+        return len(self.members)
+
+
+class BloomFilter(object):
+    """a bloom filter kept in a memory-mapped file, so that it
+    survives restarts and is shared by every worker process.
+
+    Its size is fixed by ``capacity`` and ``error_rate``, about 1.8
+    MiB per million members at the default 0.1%.
+    """
+
+    def __init__(
+        self,
+        path: [Path, str],
+        capacity: int = 10 ** 7,
+        error_rate: float = 0.001,
+    ):
+        self.path = Path(path)
+        self.bits = max(
+            8, int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.size = (self.bits + 7) // 8
+        self.pid = None
+        self.fd = None
+        self.map = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(fd).st_size != self.size:
+                if os.fstat(fd).st_size:
+                    logger.warning(
+                        f"resizing {self.path}, it was created with "
+                        "different settings"
+                    )
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            self.map = mmap.mmap(fd, self.size)
+            self.fd = fd
+            self.pid = os.getpid()
+
+    def positions(self, member: str):
+        digest = hashlib.blake2b(
+            member.encode("utf-8"), digest_size=16
+        ).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, member: str) -> bool:
+        self.open()
+        bits = self.map
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(member)
+        )
+
+    def add(self, member: str):
+        self.add_many((member,))
+
+    def add_many(self, members):
+        self.open()
+        positions = [
+            position
+            for member in members
+            for position in self.positions(member)
+        ]
+        # setting a bit is a read-modify-write of its byte, the lock
+        # keeps other threads and processes from losing each other's
+        # bits
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                for position in positions:
+                    self.map[position >> 3] |= 1 << (position & 7)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+
+class Deduplicator(object):
+    """answers "was this message stored before?" by MessageSid.
+
+    Recent sids are answered from an LRU, unknown ones from a bloom
+    filter, and only the rare "maybe" of the bloom filter is confirmed
+    against the exact :py:class:`~shortage.indexes.MessageIndex`.
+    Messages still being stored by another worker are not indexed
+    yet, so a new sid is also claimed in the index, which only one
+    process can do until the message is indexed.
+    """
+
+    def __init__(self, index, bloom: BloomFilter, lru_size: int = 10000):
+        self.index = index
+        self.bloom = bloom
+        self.recent = LRUSet(lru_size)
+        self.lock = threading.Lock()
+        self.counters = {
+            "checks": 0,
+            "duplicates": 0,
+            "lru_hits": 0,
+            "index_hits": 0,
+            "in_flight": 0,
+            "false_positives": 0,
+        }
+
+    def count(self, *names):
+        with self.lock:
+            for name in names:
+                self.counters[name] += 1
+
+    def seen(self, sid: str) -> bool:
+        if sid in self.recent:
+            self.count("checks", "duplicates", "lru_hits")
+            return True
+
+        if sid not in self.bloom:
+            self.count("checks")
+            return False
+
+        if self.index.by_sid(sid) is None:
+            self.count("checks", "false_positives")
+            return False
+
+        self.recent.add(sid)
+        self.count("checks", "duplicates", "index_hits")
+        return True
+
+    def claim(self, sid: str) -> bool:
+        """returns False if ``sid`` was seen before, otherwise
+        remembers it and returns True. Call :py:meth:`release` if the
+        message could not be stored after all."""
+        if self.seen(sid):
+            return False
+
+        if not self.index.claim(sid):
+            self.count("duplicates", "in_flight")
+            return False
+
+        self.recent.add(sid)
+        self.bloom.add(sid)
+        return True
+
+    def release(self, sid: str):
+        # the bloom filter can't forget, the index confirms it's new
+        self.recent.discard(sid)
+        self.index.unclaim(sid)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+        stats["hit_rate"] = (
+            stats["duplicates"] / stats["checks"] if stats["checks"] else 0.0
+        )
+        stats["lru_size"] = len(self.recent)
+        return stats
+
+
+_deduplicators = {}
+
+
+def default_deduplicator() -> Deduplicator:
+    path = Path(SMS_INDEX_PATH).joinpath("sids.bloom")
+    deduplicator = _deduplicators.get(path)
+    if deduplicator is None:
+        deduplicator = _deduplicators.setdefault(
+            path,
+            Deduplicator(
+                default_index(),
+                BloomFilter(path, SMS_DEDUP_CAPACITY, SMS_DEDUP_ERROR_RATE),
+                SMS_DEDUP_LRU_SIZE,
+            ),
+        )
+    return deduplicator
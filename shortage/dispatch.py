@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import signal
+import logging
+import threading
+from pathlib import Path
+from typing import Callable
+
+from shortage.metrics import NOTIFICATIONS, QUEUE_DEPTH, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationSpool(object):
+    """directory of pending notifications, one small json file per entry.
+
+    Entries are claimed by renaming them with the pid of the claiming
+    process as suffix, so that many uwsgi workers can share a single
+    spool without delivering the same notification twice.
+
+    Names start with the time an entry is due. A failed delivery is
+    spooled again ``backoff`` seconds later, twice as long after each
+    attempt, and moved to the ``dead`` directory after
+    ``max_attempts``.
+    """
+
+    suffix = ".json"
+    max_backoff = 3600.0
+
+    def __init__(
+        self,
+        path: [Path, str],
+        max_attempts: int = 10,
+        backoff: float = 30.0,
+    ):
+        self.path = Path(path)
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = float(backoff)
+
+    @property
+    def dead_path(self) -> Path:
+        return self.path.joinpath("dead")
+
+    def put(self, payload: dict, due: float = None) -> Path:
+        self.path.mkdir(parents=True, exist_ok=True)
+        due = time.time() if due is None else due
+        name = f"{due:.6f}-{uuid.uuid4().hex}{self.suffix}"
+        target = self.path.joinpath(name)
+        temp = self.path.joinpath(f".{name}.tmp")
+        with temp.open("w") as fd:
+            fd.write(json.dumps(payload, default=str))
+
+        os.rename(temp, target)
+        return target
+
+    def is_due(self, name: str, now: float) -> bool:
+        try:
+            return float(name.split("-", 1)[0]) <= now
+        except ValueError:
+            return True
+
+    def pending(self):
+        """returns the unclaimed entries that are due, oldest first,
+        plus the entries claimed by processes that are no longer
+        alive"""
+        if not self.path.is_dir():
+            return []
+
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith("."):
+                continue
+            if entry.name.endswith(self.suffix):
+                if self.is_due(entry.name, now):
+                    entries.append(Path(entry.path))
+            elif ".claimed-" in entry.name and not self.owner_is_alive(
+                entry.name
+            ):
+                entries.append(self.release(Path(entry.path)))
+
+        return sorted(filter(None, entries))
+
+    def owner_is_alive(self, name: str) -> bool:
+        try:
+            pid = int(name.rsplit("-", 1)[-1])
+        except ValueError:
+            return True
+
+        if pid == os.getpid():
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def claim(self, path: Path):
+        claimed = path.with_name(f"{path.name}.claimed-{os.getpid()}")
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            # another worker got it first
+            return None
+        return claimed
+
+    def release(self, claimed: Path):
+        original = claimed.with_name(claimed.name.rsplit(".claimed-", 1)[0])
+        try:
+            os.rename(claimed, original)
+        except FileNotFoundError:
+            return None
+        return original
+
+    def load(self, path: Path) -> dict:
+        """the payload of an entry, without its attempt count"""
+        with path.open() as fd:
+            payload = json.load(fd)
+        payload.pop("_attempts", None)
+        return payload
+
+    def retry(self, claimed: Path) -> bool:
+        """spools a claimed entry again after its delivery failed,
+        returns False when it was dead-lettered instead"""
+        with claimed.open() as fd:
+            payload = json.load(fd)
+        attempts = payload.get("_attempts", 0) + 1
+
+        if attempts >= self.max_attempts:
+            self.dead_path.mkdir(parents=True, exist_ok=True)
+            original = claimed.name.rsplit(".claimed-", 1)[0]
+            os.rename(claimed, self.dead_path.joinpath(original))
+            logger.error(
+                f"giving up on notification {original} "
+                f"after {attempts} attempts"
+            )
+            return False
+
+        payload["_attempts"] = attempts
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        self.put(payload, due=time.time() + delay)
+        self.remove(claimed)
+        return True
+
+    def remove(self, path: Path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class NotificationDispatcher(object):
+    """bounded in-process queue of notifications drained by a pool of
+    worker threads.
+
+    Every notification is written to the spool before it is queued,
+    so it survives a restart. When the in-memory queue is full the
+    notification stays in the spool and is picked up by the next
+    spool scan.
+    """
+
+    def __init__(
+        self,
+        deliver: Callable,
+        spool: NotificationSpool,
+        workers: int = 2,
+        maxsize: int = 1000,
+        scan_interval: float = 30.0,
+        drain_timeout: float = 5.0,
+    ):
+        self.deliver = deliver
+        self.spool = spool
+        self.workers = max(1, int(workers))
+        self.maxsize = int(maxsize)
+        self.scan_interval = float(scan_interval)
+        self.drain_timeout = float(drain_timeout)
+
+        self.pid = None
+        self.queue = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.accepting = False
+        self.last_scan = 0.0
+
+    @classmethod
+    def from_config(cls, config, deliver: Callable):
+        spool = NotificationSpool(
+            config.get("NOTIFICATION_SPOOL_PATH"),
+            max_attempts=config.get("NOTIFICATION_MAX_ATTEMPTS"),
+            backoff=config.get("NOTIFICATION_RETRY_BACKOFF"),
+        )
+        return cls(
+            deliver,
+            spool,
+            workers=config.get("NOTIFICATION_WORKERS"),
+            maxsize=config.get("NOTIFICATION_QUEUE_SIZE"),
+            drain_timeout=config.get("NOTIFICATION_DRAIN_TIMEOUT"),
+        )
+
+    @property
+    def is_running(self):
+        return self.pid == os.getpid() and self.accepting
+
+    def start(self):
+        """starts the worker pool, at most once per process.
+
+        Threads do not survive ``fork()``, so every uwsgi worker starts
+        its own. It should be called from the main thread, where the
+        SIGTERM handler that drains the queue can be installed.
+        """
+        if self.is_running:
+            return self
+
+        with self.lock:
+            if self.is_running:
+                return self
+
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.maxsize)
+            self.threads = []
+            self.accepting = True
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work,
+                    name=f"shortage-notifications-{index}",
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+
+            self.install_shutdown_handlers()
+            self.scan()
+
+        return self
+
+    def submit(self, **payload) -> Path:
+        self.start()
+        path = self.spool.put(payload)
+        self.enqueue(path)
+        return path
+
+    def enqueue(self, path: Path) -> bool:
+        try:
+            self.queue.put_nowait(path)
+        except queue.Full:
+            logger.warning(
+                f"notification queue is full, leaving {path.name} in spool"
+            )
+            return False
+        QUEUE_DEPTH.labels("notifications").set(self.queue.qsize())
+        return True
+
+    def scan(self):
+        """enqueues spooled notifications left behind by an overflow
+        or by a previous process"""
+        if not self.scan_lock.acquire(blocking=False):
+            return
+
+        try:
+            self.last_scan = time.monotonic()
+            for path in self.spool.pending():
+                if not self.enqueue(path):
+                    break
+        finally:
+            self.scan_lock.release()
+
+    def work(self):
+        while True:
+            try:
+                path = self.queue.get(timeout=self.scan_interval)
+            except queue.Empty:
+                if not self.accepting:
+                    return
+                self.scan()
+                continue
+
+            QUEUE_DEPTH.labels("notifications").set(self.queue.qsize())
+            try:
+                if path is None:
+                    return
+                self.process(path)
+            finally:
+                self.queue.task_done()
+
+            idle = time.monotonic() - self.last_scan
+            if self.accepting and idle > self.scan_interval:
+                self.scan()
+
+    def process(self, path: Path):
+        claimed = self.spool.claim(path)
+        if not claimed:
+            return
+
+        try:
+            payload = self.spool.load(claimed)
+        except (OSError, ValueError) as e:
+            logger.error(f"dropping unreadable notification {path}: {e}")
+            self.spool.remove(claimed)
+            return
+
+        try:
+            with STAGE_SECONDS.labels("notify").time():
+                self.deliver(**payload)
+        except Exception as e:
+            logger.exception(f"failed to deliver notification {path}: {e}")
+            NOTIFICATIONS.labels("failed").inc()
+            if not self.spool.retry(claimed):
+                NOTIFICATIONS.labels("dead").inc()
+            return
+
+        NOTIFICATIONS.labels("sent").inc()
+        self.spool.remove(claimed)
+
+    def stop(self, timeout: float = None):
+        """stops accepting notifications and waits up to ``timeout``
+        seconds for the queue to drain. Whatever is left stays in the
+        spool for the next process to deliver."""
+        if self.pid != os.getpid() or not self.threads:
+            return
+
+        timeout = self.drain_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        self.accepting = False
+        for _ in self.threads:
+            try:
+                self.queue.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+        pending = self.queue.qsize()
+        if pending:
+            logger.warning(f"{pending} notifications left in spool")
+
+        self.threads = []
+
+    def install_shutdown_handlers(self):
+        atexit.register(self.stop)
+        if threading.current_thread() is not threading.main_thread():
+            logger.warning(
+                "notifications started outside of the main thread, they "
+                "won't be drained on SIGTERM"
+            )
+            return
+
+        previous = signal.getsignal(signal.SIGTERM)
+
+        def handle_sigterm(signum, frame):
+            self.stop()
+            if previous == signal.SIG_IGN:
+                return
+            if callable(previous):
+                return previous(signum, frame)
+
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
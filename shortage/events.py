@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+
+from shortage.config import SMS_STREAM_BUFFER
+from shortage.filesystem import default_storage
+from shortage.indexes import default_index
+from shortage.records import MessageRecord
+from shortage.metrics import STREAMS, STREAMS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+
+MessageEvent = namedtuple("MessageEvent", "id sender recipient frame")
+
+
+class SubscriberDropped(Exception):
+    """the subscriber fell more than a buffer behind the stored
+    messages, it should resume from storage"""
+
+
+def message_json(entry, record) -> dict:
+    """a stored message as the web api returns it, ``record`` is None
+    when the message could not be read back"""
+    return {
+        "sid": entry.sid,
+        "from": entry.sender,
+        "to": entry.recipient,
+        "received_at": entry.received_at,
+        "body": record and record.body,
+        "data": record and record.to_data(),
+    }
+
+
+def message_frame(entry, record) -> str:
+    """a message as a server-sent event, its id is the id of the
+    message in the index, which is never reused"""
+    data = json.dumps(message_json(entry, record), default=str)
+    return f"id: {entry.id}\nevent: message\ndata: {data}\n\n"
+
+
+def replay(last_id: int, sender=None, recipient=None, limit: int = 1000):
+    """yields ``(id, frame)`` for the messages stored after the one a
+    client last received, read back from the index and the storage"""
+    storage = default_storage()
+    for entry in default_index().after(last_id, sender, recipient, limit):
+        blob = storage.get(entry.key_name, entry.key_value)
+        record = MessageRecord.from_blob(blob) if blob is not None else None
+        yield entry.id, message_frame(entry, record)
+
+
+class Broadcaster(object):
+    """fans out stored messages to the event streams of the process.
+
+    Publishing only puts the message on a queue, and only when streams
+    are open, whatever their number. A single thread renders each
+    message once into a ring of the last ``capacity`` events, which the
+    subscribers read at their own pace: a subscriber that falls more
+    than ``capacity`` events behind is dropped instead of slowing down
+    anyone else.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = max(1, int(capacity))
+        self.wakers = []
+        self.forget()
+        os.register_at_fork(after_in_child=self.forget)
+
+    def forget(self):
+        # threads and subscribers don't survive fork()
+        self.condition = threading.Condition()
+        self.inbox = queue.SimpleQueue()
+        self.ring = [None] * self.capacity
+        self.sequence = 0
+        self.subscribers = 0
+        self.thread = None
+
+    def publish(self, entry, record):
+        if self.subscribers:
+            self.inbox.put((entry, record))
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="shortage-events", daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        while True:
+            published = [self.inbox.get()]
+            while True:
+                try:
+                    published.append(self.inbox.get_nowait())
+                except queue.Empty:
+                    break
+
+            events = []
+            for entry, record in published:
+                try:
+                    frame = message_frame(entry, record)
+                except Exception as e:
+                    logger.error(f"failed to render event {entry.id}: {e}")
+                    continue
+                events.append(
+                    MessageEvent(
+                        entry.id, entry.sender, entry.recipient, frame
+                    )
+                )
+
+            with self.condition:
+                for event in events:
+                    self.ring[self.sequence % self.capacity] = event
+                    self.sequence += 1
+                self.condition.notify_all()
+
+            for wake in list(self.wakers):
+                wake()
+
+    def subscribe(self, sender=None, recipient=None, limit: int = None):
+        """returns a :py:class:`Subscription` to the messages stored
+        from now on, or None when ``limit`` subscribers are open"""
+        self.start()
+        with self.condition:
+            if limit is not None and self.subscribers >= limit:
+                return None
+            self.subscribers += 1
+            STREAMS.set(self.subscribers)
+            return Subscription(self, self.sequence, sender, recipient)
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+            STREAMS.set(self.subscribers)
+
+    def add_waker(self, wake):
+        """calls ``wake()`` from the broadcasting thread whenever events
+        were added, for subscribers that can't block on a condition"""
+        self.wakers.append(wake)
+
+    def remove_waker(self, wake):
+        if wake in self.wakers:
+            self.wakers.remove(wake)
+
+
+class Subscription(object):
+    """the position of a single event stream in the ring of its
+    :py:class:`Broadcaster`"""
+
+    def __init__(self, broadcaster, position, sender=None, recipient=None):
+        self.broadcaster = broadcaster
+        self.position = position
+        self.sender = sender
+        self.recipient = recipient
+        self.closed = False
+
+    def matches(self, event: MessageEvent) -> bool:
+        return (not self.sender or event.sender == self.sender) and (
+            not self.recipient or event.recipient == self.recipient
+        )
+
+    def take(self) -> list:
+        """the events added since the last call, must be called with
+        the condition of the broadcaster held"""
+        broadcaster = self.broadcaster
+        if broadcaster.sequence - self.position > broadcaster.capacity:
+            STREAMS_DROPPED.inc()
+            raise SubscriberDropped(
+                f"{broadcaster.sequence - self.position} events behind"
+            )
+
+        events = [
+            broadcaster.ring[sequence % broadcaster.capacity]
+            for sequence in range(self.position, broadcaster.sequence)
+        ]
+        self.position = broadcaster.sequence
+        return [event for event in events if self.matches(event)]
+
+    def poll(self) -> list:
+        with self.broadcaster.condition:
+            return self.take()
+
+    def wait(self, timeout: float) -> list:
+        """blocks until matching events were added or ``timeout``
+        seconds passed, in which case the list is empty"""
+        deadline = time.monotonic() + timeout
+        condition = self.broadcaster.condition
+        with condition:
+            while True:
+                events = self.take()
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                condition.wait(remaining)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcaster.unsubscribe()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_broadcaster = None
+
+
+def default_broadcaster() -> Broadcaster:
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = Broadcaster(SMS_STREAM_BUFFER)
+    return _broadcaster
@@ -0,0 +1,204 @@
+import io
+import os
+import sys
+import csv
+import gzip
+import json
+import logging
+from datetime import datetime
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from shortage.filesystem import FileStorage, sanitize
+from shortage.indexes import participant, to_timestamp
+from shortage.records import MessageRecord, chunked
+
+logger = logging.getLogger(__name__)
+
+
+CSV_COLUMNS = ("received_at", "key", "sid", "from", "to", "status", "body")
+
+
+def parse_time(value) -> float:
+    """a unix timestamp or an ISO 8601 date, naive dates are local"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def ordered_map(function, items, executor, window: int):
+    """like ``executor.map()`` but consumes ``items`` lazily, with at
+    most ``window`` calls in flight, so that memory stays flat however
+    many items there are. Results come out in the order of ``items``."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def message_row(key_name: str, key_value: str, record: MessageRecord):
+    return {
+        "received_at": to_timestamp(key_value),
+        "key": key_name,
+        "sid": record.sid,
+        "from": record.sender,
+        "to": record.recipient,
+        "status": record.status,
+        "body": record.body,
+        "data": record.to_data(),
+    }
+
+
+class Export(object):
+    """walks a storage one message at a time, key by key, and yields
+    the messages matching the filters as rows.
+
+    Time filters are applied to the file names of a
+    :py:class:`FileStorage` before anything is read. Its directories
+    are walked with ``os.scandir()`` in directory order, never listed
+    as a whole, and the files are read by a pool of threads ``chunk``
+    at a time with a bounded number of chunks in flight.
+    """
+
+    def __init__(
+        self,
+        storage,
+        since: float = None,
+        until: float = None,
+        recipients=(),
+        senders=(),
+        limit: int = None,
+        workers: int = 8,
+        chunk: int = 64,
+    ):
+        self.storage = storage
+        self.since = float("-inf") if since is None else since
+        self.until = float("inf") if until is None else until
+        self.recipients = {sanitize(r) for r in recipients}
+        self.senders = {participant(s) for s in senders}
+        self.limit = limit
+        self.workers = max(1, int(workers))
+        self.chunk = max(1, int(chunk))
+        self.counts = {"exported": 0, "filtered": 0, "failed": 0}
+
+    def in_range(self, key_value: str) -> bool:
+        return self.since <= to_timestamp(key_value) < self.until
+
+    def keys(self):
+        return [
+            key_name
+            for key_name in self.storage.keys()
+            if not self.recipients or key_name in self.recipients
+        ]
+
+    def files(self):
+        """yields ``(key_name, key_value, path)`` of the blob files in
+        the time range"""
+        extensions = self.storage.extensions
+        for key_name in self.keys():
+            key_path = self.storage.base_path.joinpath(key_name)
+            with os.scandir(key_path) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(extensions):
+                        continue
+                    key_value = entry.name.rsplit(".", 1)[0]
+                    if self.in_range(key_value):
+                        yield key_name, key_value, entry.path
+                    else:
+                        self.counts["filtered"] += 1
+
+    def read_files(self, files: list) -> list:
+        blobs = []
+        for key_name, key_value, path in files:
+            try:
+                with open(path, "rb") as fd:
+                    blob = self.storage.codecs.load(fd.read())
+            except Exception as e:
+                logger.error(f"failed to read {path}: {e}")
+                blob = None
+            blobs.append((key_name, key_value, blob))
+        return blobs
+
+    def blobs(self):
+        """yields ``(key_name, key_value, blob)``, blob being None when
+        it could not be read"""
+        if not isinstance(self.storage, FileStorage):
+            for key_name in self.keys():
+                for key_value, blob in self.storage.scan(key_name):
+                    if self.in_range(key_value):
+                        yield key_name, key_value, blob
+                    else:
+                        self.counts["filtered"] += 1
+            return
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            chunks = ordered_map(
+                self.read_files,
+                chunked(self.files(), self.chunk),
+                executor,
+                self.workers * 2,
+            )
+            for blobs in chunks:
+                yield from blobs
+
+    def rows(self):
+        for key_name, key_value, blob in self.blobs():
+            if blob is None:
+                self.counts["failed"] += 1
+                continue
+
+            record = MessageRecord.from_blob(blob)
+            if self.senders and participant(record.sender) not in self.senders:
+                self.counts["filtered"] += 1
+                continue
+
+            yield message_row(key_name, key_value, record)
+            self.counts["exported"] += 1
+            if self.limit and self.counts["exported"] >= self.limit:
+                return
+
+
+def write_ndjson(rows, fd):
+    for row in rows:
+        fd.write(json.dumps(row, ensure_ascii=False, default=str))
+        fd.write("\n")
+
+
+def write_csv(rows, fd):
+    """the columns of :py:data:`CSV_COLUMNS`, the other twilio fields
+    are only exported as ndjson"""
+    writer = csv.DictWriter(fd, CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+
+WRITERS = {"ndjson": write_ndjson, "csv": write_csv}
+
+
+@contextmanager
+def output(path=None, compress: bool = False):
+    """a text stream to ``path`` or to stdout when it is None or
+    ``-``, gzipped when ``compress`` is set"""
+    to_stdout = path in (None, "-")
+    binary = sys.stdout.buffer if to_stdout else open(path, "wb")
+    compressed = gzip.GzipFile(fileobj=binary, mode="wb") if compress else None
+    text = io.TextIOWrapper(compressed or binary, encoding="utf-8", newline="")
+    try:
+        yield text
+    finally:
+        text.flush()
+        text.detach()
+        if compressed is not None:
+            compressed.close()
+        if to_stdout:
+            binary.flush()
+        else:
+            binary.close()
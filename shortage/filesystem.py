@@ -1,14 +1,43 @@
+import os
 import re
+import mmap
+import fcntl
+import struct
+import bisect
 import logging
-import json
+import threading
+from zlib import crc32
 from pathlib import Path
-from shortage.config import SMS_STORAGE_PATH
+from collections import namedtuple, OrderedDict
+from shortage.config import (
+    SMS_STORAGE_PATH,
+    SMS_STORAGE_BACKEND,
+    SMS_STORAGE_CODEC,
+    SMS_LOG_SEGMENT_SIZE,
+    SMS_LOG_INDEX_INTERVAL,
+    SMS_GROUP_COMMIT,
+    SMS_GROUP_COMMIT_BATCH_SIZE,
+    SMS_GROUP_COMMIT_MAX_WAIT,
+    SMS_DIRECTORY_CACHE_SIZE,
+    SMS_S3_BUCKET,
+    SMS_S3_PREFIX,
+    SMS_S3_ENDPOINT_URL,
+    SMS_S3_POOL_SIZE,
+    SMS_S3_BATCH_SIZE,
+    SMS_S3_MAX_WAIT,
+    SMS_SQLITE_PATH,
+)
+from shortage.serialization import Codecs, create_codecs
+from shortage.groupcommit import GroupCommit, sync_filesystem
 
 logger = logging.getLogger(__name__)
 
 
+non_word = re.compile(r"\W+")
+
+
 def slugify(string: str, separator: str = "_"):
-    return re.sub(r"\W+", separator, string)
+    return non_word.sub(separator, string)
 
 
 def sanitize(string: str):
@@ -24,18 +53,141 @@ def sanitize(string: str):
 
 
 def ensure_path_exists_as_directory(path: Path):
-    if not path.is_dir() and path.exists():
+    # checking before mkdir() races with other threads creating the
+    # same directory, mkdir() only fails if path is not a directory
+    try:
+        path.mkdir(parents=True, exist_ok=True)
+    except FileExistsError:
         raise IOError(f"{path} already exists and is not a directory.")
 
-    path.mkdir(parents=True, exist_ok=True)
     return path
 
 
+def write_all(fd: int, blob: bytes):
+    view = memoryview(blob)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def write_blobs(writes):
+    """writes a batch of ``(blob_path, blob)`` and makes all of them
+    durable with a single filesystem sync"""
+    results = []
+    for blob_path, blob in writes:
+        try:
+            with blob_path.open("wb") as fd:
+                fd.write(blob)
+            results.append(blob_path)
+        except OSError as e:
+            results.append(e)
+
+    fd = os.open(writes[0][0].parent, os.O_RDONLY)
+    try:
+        sync_filesystem(fd)
+    finally:
+        os.close(fd)
+
+    return results
+
+
+class DirectoryCache(object):
+    """LRU of key name -> (sanitized name, open directory fd).
+
+    Once a key is known, blobs are opened relative to its cached fd
+    without any ``mkdir()`` or path lookup from the root. Every use
+    checks with a single ``fstatat()`` in the base directory that the
+    fd is still the key's directory, so that a directory removed or
+    renamed since is created and opened again instead of receiving
+    blobs nobody can find.
+    """
+
+    def __init__(self, base_path: [Path, str], capacity: int = 1024):
+        self.base_path = Path(base_path)
+        self.capacity = int(capacity)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.base_fd = None
+
+    def is_current(self, entry) -> bool:
+        sanitized, _, identity = entry
+        try:
+            st = os.stat(sanitized, dir_fd=self.base_fd, follow_symlinks=False)
+        except FileNotFoundError:
+            return False
+        return (st.st_dev, st.st_ino) == identity
+
+    def entry(self, key_name: str):
+        entry = self.entries.get(key_name)
+        if entry is not None:
+            if self.is_current(entry):
+                self.entries.move_to_end(key_name)
+                return entry
+            del self.entries[key_name]
+            os.close(entry[1])
+
+        if self.base_fd is None:
+            self.base_fd = os.open(self.base_path, os.O_RDONLY)
+
+        sanitized = sanitize(key_name)
+        try:
+            os.mkdir(sanitized, dir_fd=self.base_fd)
+        except FileExistsError:
+            pass
+
+        flags = os.O_RDONLY | os.O_DIRECTORY
+        fd = os.open(sanitized, flags, dir_fd=self.base_fd)
+        st = os.fstat(fd)
+        entry = (sanitized, fd, (st.st_dev, st.st_ino))
+        self.entries[key_name] = entry
+        while len(self.entries) > self.capacity:
+            _, (_, evicted, _) = self.entries.popitem(last=False)
+            os.close(evicted)
+
+        return entry
+
+    def sanitized(self, key_name: str) -> str:
+        with self.lock:
+            return self.entry(key_name)[0]
+
+    def open(self, key_name: str, filename: str, flags: int, mode=0o666):
+        """returns ``(sanitized name, fd)`` of ``filename`` opened
+        inside the directory of ``key_name``"""
+        # the lock keeps the directory fd from being evicted and closed
+        # while another thread opens a file relative to it
+        with self.lock:
+            sanitized, dir_fd, _ = self.entry(key_name)
+            return sanitized, os.open(filename, flags, mode, dir_fd=dir_fd)
+
+    def close(self):
+        with self.lock:
+            for _, fd, _ in self.entries.values():
+                os.close(fd)
+            self.entries.clear()
+            if self.base_fd is not None:
+                os.close(self.base_fd)
+                self.base_fd = None
+
+
 class FileStorage(object):
-    def __init__(self, base_path: [Path, str]):
+    extensions = (".json", ".blob")
+    write_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+
+    def __init__(
+        self,
+        base_path: [Path, str],
+        codecs: Codecs = None,
+        group_commit: GroupCommit = None,
+        directories: DirectoryCache = None,
+    ):
         self.base_path = Path(base_path)
+        self.codecs = codecs or Codecs()
+        self.group_commit = group_commit
+        self.directories = directories
 
     def path_to_key(self, name: str):
+        if self.directories:
+            return self.base_path.joinpath(self.directories.sanitized(name))
+
         sanitized = sanitize(name)
         return ensure_path_exists_as_directory(
             self.base_path.joinpath(sanitized)
@@ -43,26 +195,377 @@ class FileStorage(object):
 
     def path_to_blob(self, key_name, key_value):
         key_path = self.path_to_key(key_name)
-        blob_path = key_path.joinpath(f"{key_value}.json")
+        blob_path = key_path.joinpath(f"{key_value}.{self.codecs.extension}")
         return blob_path
 
     def add(self, key_name, key_value, data):
-        blob_path = self.path_to_blob(key_name, key_value)
-        if isinstance(data, bytes):
-            data = data.decode("utf-8")
-
-        blob = json.dumps(data, indent=2, default=str)
-        with blob_path.open("w") as fd:
-            fd.write(blob)
+        blob = self.codecs.dump(data)
+        if self.directories and not self.group_commit:
+            filename = f"{key_value}.{self.codecs.extension}"
+            sanitized, fd = self.directories.open(
+                key_name, filename, self.write_flags
+            )
+            try:
+                write_all(fd, blob)
+            finally:
+                os.close(fd)
+            blob_path = self.base_path.joinpath(sanitized, filename)
+        elif self.group_commit:
+            blob_path = self.path_to_blob(key_name, key_value)
+            self.group_commit.submit((blob_path, blob))
+        else:
+            blob_path = self.path_to_blob(key_name, key_value)
+            with blob_path.open("wb") as fd:
+                fd.write(blob)
 
         logger.info(f"wrote blob: {blob_path}")
         return blob_path
 
+    def keys(self):
+        return sorted(
+            entry.name
+            for entry in os.scandir(self.base_path)
+            if entry.is_dir() and not entry.name.startswith(".")
+        )
+
+    def read(self, blob_path: Path):
+        with blob_path.open("rb") as fd:
+            return self.codecs.load(fd.read())
+
+    def get(self, key_name, key_value):
+        key_path = self.base_path.joinpath(sanitize(key_name))
+        preferred = f".{self.codecs.extension}"
+        extensions = sorted(self.extensions, key=lambda e: e != preferred)
+        for extension in extensions:
+            try:
+                return self.read(key_path.joinpath(f"{key_value}{extension}"))
+            except FileNotFoundError:
+                continue
+
+        return None
+
+    def scan(self, key_name):
+        """yields ``(key_value, data)`` for every blob of the given key"""
+        key_path = self.base_path.joinpath(sanitize(key_name))
+        if not key_path.is_dir():
+            return
+
+        names = sorted(
+            entry.name
+            for entry in os.scandir(key_path)
+            if entry.name.endswith(self.extensions)
+        )
+        for name in names:
+            key_value = name.rsplit(".", 1)[0]
+            yield key_value, self.read(key_path.joinpath(name))
+
+    def raw_blobs(self):
+        """yields ``(key_name, key_value, raw bytes)`` of every blob in
+        directory order, without listing a whole directory in memory"""
+        for key_name in self.keys():
+            with os.scandir(self.base_path.joinpath(key_name)) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(self.extensions):
+                        continue
+                    with open(entry.path, "rb") as fd:
+                        raw = fd.read()
+                    yield key_name, entry.name.rsplit(".", 1)[0], raw
+
+
+SegmentPosition = namedtuple("SegmentPosition", "path offset")
+
+
+def sort_key(key_value: str):
+    try:
+        return (0, float(key_value), "")
+    except ValueError:
+        return (1, 0.0, key_value)
+
+
+class LogStorage(object):
+    """append-only storage that groups records per key into rotating
+    segment files instead of writing one file per record.
+
+    Each record is ``length | crc32 | key length | key | blob`` and
+    every record that crosses an ``index_interval`` boundary gets an
+    entry in the sparse ``.idx`` file of its segment, so that reads
+    can seek close to a record instead of scanning the whole segment.
+    """
+
+    header = struct.Struct(">IIH")
+    index_entry = struct.Struct(">QH")
+
+    def __init__(
+        self,
+        base_path: [Path, str],
+        segment_size: int = 64 * 1024 * 1024,
+        index_interval: int = 4096,
+        codecs: Codecs = None,
+    ):
+        self.base_path = Path(base_path)
+        self.codecs = codecs or Codecs()
+        self.segment_size = int(segment_size)
+        self.index_interval = int(index_interval)
+        self.lock = threading.Lock()
+
+    def path_to_key(self, name: str):
+        return ensure_path_exists_as_directory(
+            self.base_path.joinpath(sanitize(name))
+        )
+
+    def segments(self, key_path: Path):
+        return sorted(
+            key_path.joinpath(entry.name)
+            for entry in os.scandir(key_path)
+            if entry.name.endswith(".log")
+        )
+
+    def segment_path(self, key_path: Path, number: int):
+        return key_path.joinpath(f"{number:012d}.log")
+
+    def encode(self, key_value, data) -> bytes:
+        key = str(key_value).encode("utf-8")
+        body = key + self.codecs.dump(data)
+        return self.header.pack(len(body), crc32(body), len(key)) + body
+
+    def add(self, key_name, key_value, data):
+        record = self.encode(key_value, data)
+        key_path = self.path_to_key(key_name)
+
+        with self.lock:
+            segments = self.segments(key_path)
+            number = int(segments[-1].stem) if segments else 0
+            while True:
+                path = self.segment_path(key_path, number)
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+                try:
+                    # other processes may append to the same segment
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    offset = os.fstat(fd).st_size
+                    full = offset + len(record) > self.segment_size
+                    if offset and full:
+                        number += 1
+                        continue
+
+                    os.write(fd, record)
+                    if self.should_index(offset, len(record)):
+                        self.write_index_entry(path, key_value, offset)
+                finally:
+                    os.close(fd)
+
+                logger.info(f"appended {len(record)} bytes to {path}")
+                return SegmentPosition(path, offset)
+
+    def should_index(self, offset: int, length: int) -> bool:
+        if offset == 0:
+            return True
+        interval = self.index_interval
+        return offset // interval != (offset + length) // interval
+
+    def write_index_entry(self, segment: Path, key_value, offset: int):
+        key = str(key_value).encode("utf-8")
+        with segment.with_suffix(".idx").open("ab") as fd:
+            fd.write(self.index_entry.pack(offset, len(key)) + key)
+
+    def read_index(self, segment: Path):
+        try:
+            raw = segment.with_suffix(".idx").read_bytes()
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        position = 0
+        size = self.index_entry.size
+        while position + size <= len(raw):
+            offset, length = self.index_entry.unpack_from(raw, position)
+            position += size
+            key = raw[position: position + length].decode("utf-8")
+            position += length
+            entries.append((sort_key(key), offset))
+
+        return entries
+
+    def read_records(self, segment: Path, start: int = 0, stop: int = None):
+        """yields ``(key_value, data, offset)`` reading the segment
+        through ``mmap``"""
+        with segment.open("rb") as fd:
+            size = os.fstat(fd.fileno()).st_size
+            if not size:
+                return
+
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                position = start
+                stop = size if stop is None else min(stop, size)
+                while position + self.header.size <= stop:
+                    length, checksum, key_length = self.header.unpack_from(
+                        view, position
+                    )
+                    begin = position + self.header.size
+                    body = view[begin: begin + length]
+                    if len(body) < length or crc32(body) != checksum:
+                        logger.warning(
+                            f"corrupt or partial record at {segment}:{position}"
+                        )
+                        return
+
+                    key = body[:key_length].decode("utf-8")
+                    data = self.codecs.load(body[key_length:])
+                    yield key, data, position
+                    position = begin + length
+
+    def keys(self):
+        return sorted(
+            entry.name
+            for entry in os.scandir(self.base_path)
+            if entry.is_dir() and not entry.name.startswith(".")
+        )
+
+    def scan(self, key_name):
+        """yields ``(key_value, data)`` for every record of the given
+        key, in the order they were appended"""
+        key_path = self.base_path.joinpath(sanitize(key_name))
+        if not key_path.is_dir():
+            return
+
+        for segment in self.segments(key_path):
+            for key, data, _ in self.read_records(segment):
+                yield key, data
+
+    def get(self, key_name, key_value):
+        key_path = self.base_path.joinpath(sanitize(key_name))
+        if not key_path.is_dir():
+            return None
+
+        key_value = str(key_value)
+        target = sort_key(key_value)
+        segments = self.segments(key_path)
+        for segment in reversed(segments):
+            index = self.read_index(segment)
+            if not index or index[0][0] > target:
+                continue
+
+            # keys written concurrently may be slightly out of order,
+            # so look one index entry around the expected position
+            position = bisect.bisect_right(index, (target, float("inf")))
+            start = index[max(0, position - 2)][1]
+            stop = index[position + 1][1] if position + 1 < len(index) else None
+            for key, data, _ in self.read_records(segment, start, stop):
+                if key == key_value:
+                    return data
+            break
+
+        for segment in segments:
+            for key, data, _ in self.read_records(segment):
+                if key == key_value:
+                    return data
+
+        return None
+
 
 def get_storage_path():
     return Path(SMS_STORAGE_PATH or "~/.shortage/data").expanduser().absolute()
 
 
+def get_dictionaries_path():
+    return get_storage_path().joinpath(".zdicts")
+
+
+_group_commits = {}
+
+
+def get_group_commit(blob_path: Path) -> GroupCommit:
+    """one writer thread per storage path and process"""
+    if blob_path not in _group_commits:
+        _group_commits[blob_path] = GroupCommit(
+            write_blobs,
+            batch_size=SMS_GROUP_COMMIT_BATCH_SIZE,
+            max_wait=SMS_GROUP_COMMIT_MAX_WAIT,
+        )
+    return _group_commits[blob_path]
+
+
+def create_storage():
+    blob_path = ensure_path_exists_as_directory(get_storage_path())
+    codecs = create_codecs(SMS_STORAGE_CODEC, get_dictionaries_path())
+    if SMS_STORAGE_BACKEND == "log":
+        return LogStorage(
+            blob_path,
+            segment_size=SMS_LOG_SEGMENT_SIZE,
+            index_interval=SMS_LOG_INDEX_INTERVAL,
+            codecs=codecs,
+        )
+
+    if SMS_STORAGE_BACKEND == "partitioned":
+        from shortage.partitions import PartitionedStorage
+
+        return PartitionedStorage(blob_path, codecs=codecs)
+
+    if SMS_STORAGE_BACKEND == "sqlite":
+        from shortage.sqlstorage import SQLiteStorage
+
+        return SQLiteStorage(
+            SMS_SQLITE_PATH,
+            codecs=codecs,
+            batch_size=SMS_GROUP_COMMIT_BATCH_SIZE,
+            max_wait=SMS_GROUP_COMMIT_MAX_WAIT,
+        )
+
+    if SMS_STORAGE_BACKEND == "s3":
+        from shortage.s3 import S3Storage, get_s3_client
+
+        return S3Storage(
+            SMS_S3_BUCKET,
+            prefix=SMS_S3_PREFIX,
+            client=get_s3_client(SMS_S3_ENDPOINT_URL, SMS_S3_POOL_SIZE),
+            codecs=codecs,
+            batch_size=SMS_S3_BATCH_SIZE,
+            max_wait=SMS_S3_MAX_WAIT,
+        )
+
+    group_commit = get_group_commit(blob_path) if SMS_GROUP_COMMIT else None
+    return FileStorage(
+        blob_path,
+        codecs=codecs,
+        group_commit=group_commit,
+        directories=DirectoryCache(blob_path, SMS_DIRECTORY_CACHE_SIZE),
+    )
+
+
+class StorageManager(object):
+    """holds the storage of the current process.
+
+    The storage is created once per process, the first time it is
+    needed after ``fork()``, so uwsgi workers don't share the cached
+    directory fds of the master.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.current = None
+        self.lock = threading.Lock()
+
+    @property
+    def storage(self):
+        if self.pid == os.getpid():
+            return self.current
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.current = create_storage()
+                self.pid = os.getpid()
+
+        return self.current
+
+    def reset(self):
+        with self.lock:
+            directories = getattr(self.current, "directories", None)
+            if directories and self.pid == os.getpid():
+                directories.close()
+            self.pid = self.current = None
+
+
+storage_manager = StorageManager()
+
+
 def default_storage():
-    blob_path = get_storage_path()
-    return FileStorage(ensure_path_exists_as_directory(blob_path))
+    return storage_manager.storage
@@ -0,0 +1,149 @@
+import os
+import time
+import queue
+import ctypes
+import ctypes.util
+import logging
+import threading
+from typing import Callable
+
+from shortage.metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+def load_syncfs():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return libc.syncfs
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+_syncfs = load_syncfs()
+
+
+def sync_filesystem(fd: int):
+    """makes every write to the filesystem containing ``fd`` durable
+    with a single syscall: ``syncfs(2)`` where available, ``sync(2)``
+    elsewhere"""
+    if _syncfs is None:
+        os.sync()
+        return
+
+    if _syncfs(fd) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+class PendingWrite(object):
+    __slots__ = ("item", "done", "result", "error")
+
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommit(object):
+    """coalesces concurrent writes into batches handled by a single
+    writer thread.
+
+    ``write_batch`` receives the items of a batch and must return one
+    result per item after making the whole batch durable, typically
+    with one fsync. Callers of :py:meth:`submit` block until the batch
+    holding their item is durable.
+    """
+
+    def __init__(
+        self,
+        write_batch: Callable,
+        batch_size: int = 64,
+        max_wait: float = 0.002,
+    ):
+        self.write_batch = write_batch
+        self.batch_size = int(batch_size)
+        self.max_wait = float(max_wait)
+
+        self.pid = None
+        self.queue = None
+        self.lock = threading.Lock()
+
+        self.batches = 0
+        self.writes = 0
+        self.max_batch_size = 0
+        self.last_batch_size = 0
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.queue = queue.Queue()
+            threading.Thread(
+                target=self.run, name="shortage-group-commit", daemon=True
+            ).start()
+            self.pid = os.getpid()
+
+    def submit(self, item):
+        self.start()
+        pending = PendingWrite(item)
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def collect(self):
+        """waits for one item, then for up to ``max_wait`` seconds for
+        more. Items that arrive while a batch is being committed are
+        picked up right away by the next one."""
+        batch = [self.queue.get()]
+        QUEUE_DEPTH.labels("group_commit").set(self.queue.qsize())
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                results = self.write_batch([p.item for p in batch])
+            except Exception as e:
+                logger.exception(f"failed to commit batch of {len(batch)}")
+                results = [e] * len(batch)
+
+            for pending, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    pending.error = result
+                else:
+                    pending.result = result
+                pending.done.set()
+
+            self.batches += 1
+            self.writes += len(batch)
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+
+    def stats(self) -> dict:
+        batches = self.batches
+        return {
+            "batches": batches,
+            "writes": self.writes,
+            "mean_batch_size": self.writes / batches if batches else 0,
+            "max_batch_size": self.max_batch_size,
+            "last_batch_size": self.last_batch_size,
+        }
@@ -0,0 +1,693 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+from functools import lru_cache
+from pathlib import Path
+from collections import namedtuple
+from shortage.config import SMS_INDEX_PATH
+from shortage.filesystem import sanitize
+from shortage.records import MessageRecord
+
+logger = logging.getLogger(__name__)
+
+
+IndexEntry = namedtuple(
+    "IndexEntry", "id sid sender recipient received_at key_name key_value"
+)
+
+
+Thread = namedtuple(
+    "Thread",
+    "id participant_a participant_b message_count unread_count read_until "
+    "last_sid last_sender last_body last_received_at",
+)
+
+
+# ids are never reused, not even by clear(): event streams resume from
+# them with Last-Event-ID
+MESSAGES_TABLE = """
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sid TEXT,
+    sender TEXT,
+    recipient TEXT,
+    received_at REAL NOT NULL,
+    key_name TEXT NOT NULL,
+    key_value TEXT NOT NULL,
+    thread_id INTEGER,
+    UNIQUE (key_name, key_value)
+);
+"""
+
+SCHEMA = MESSAGES_TABLE.format(name="messages") + """
+CREATE INDEX IF NOT EXISTS messages_by_sid ON messages (sid);
+CREATE INDEX IF NOT EXISTS messages_by_sender
+    ON messages (sender, received_at);
+CREATE INDEX IF NOT EXISTS messages_by_recipient
+    ON messages (recipient, received_at);
+CREATE INDEX IF NOT EXISTS messages_by_time ON messages (received_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS bodies USING fts5 (
+    body, tokenize = 'unicode61'
+);
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    participant_a TEXT NOT NULL,
+    participant_b TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    read_until REAL NOT NULL DEFAULT 0,
+    last_sid TEXT,
+    last_sender TEXT,
+    last_body TEXT,
+    last_received_at REAL,
+    UNIQUE (participant_a, participant_b)
+);
+CREATE INDEX IF NOT EXISTS threads_by_activity
+    ON threads (last_received_at, id);
+CREATE TABLE IF NOT EXISTS claims (
+    sid TEXT PRIMARY KEY,
+    claimed_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+# created once messages of older indexes have a thread_id
+THREAD_SCHEMA = """
+CREATE INDEX IF NOT EXISTS messages_by_thread
+    ON messages (thread_id, received_at);
+"""
+
+COLUMNS = "id, sid, sender, recipient, received_at, key_name, key_value"
+THREAD_COLUMNS = ", ".join(Thread._fields)
+
+INSERT = (
+    "INSERT OR REPLACE INTO messages "
+    "(sid, sender, recipient, received_at, key_name, key_value, thread_id) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+# INSERT OR REPLACE gives a replaced message a new id, so its body
+# has to be removed from the full-text index first and it must not be
+# counted twice in its thread
+FIND_REPLACED = (
+    "SELECT id, thread_id, received_at FROM messages "
+    "WHERE key_name = ? AND key_value = ?"
+)
+FORGET_BODY = "DELETE FROM bodies WHERE rowid = ?"
+# a message being stored by a worker is claimed by its sid until it
+# is indexed, claims older than the timeout were abandoned
+CLAIM = (
+    "INSERT INTO claims (sid, claimed_at) VALUES (?, ?) "
+    "ON CONFLICT (sid) DO UPDATE SET claimed_at = excluded.claimed_at "
+    "WHERE claimed_at < ?"
+)
+UNCLAIM = "DELETE FROM claims WHERE sid = ?"
+INSERT_BODY = "INSERT INTO bodies (rowid, body) VALUES (?, ?)"
+
+# the summary of a thread follows its newest message, whatever the
+# order messages are indexed in
+SUMMARY = ("last_sid", "last_sender", "last_body", "last_received_at")
+UPSERT_THREAD = (
+    "INSERT INTO threads (participant_a, participant_b, message_count, "
+    f"unread_count, {', '.join(SUMMARY)}) VALUES (?, ?, 1, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (participant_a, participant_b) DO UPDATE SET "
+    "message_count = message_count + 1, "
+    "unread_count = unread_count + ("
+    "excluded.unread_count AND excluded.last_received_at > read_until), "
+    + ", ".join(
+        f"{column} = CASE WHEN excluded.last_received_at >= "
+        f"coalesce(last_received_at, 0) THEN excluded.{column} "
+        f"ELSE {column} END"
+        for column in SUMMARY
+    )
+)
+FORGET_IN_THREAD = (
+    "UPDATE threads SET message_count = message_count - 1, "
+    "unread_count = max(unread_count - (? AND ? > read_until), 0) "
+    "WHERE id = ?"
+)
+
+# twilio statuses of the messages received, the others are status
+# callbacks of the messages sent
+INCOMING_STATUSES = (None, "received", "receiving")
+
+SearchResult = namedtuple("SearchResult", "entry snippet")
+
+word = re.compile(r"\w+")
+non_digit = re.compile(r"\D+")
+
+
+def search_expression(text: str) -> str:
+    """turns free text into an fts5 query matching every word of it,
+    quoting each word so that user input can't use the query syntax"""
+    return " ".join(f'"{term}"' for term in word.findall(text or ""))
+
+
+def message_fields(blob: dict) -> dict:
+    """extracts the indexed twilio fields from a stored request blob"""
+    record = MessageRecord.from_blob(blob)
+    return {
+        "sid": record.sid,
+        "sender": record.sender,
+        "recipient": record.recipient,
+        "body": record.body,
+        "status": record.status,
+    }
+
+
+@lru_cache(maxsize=4096)
+def participant(number) -> str:
+    """phone numbers compare equal whatever their punctuation,
+    alphanumeric senders are compared case-insensitively"""
+    number = str(number or "").strip()
+    digits = non_digit.sub("", number)
+    if not digits:
+        return number.lower()
+    return f"+{digits}" if number.startswith("+") else digits
+
+
+def thread_key(sender, recipient) -> tuple:
+    """the participants of the conversation a message belongs to, in
+    the same order whichever way the message went"""
+    return tuple(sorted((participant(sender), participant(recipient))))
+
+
+def to_timestamp(key_value) -> float:
+    try:
+        return float(key_value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class MessageIndex(object):
+    """persistent secondary indexes over stored messages.
+
+    The indexes live in a sqlite b-tree so each lookup is O(log n)
+    and only points at ``(key_name, key_value)``, which is what the
+    storage backends need to read the message itself.
+    """
+
+    def __init__(self, path: [Path, str]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads or fork()
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        self.migrate(connection)
+        if self.migrate_ids(connection):
+            connection.executescript(SCHEMA)
+        connection.executescript(THREAD_SCHEMA)
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def migrate(self, connection):
+        """threads messages of indexes created before threads"""
+        if self.has_threads(connection):
+            return
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have migrated it in the meantime
+            if not self.has_threads(connection):
+                connection.execute(
+                    "ALTER TABLE messages ADD COLUMN thread_id INTEGER"
+                )
+                total = self.thread_messages(connection)
+                logger.warning(f"threaded {total} messages of {self.path}")
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def migrate_ids(self, connection) -> bool:
+        """copies the messages of indexes created before their ids were
+        AUTOINCREMENT into a table that has them, the indexes of the
+        table are to be created again"""
+        if self.has_autoincrement(connection):
+            return False
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.has_autoincrement(connection):
+                connection.rollback()
+                return False
+
+            columns = "id, sid, sender, recipient, received_at, " + (
+                "key_name, key_value, thread_id"
+            )
+            connection.execute("DROP TABLE IF EXISTS messages_migrated")
+            connection.execute(MESSAGES_TABLE.format(name="messages_migrated"))
+            connection.execute(
+                f"INSERT INTO messages_migrated ({columns}) "
+                f"SELECT {columns} FROM messages"
+            )
+            connection.execute("DROP TABLE messages")
+            connection.execute(
+                "ALTER TABLE messages_migrated RENAME TO messages"
+            )
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+        logger.warning(f"made the message ids of {self.path} AUTOINCREMENT")
+        return True
+
+    def has_autoincrement(self, connection) -> bool:
+        sql = connection.execute(
+            "SELECT sql FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'messages'"
+        ).fetchone()[0]
+        return "AUTOINCREMENT" in sql.upper()
+
+    def has_threads(self, connection) -> bool:
+        columns = connection.execute("PRAGMA table_info(messages)")
+        return "thread_id" in {column[1] for column in columns}
+
+    def thread_messages(self, connection, batch_size: int = 1000) -> int:
+        total = 0
+        last = 0
+        while True:
+            rows = connection.execute(
+                "SELECT m.id, m.sid, m.sender, m.recipient, m.received_at, "
+                "b.body FROM messages m LEFT JOIN bodies b ON b.rowid = m.id "
+                "WHERE m.id > ? ORDER BY m.id LIMIT ?",
+                (last, batch_size),
+            ).fetchall()
+            if not rows:
+                return total
+
+            for id, sid, sender, recipient, received_at, body in rows:
+                fields = {
+                    "sid": sid,
+                    "sender": sender,
+                    "recipient": recipient,
+                    "body": body,
+                    "status": None,
+                }
+                thread_id = self.add_to_thread(connection, fields, received_at)
+                connection.execute(
+                    "UPDATE messages SET thread_id = ? WHERE id = ?",
+                    (thread_id, id),
+                )
+            total += len(rows)
+            last = rows[-1][0]
+
+    def row(self, key_name, key_value, fields: dict):
+        return (
+            fields["sid"],
+            fields["sender"],
+            fields["recipient"],
+            to_timestamp(key_value),
+            sanitize(key_name),
+            str(key_value),
+        )
+
+    def add_to_thread(
+        self, connection, fields: dict, received_at, thread_ids=None
+    ) -> int:
+        """counts a message in its thread in O(1), returns the id of
+        the thread. ``thread_ids`` caches them for a transaction."""
+        key = thread_key(fields["sender"], fields["recipient"])
+        incoming = fields["status"] in INCOMING_STATUSES
+        connection.execute(
+            UPSERT_THREAD,
+            key
+            + (
+                int(incoming),
+                fields["sid"],
+                fields["sender"],
+                fields["body"],
+                received_at,
+            ),
+        )
+        if thread_ids is not None and key in thread_ids:
+            return thread_ids[key]
+
+        id = connection.execute(
+            "SELECT id FROM threads "
+            "WHERE participant_a = ? AND participant_b = ?",
+            key,
+        ).fetchone()[0]
+        if thread_ids is not None:
+            thread_ids[key] = id
+        return id
+
+    def insert(self, connection, key_name, key_value, blob: dict) -> int:
+        return self.insert_fields(
+            connection, key_name, key_value, message_fields(blob)
+        )
+
+    def insert_fields(
+        self, connection, key_name, key_value, fields, thread_ids=None
+    ) -> int:
+        """indexes a message from its :py:func:`message_fields`"""
+        row = self.row(key_name, key_value, fields)
+        incoming = fields["status"] in INCOMING_STATUSES
+        replaced = connection.execute(FIND_REPLACED, row[-2:]).fetchone()
+        if replaced:
+            replaced_id, thread_id, received_at = replaced
+            connection.execute(FORGET_BODY, (replaced_id,))
+            connection.execute(
+                FORGET_IN_THREAD, (int(incoming), received_at, thread_id)
+            )
+
+        thread_id = self.add_to_thread(connection, fields, row[3], thread_ids)
+        id = connection.execute(INSERT, row + (thread_id,)).lastrowid
+        if fields["sid"]:
+            connection.execute(UNCLAIM, (fields["sid"],))
+        if fields["body"]:
+            connection.execute(INSERT_BODY, (id, str(fields["body"])))
+        return id
+
+    def add(self, key_name, key_value, blob: dict) -> int:
+        with self.connection as connection:
+            return self.insert(connection, key_name, key_value, blob)
+
+    def add_many(self, rows) -> int:
+        """inserts ``(key_name, key_value, blob)`` tuples in one
+        transaction"""
+        return self.add_fields(
+            (key_name, key_value, message_fields(blob))
+            for key_name, key_value, blob in rows
+        )
+
+    def add_fields(self, rows) -> int:
+        """inserts ``(key_name, key_value, fields)`` tuples, the fields
+        extracted beforehand with :py:func:`message_fields`, in one
+        transaction"""
+        total = 0
+        thread_ids = {}
+        with self.connection as connection:
+            for key_name, key_value, fields in rows:
+                self.insert_fields(
+                    connection, key_name, key_value, fields, thread_ids
+                )
+                total += 1
+        return total
+
+    def claim(self, sid: str, timeout: float = 60.0) -> bool:
+        """returns True when no other worker is storing a message with
+        this sid, which then can't be claimed until it is indexed,
+        :py:meth:`unclaim`-ed or ``timeout`` seconds passed"""
+        now = time.time()
+        with self.connection as connection:
+            claimed = connection.execute(CLAIM, (sid, now, now - timeout))
+            return claimed.rowcount == 1
+
+    def unclaim(self, sid: str):
+        with self.connection as connection:
+            connection.execute(UNCLAIM, (sid,))
+
+    def indexed(self, key_name, key_values: list) -> set:
+        """the given key values of ``key_name`` that are indexed"""
+        if not key_values:
+            return set()
+        found = self.connection.execute(
+            "SELECT key_value FROM messages WHERE key_name = ? AND "
+            f"key_value IN ({', '.join('?' * len(key_values))})",
+            [sanitize(key_name)] + [str(value) for value in key_values],
+        )
+        return {row[0] for row in found}
+
+    def query(self, where: str, params=(), limit: int = None):
+        sql = f"SELECT {COLUMNS} FROM messages WHERE {where}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        cursor = self.connection.execute(sql, params)
+        return [IndexEntry(*row) for row in cursor]
+
+    def by_sid(self, sid: str):
+        found = self.query("sid = ?", (sid,), limit=1)
+        return found[0] if found else None
+
+    def time_range(self, since=None, until=None):
+        since = float("-inf") if since is None else since
+        until = float("inf") if until is None else until
+        return "received_at >= ? AND received_at < ?", (since, until)
+
+    def by_sender(self, number: str, since=None, until=None, limit=None):
+        where, params = self.time_range(since, until)
+        return self.query(
+            f"sender = ? AND {where} ORDER BY received_at",
+            (number,) + params,
+            limit,
+        )
+
+    def by_recipient(self, number: str, since=None, until=None, limit=None):
+        where, params = self.time_range(since, until)
+        return self.query(
+            f"recipient = ? AND {where} ORDER BY received_at",
+            (number,) + params,
+            limit,
+        )
+
+    def between(self, since=None, until=None, limit=None):
+        where, params = self.time_range(since, until)
+        return self.query(f"{where} ORDER BY received_at", params, limit)
+
+    def page(
+        self,
+        sender=None,
+        recipient=None,
+        before=None,
+        limit=50,
+        thread_id=None,
+    ):
+        """returns up to ``limit`` entries, newest first, positioned
+        after the ``(received_at, id)`` of the last entry of the
+        previous page"""
+        clauses, params = [], []
+        if thread_id is not None:
+            clauses.append("thread_id = ?")
+            params.append(int(thread_id))
+        if sender:
+            clauses.append("sender = ?")
+            params.append(sender)
+        if recipient:
+            clauses.append("recipient = ?")
+            params.append(recipient)
+        if before:
+            received_at, id = before
+            clauses.append(
+                "(received_at < ? OR (received_at = ? AND id < ?))"
+            )
+            params.extend([received_at, received_at, id])
+
+        where = " AND ".join(clauses) or "1"
+        return self.query(
+            f"{where} ORDER BY received_at DESC, id DESC", params, limit
+        )
+
+    def after(self, id: int, sender=None, recipient=None, limit=1000):
+        """returns the newest ``limit`` entries added after the entry
+        ``id``, oldest first"""
+        clauses, params = ["id > ?"], [int(id)]
+        if sender:
+            clauses.append("sender = ?")
+            params.append(sender)
+        if recipient:
+            clauses.append("recipient = ?")
+            params.append(recipient)
+
+        where = " AND ".join(clauses)
+        found = self.query(f"{where} ORDER BY id DESC", params, limit)
+        found.reverse()
+        return found
+
+    def latest(self, sender=None, recipient=None):
+        found = self.page(sender, recipient, limit=1)
+        return found[0] if found else None
+
+    def search(
+        self, text: str, limit: int = 20, offset: int = 0, candidates=5000
+    ):
+        """returns the messages whose body contains every word of
+        ``text`` as :py:class:`SearchResult`, best match first.
+
+        Matches are ranked ``candidates`` at a time, newest first: the
+        best of the newest ``candidates`` matches come first, then the
+        best of the ones before, and so on. That keeps frequent words
+        as fast as rare ones no matter how many messages are indexed,
+        while every match can still be paged to.
+        """
+        expression = search_expression(text)
+        if not expression:
+            return []
+
+        columns = ", ".join(f"m.{c}" for c in COLUMNS.split(", "))
+        candidates, limit, offset = int(candidates), int(limit), int(offset)
+        rows = []
+        while len(rows) < limit:
+            window, position = divmod(offset, candidates)
+            found = self.connection.execute(
+                f"SELECT {columns} FROM ("
+                "  SELECT rowid, rank FROM bodies WHERE bodies MATCH ?"
+                "  ORDER BY rowid DESC LIMIT ? OFFSET ?"
+                ") AS found JOIN messages m ON m.id = found.rowid "
+                "ORDER BY found.rank, m.received_at DESC LIMIT ? OFFSET ?",
+                (
+                    expression,
+                    candidates,
+                    window * candidates,
+                    limit - len(rows),
+                    position,
+                ),
+            ).fetchall()
+            if not found and not position:
+                break
+            rows.extend(found)
+            # past the end of this window, go on with the next one
+            offset = (window + 1) * candidates
+            if len(rows) < limit and len(found) + position < candidates:
+                break
+        if not rows:
+            return []
+
+        # snippets are only built for the page being returned
+        ids = [row[0] for row in rows]
+        snippets = dict(
+            self.connection.execute(
+                "SELECT rowid, snippet(bodies, 0, '[', ']', '...', 12) "
+                "FROM bodies WHERE bodies MATCH ? AND rowid IN "
+                f"({', '.join('?' * len(ids))})",
+                [expression] + ids,
+            )
+        )
+        return [
+            SearchResult(IndexEntry(*row), snippets.get(row[0]))
+            for row in rows
+        ]
+
+    def threads(self, before=None, unread=False, limit=50):
+        """returns up to ``limit`` threads, most recently active first,
+        positioned after the ``(last_received_at, id)`` of the last
+        thread of the previous page"""
+        clauses, params = ["message_count > 0"], []
+        if unread:
+            clauses.append("unread_count > 0")
+        if before:
+            received_at, id = before
+            clauses.append(
+                "(last_received_at < ? OR (last_received_at = ? AND id < ?))"
+            )
+            params.extend([received_at, received_at, id])
+
+        cursor = self.connection.execute(
+            f"SELECT {THREAD_COLUMNS} FROM threads "
+            f"WHERE {' AND '.join(clauses)} "
+            f"ORDER BY last_received_at DESC, id DESC LIMIT {int(limit)}",
+            params,
+        )
+        return [Thread(*row) for row in cursor]
+
+    def thread(self, id: int):
+        row = self.connection.execute(
+            f"SELECT {THREAD_COLUMNS} FROM threads "
+            "WHERE id = ? AND message_count > 0",
+            (int(id),),
+        ).fetchone()
+        return Thread(*row) if row else None
+
+    def mark_read(self, id: int):
+        """marks every message of the thread stored so far as read"""
+        with self.connection as connection:
+            connection.execute(
+                "UPDATE threads SET unread_count = 0, "
+                "read_until = coalesce(last_received_at, read_until) "
+                "WHERE id = ?",
+                (int(id),),
+            )
+        return self.thread(id)
+
+    def forget(self, key_name, since: float, until: float) -> int:
+        """removes the messages of ``key_name`` received in ``[since,
+        until)`` and takes them out of their threads. Returns how many
+        were removed."""
+        where = "key_name = ? AND received_at >= ? AND received_at < ?"
+        params = (sanitize(key_name), since, until)
+        with self.connection as connection:
+            # the index doesn't keep the status of messages, so the
+            # unread count only loses the ones after read_until
+            connection.execute(
+                "UPDATE threads SET "
+                "message_count = message_count - ("
+                f"  SELECT COUNT(*) FROM messages WHERE {where}"
+                "   AND thread_id = threads.id), "
+                "unread_count = max(unread_count - ("
+                f"  SELECT COUNT(*) FROM messages WHERE {where}"
+                "   AND thread_id = threads.id"
+                "   AND received_at > threads.read_until), 0) "
+                "WHERE id IN ("
+                f"  SELECT DISTINCT thread_id FROM messages WHERE {where})",
+                params * 3,
+            )
+            connection.execute(
+                "UPDATE threads SET unread_count = 0, "
+                + ", ".join(f"{column} = NULL" for column in SUMMARY)
+                + " WHERE message_count <= 0"
+            )
+            connection.execute(
+                "DELETE FROM bodies WHERE rowid IN ("
+                f"SELECT id FROM messages WHERE {where})",
+                params,
+            )
+            return connection.execute(
+                f"DELETE FROM messages WHERE {where}", params
+            ).rowcount
+
+    def count(self) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM messages"
+        ).fetchone()[0]
+
+    def clear(self):
+        with self.connection as connection:
+            connection.execute("DELETE FROM messages")
+            connection.execute("DELETE FROM bodies")
+            # threads keep their id and what was read, so that a
+            # rebuild doesn't mark everything unread again
+            connection.execute(
+                "UPDATE threads SET message_count = 0, unread_count = 0, "
+                + ", ".join(f"{column} = NULL" for column in SUMMARY)
+            )
+
+    def rebuild(self, storage, batch_size: int = 1000) -> int:
+        """drops every entry and indexes everything in ``storage`` again"""
+        self.clear()
+        total = 0
+        batch = []
+        for key_name in storage.keys():
+            for key_value, blob in storage.scan(key_name):
+                batch.append((key_name, key_value, blob))
+                if len(batch) >= batch_size:
+                    total += self.add_many(batch)
+                    batch = []
+
+        if batch:
+            total += self.add_many(batch)
+
+        logger.info(f"indexed {total} messages into {self.path}")
+        return total
+
+
+_indexes = {}
+
+
+def default_index() -> MessageIndex:
+    path = Path(SMS_INDEX_PATH).joinpath("messages.db")
+    index = _indexes.get(path)
+    if index is None:
+        index = _indexes.setdefault(path, MessageIndex(path))
+    return index
@@ -0,0 +1,137 @@
+import time
+import json
+import logging
+
+from shortage.config import SMS_DEDUP
+from shortage.filesystem import default_storage
+from shortage.indexes import IndexEntry, default_index
+from shortage.dedup import default_deduplicator
+from shortage.records import MessageRecord
+from shortage.events import default_broadcaster
+from shortage.metrics import MESSAGES_STORED, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+REQUIRED_FIELDS = ("body", "sender", "recipient")
+
+
+def serialize_request(
+    method: str,
+    url: str,
+    body: bytes,
+    form: dict,
+    args: dict,
+) -> MessageRecord:
+    """builds the record stored for a webhook request, independently
+    of the web framework that received it"""
+
+    # twilio posts form fields, json bodies are kept for the clients
+    # that post the same fields as json
+    if body and not form:
+        try:
+            values = json.loads(body.decode("utf-8"))
+        except Exception as e:
+            values = {"raw": body.decode("utf-8", "replace")}
+            logger.warning(f"failed to parse json from bytes: {body!r}: {e}")
+        if not isinstance(values, dict):
+            values = {"raw": values}
+    elif args:
+        values = dict(args)
+        values.update(form)
+    else:
+        values = form
+
+    return MessageRecord.from_values(values, method=method, url=url)
+
+
+def store_message(message: MessageRecord, deduplicate: bool = True):
+    """stores and indexes a webhook request.
+
+    Returns where the message was stored, or None when it is a retry
+    of a message that was already stored.
+    """
+    for attribute in REQUIRED_FIELDS:
+        if not getattr(message, attribute):
+            logger.error(f"missing required field {attribute}: {message!r}")
+
+    storage = default_storage()
+    logger.debug(f"storing SMS request")
+    timestamp = str(time.time())
+
+    # twilio retries a webhook with the same sid when we are slow to
+    # answer, status callbacks however reuse the sid of their message
+    sid = message.sid
+    deduplicator = None
+    if deduplicate and sid and SMS_DEDUP:
+        deduplicator = default_deduplicator()
+        if not deduplicator.claim(sid):
+            logger.info(f"ignoring duplicate of {sid}")
+            return None
+
+    key = message.recipient or "webhook"
+    blob = message.to_blob()
+    try:
+        with STAGE_SECONDS.labels("store").time():
+            path = storage.add(key, timestamp, blob)
+            id = default_index().add(key, timestamp, blob)
+    except Exception:
+        if deduplicator:
+            deduplicator.release(sid)
+        raise
+
+    MESSAGES_STORED.inc()
+    entry = IndexEntry(
+        id,
+        sid,
+        message.sender,
+        message.recipient,
+        float(timestamp),
+        key,
+        timestamp,
+    )
+    default_broadcaster().publish(entry, message)
+    return path
+
+
+def notification_for(message: MessageRecord) -> dict:
+    return {"body": message.body, "title": f"{message.recipient} SMS"}
+
+
+# what twilio.twiml.messaging_response.MessagingResponse() renders,
+# spelled out so that webhooks don't import the twilio library
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response />'
+
+
+def empty_twiml() -> str:
+    return EMPTY_TWIML
+
+
+# pync only exists on macOS, it is looked up once, on the first
+# desktop notification
+pync = False
+
+
+def load_pync():
+    global pync
+    if pync is False:
+        try:
+            import pync as module
+        except Exception:
+            module = None
+        pync = module
+    return pync
+
+
+def show_desktop_notification(body, title):
+    notifier = load_pync()
+    if not notifier:
+        logger.info(f"{title} - {body}")
+        return
+
+    try:
+        notifier.notify(body, title=title)
+    except Exception as err:
+        logger.debug(
+            f'failed to show notification "{body}" (title={title}) - {err}'
+        )
@@ -0,0 +1,436 @@
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import logging
+import threading
+import weakref
+from bisect import bisect_left
+from pathlib import Path
+
+from shortage.config import SMS_METRICS, SMS_METRICS_PATH
+
+logger = logging.getLogger(__name__)
+
+
+# every process adds to its own file of float64 values, laid out by
+# the order metrics are declared in, which is the same in every
+# process. /metrics sums the files of all the processes.
+MAGIC = b"SHMETRC1"
+header = struct.Struct(">8sIi")
+
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+def process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# registries whose values are dropped in the child after fork()
+registries = weakref.WeakSet()
+
+
+def forget_registries():
+    for registry in list(registries):
+        registry.forget()
+
+
+os.register_at_fork(after_in_child=forget_registries)
+
+
+class Registry(object):
+    """the metrics of the application and the file holding the values
+    of the current process.
+
+    Writes only take an uncontended lock of the current process. The
+    file is opened on first use, and again after ``fork()``: the
+    values are dropped in the child by an at-fork hook, which spares
+    the hot path a ``getpid()`` per write.
+    """
+
+    def __init__(self, path=None, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.metrics = []
+        self.size = 0
+        self.lock = threading.Lock()
+        self.pid = None
+        self.values = None
+        self.mapped = None
+        registries.add(self)
+
+    def allocate(self, metric, slots: int) -> int:
+        if self.values is not None:
+            raise RuntimeError("metrics must be declared before use")
+        offset = self.size
+        self.size += slots
+        self.metrics.append(metric)
+        return offset
+
+    @property
+    def layout(self) -> int:
+        names = ";".join(f"{m.name}:{m.slots}" for m in self.metrics)
+        return zlib.crc32(names.encode("utf-8"))
+
+    @property
+    def directory(self) -> Path:
+        return Path(self.path).expanduser()
+
+    def file_for(self, pid: int) -> Path:
+        return self.directory.joinpath(f"{pid}.metrics")
+
+    def forget(self):
+        # the lock may have been held by another thread at fork()
+        self.lock = threading.Lock()
+        self.pid = self.values = self.mapped = None
+
+    def open(self):
+        """the values of the current process, created on first use"""
+        pid = os.getpid()
+        if self.pid != pid:
+            self.forget()
+            self.pid = pid
+
+        with self.lock:
+            if self.values is not None:
+                return self.values
+
+            if not (self.enabled and self.path):
+                self.values = memoryview(bytearray(8 * self.size)).cast("d")
+                return self.values
+
+            self.directory.mkdir(parents=True, exist_ok=True)
+            size = header.size + 8 * self.size
+            fd = os.open(self.file_for(pid), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                self.mapped = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+            self.mapped[: header.size] = header.pack(MAGIC, self.layout, pid)
+            self.values = memoryview(self.mapped)[header.size:].cast("d")
+            return self.values
+
+    def reset(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                if self.values is not None:
+                    self.values.release()
+                if self.mapped is not None:
+                    self.mapped.close()
+        self.forget()
+
+    def add(self, slot: int, amount: float):
+        values = self.values
+        if values is None:
+            values = self.open()
+        with self.lock:
+            values[slot] += amount
+
+    def set(self, slot: int, value: float):
+        values = self.values
+        if values is None:
+            values = self.open()
+        values[slot] = value
+
+    def read(self, path: Path):
+        """returns ``(pid, values)`` of a metrics file, or None when it
+        was written with another layout"""
+        raw = path.read_bytes()
+        if len(raw) != header.size + 8 * self.size:
+            return None
+        magic, layout, pid = header.unpack_from(raw)
+        if magic != MAGIC or layout != self.layout:
+            return None
+        return pid, memoryview(raw[header.size:]).cast("d")
+
+    def fold_dead_processes(self, found: dict):
+        """adds the counters of exited processes to ``0.metrics``, so
+        that files don't pile up as workers are recycled. ``found``
+        maps every file to its ``(pid, values)``"""
+        archive_path = self.file_for(0)
+        archived = found.pop(archive_path, None)
+        totals = list(archived[1]) if archived else [0.0] * self.size
+        dead = []
+        for path, (pid, values) in found.items():
+            if process_alive(pid):
+                continue
+            for index, value in enumerate(values):
+                totals[index] += value
+            dead.append(path)
+
+        if dead:
+            for metric in self.metrics:
+                if metric.kind == "gauge":
+                    for slot in range(metric.offset, metric.end):
+                        totals[slot] = 0.0
+
+            temp = archive_path.with_suffix(".tmp")
+            temp.write_bytes(
+                header.pack(MAGIC, self.layout, 0)
+                + struct.pack(f"={self.size}d", *totals)
+            )
+            os.replace(temp, archive_path)
+            for path in dead:
+                path.unlink()
+                del found[path]
+
+        found[archive_path] = (0, totals)
+
+    def collect(self) -> list:
+        """sums the values of every process"""
+        if self.values is None:
+            self.open()
+        if not (self.enabled and self.path):
+            return list(self.values)
+
+        with open(self.directory.joinpath(".lock"), "a") as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            found = {}
+            for path in self.directory.glob("*.metrics"):
+                values = self.read(path)
+                if values is not None:
+                    found[path] = values
+                elif path.stem.isdigit() and not process_alive(
+                    int(path.stem)
+                ):
+                    # written by a version with other metrics
+                    path.unlink()
+
+            self.fold_dead_processes(found)
+
+        totals = [0.0] * self.size
+        for _, values in found.values():
+            for index, value in enumerate(values):
+                totals[index] += value
+        return totals
+
+    def expose(self) -> str:
+        """the values of every metric in the prometheus text format"""
+        totals = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(totals))
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value: float) -> str:
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Slot(object):
+    __slots__ = ("registry", "slot")
+
+    def __init__(self, registry: Registry, slot: int):
+        self.registry = registry
+        self.slot = slot
+
+    def inc(self, amount: float = 1):
+        self.registry.add(self.slot, amount)
+
+    def set(self, value: float):
+        self.registry.set(self.slot, value)
+
+
+class Metric(object):
+    kind = None
+    width = 1
+
+    def __init__(
+        self,
+        registry: Registry,
+        name: str,
+        documentation: str,
+        label: str = None,
+        values=(),
+    ):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.label_values = tuple(values) if label else (None,)
+        self.slots = self.width * len(self.label_values)
+        self.offset = registry.allocate(self, self.slots)
+        self.end = self.offset + self.slots
+        self.children = {
+            value: self.child(self.offset + index * self.width)
+            for index, value in enumerate(self.label_values)
+        }
+
+    def child(self, offset: int):
+        return Slot(self.registry, offset)
+
+    def labels(self, value: str):
+        return self.children[value]
+
+    def labels_of(self, value) -> dict:
+        return {self.label: value} if self.label else {}
+
+    def samples(self, totals: list):
+        for value, child in self.children.items():
+            labels = format_labels(self.labels_of(value))
+            yield f"{self.name}{labels} {format_value(totals[child.slot])}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1):
+        self.children[None].inc(amount)
+
+
+class Gauge(Counter):
+    """summed over the running processes"""
+
+    kind = "gauge"
+
+    def set(self, value: float):
+        self.children[None].set(value)
+
+
+class Timer(object):
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Buckets(object):
+    """one counter per bucket, the last one being ``+Inf``, followed by
+    the sum of the observed values"""
+
+    __slots__ = ("registry", "slot", "bounds")
+
+    def __init__(self, registry: Registry, slot: int, bounds: tuple):
+        self.registry = registry
+        self.slot = slot
+        self.bounds = bounds
+
+    def observe(self, value: float):
+        registry = self.registry
+        values = registry.values
+        if values is None:
+            values = registry.open()
+        bucket = self.slot + bisect_left(self.bounds, value)
+        with registry.lock:
+            values[bucket] += 1
+            values[self.slot + len(self.bounds) + 1] += value
+
+    def time(self) -> Timer:
+        return Timer(self)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kw):
+        self.bounds = tuple(sorted(map(float, buckets)))
+        self.width = len(self.bounds) + 2
+        super().__init__(*args, **kw)
+
+    def child(self, offset: int):
+        return Buckets(self.registry, offset, self.bounds)
+
+    def observe(self, value: float):
+        self.children[None].observe(value)
+
+    def time(self) -> Timer:
+        return Timer(self.children[None])
+
+    def samples(self, totals: list):
+        for value, child in self.children.items():
+            labels = self.labels_of(value)
+            cumulative = 0.0
+            bounds = self.bounds + (float("inf"),)
+            for index, bound in enumerate(bounds):
+                cumulative += totals[child.slot + index]
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket = format_labels(dict(labels, le=le))
+                yield f"{self.name}_bucket{bucket} {format_value(cumulative)}"
+
+            total = totals[child.slot + len(bounds)]
+            labels = format_labels(labels)
+            yield f"{self.name}_sum{labels} {format_value(total)}"
+            yield f"{self.name}_count{labels} {format_value(cumulative)}"
+
+
+registry = Registry(SMS_METRICS_PATH, enabled=SMS_METRICS)
+
+STAGE_SECONDS = Histogram(
+    registry,
+    "shortage_stage_seconds",
+    "Time spent handling webhooks, by stage.",
+    label="stage",
+    values=("validate", "parse", "store", "notify"),
+)
+MESSAGES_STORED = Counter(
+    registry, "shortage_messages_stored_total", "Messages stored."
+)
+BYTES_WRITTEN = Counter(
+    registry,
+    "shortage_bytes_written_total",
+    "Bytes of encoded blobs handed to the storage.",
+)
+NOTIFICATIONS = Counter(
+    registry,
+    "shortage_notifications_total",
+    "Notifications delivered, failed or given up on.",
+    label="result",
+    values=("sent", "failed", "dead"),
+)
+SIGNATURES = Counter(
+    registry,
+    "shortage_signatures_total",
+    "Twilio signatures checked, by outcome.",
+    label="result",
+    values=("accepted", "unsigned", "invalid"),
+)
+QUEUE_DEPTH = Gauge(
+    registry,
+    "shortage_queue_depth",
+    "Items waiting in the in-memory queues.",
+    label="queue",
+    values=("notifications", "group_commit"),
+)
+STREAMS = Gauge(
+    registry, "shortage_streams", "Open GET /sms/stream connections."
+)
+STREAMS_DROPPED = Counter(
+    registry,
+    "shortage_streams_dropped_total",
+    "Event streams disconnected for falling behind.",
+)
@@ -1,42 +1,204 @@
 # -*- coding: utf-8 -*-
-import json
+import os
+import time
 import logging
+import threading
 import requests
 
+from collections import deque
 from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
 
 
 logger = logging.getLogger(__name__)
 
 
+class PushOverError(Exception):
+    """raised when a notification could not be delivered"""
+
+
+class PushOverRateLimited(PushOverError):
+    def __init__(self, reset_at: float):
+        self.reset_at = reset_at
+        super().__init__(
+            f"pushover app limit exhausted until {time.ctime(reset_at)}"
+        )
+
+
+class LatencyStats(object):
+    """keeps a count of calls and a window of the most recent latencies"""
+
+    def __init__(self, window: int = 1024):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float, error: bool = False):
+        with self.lock:
+            self.calls += 1
+            self.errors += int(error)
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.samples.append(seconds)
+
+    def percentile(self, samples, fraction: float) -> float:
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            samples = sorted(self.samples)
+            calls, errors, total, maximum = (
+                self.calls,
+                self.errors,
+                self.total,
+                self.max,
+            )
+
+        return {
+            "calls": calls,
+            "errors": errors,
+            "mean": total / calls if calls else 0.0,
+            "p50": self.percentile(samples, 0.50),
+            "p95": self.percentile(samples, 0.95),
+            "p99": self.percentile(samples, 0.99),
+            "max": maximum,
+        }
+
+
 class PushOverClient(object):
-    def __init__(self, token: str, user_key: str):
+    def __init__(
+        self,
+        token: str,
+        user_key: str,
+        base_url: str = "https://api.pushover.net/",
+        pool_size: int = 4,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: float = 10.0,
+    ):
         self.token = token
         self.user_key = user_key
-        self.base_url = f"https://api.pushover.net/"
+        self.base_url = base_url
+        self.pool_size = int(pool_size)
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.timeout = float(timeout)
+        self.sleep = time.sleep
+
+        self.limit_remaining = None
+        self.limit_reset = None
+        self.stats = LatencyStats()
+        self.http = self.create_session()
 
-        self.http = requests.Session()
-        self.http.headers.update({
+    def create_session(self):
+        http = requests.Session()
+        http.headers.update({
             'Content-Type': 'application/json'
         })
+        # retries are handled by send_notification() so they can
+        # take the rate-limit headers into account
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+        )
+        http.mount("https://", adapter)
+        http.mount("http://", adapter)
+        return http
 
     def url(self, path):
         return urljoin(self.base_url, path)
 
+    @property
+    def is_configured(self):
+        return bool(self.token and self.user_key)
+
+    def check_rate_limit(self):
+        if self.limit_remaining is None or self.limit_remaining > 0:
+            return
+        if self.limit_reset and time.time() < self.limit_reset:
+            raise PushOverRateLimited(self.limit_reset)
+
+    def update_rate_limit(self, headers):
+        remaining = headers.get("X-Limit-App-Remaining")
+        reset = headers.get("X-Limit-App-Reset")
+        if remaining is not None:
+            self.limit_remaining = int(remaining)
+        if reset is not None:
+            self.limit_reset = float(reset)
+
+    def backoff(self, attempt: int):
+        self.sleep(self.backoff_factor * (2 ** attempt))
+
     def send_notification(self, body: str, title: str):
-        data = json.dumps({
+        if not self.is_configured:
+            logger.info(f"pushover is not configured, skipping: {title}")
+            return
+
+        self.check_rate_limit()
+        data = {
             "token": self.token,
             "user": self.user_key,
             "message": body,
             "title": title,
-        }, indent=2)
+        }
         url = self.url("/1/messages.json")
-        logger.info(f"Calling pushover API\nPOST {url!r}\n{data}")
-        try:
-            response = self.http.post(url, data=data)
-        except Exception as e:
-            logger.exception(f"failed to POST to {url!r}: {e}")
-            return
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.backoff(attempt - 1)
+
+            started = time.perf_counter()
+            try:
+                response = self.http.post(url, json=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.stats.record(time.perf_counter() - started, error=True)
+                logger.warning(f"failed to POST to {url!r}: {e}")
+                continue
+
+            failed = response.status_code >= 500
+            self.stats.record(time.perf_counter() - started, error=failed)
+            self.update_rate_limit(response.headers)
+            logger.info(f"POST {url!r}: {response}")
+
+            if response.status_code == 429:
+                raise PushOverRateLimited(self.limit_reset or time.time())
+            if failed:
+                continue
+            if response.status_code >= 400:
+                # the request itself is wrong, retrying will not help
+                logger.error(f"pushover rejected {title!r}: {response.text}")
+            return response
+
+        raise PushOverError(
+            f"failed to POST to {url!r} after {attempt + 1} attempts"
+        )
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_pushover_client(token: str, user_key: str, **kw) -> PushOverClient:
+    """returns a process-wide client so that connections are kept
+    alive between notifications.
+
+    Connection pools cannot be shared across ``fork()``, so each
+    process builds its own client the first time it needs one.
+    """
+    key = (os.getpid(), token, user_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        pid = os.getpid()
+        for stale in [k for k in _clients if k[0] != pid]:
+            del _clients[stale]
+
+        if key not in _clients:
+            _clients[key] = PushOverClient(token, user_key, **kw)
 
-        logger.info(f"POST {url!r}: {response}")
-        logger.info(f"response: {response.text}")
+        return _clients[key]
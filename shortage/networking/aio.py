@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+import logging
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from shortage.networking import (
+    PushOverClient,
+    PushOverError,
+    PushOverRateLimited,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPushOverClient(PushOverClient):
+    """:py:class:`PushOverClient` on top of aiohttp, for the asyncio
+    server. The session is created lazily inside the running loop."""
+
+    def __init__(self, *args, **kw):
+        if aiohttp is None:
+            raise RuntimeError("the async server requires shortage-app[async]")
+        super().__init__(*args, **kw)
+        self.sleep = asyncio.sleep
+
+    def create_session(self):
+        return None
+
+    @property
+    def session(self):
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.http
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+
+    async def backoff(self, attempt: int):
+        await self.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def send_notification(self, body: str, title: str):
+        if not self.is_configured:
+            logger.info(f"pushover is not configured, skipping: {title}")
+            return
+
+        self.check_rate_limit()
+        data = {
+            "token": self.token,
+            "user": self.user_key,
+            "message": body,
+            "title": title,
+        }
+        url = self.url("/1/messages.json")
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await self.backoff(attempt - 1)
+
+            started = time.perf_counter()
+            try:
+                async with self.session.post(url, json=data) as response:
+                    status = response.status
+                    text = await response.text()
+                    headers = response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.stats.record(time.perf_counter() - started, error=True)
+                logger.warning(f"failed to POST to {url!r}: {e}")
+                continue
+
+            failed = status >= 500
+            self.stats.record(time.perf_counter() - started, error=failed)
+            self.update_rate_limit(headers)
+            logger.info(f"POST {url!r}: {status}")
+
+            if status == 429:
+                raise PushOverRateLimited(self.limit_reset or time.time())
+            if failed:
+                continue
+            if status >= 400:
+                # the request itself is wrong, retrying will not help
+                logger.error(f"pushover rejected {title!r}: {text}")
+            return status
+
+        raise PushOverError(
+            f"failed to POST to {url!r} after {attempt + 1} attempts"
+        )
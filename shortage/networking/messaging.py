@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+import requests
+
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+
+from shortage.networking import LatencyStats
+
+
+logger = logging.getLogger(__name__)
+
+
+class TwilioError(Exception):
+    """raised when twilio did not accept a message"""
+
+    def __init__(self, message: str, status: int = None):
+        self.status = status
+        super().__init__(message)
+
+
+class TwilioUnknownOutcome(TwilioError):
+    """raised when the request may have reached twilio but no answer
+    says whether the message was accepted: sending it again could
+    deliver it twice"""
+
+
+def never_sent(error: requests.RequestException) -> bool:
+    """whether the request provably never reached twilio, which only
+    holds when the connection could not be established"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        # "connection aborted" happens after the request was written
+        reason = error.args[0] if error.args else None
+        return not isinstance(reason, ProtocolError)
+    return False
+
+
+class TwilioMessagesClient(object):
+    """sends SMS through the twilio REST API with a pooled session
+    that can be shared by many threads"""
+
+    def __init__(
+        self,
+        account_sid: str,
+        auth_token: str,
+        base_url: str = "https://api.twilio.com/",
+        pool_size: int = 8,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: float = 10.0,
+    ):
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.base_url = base_url
+        self.pool_size = int(pool_size)
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.timeout = float(timeout)
+        self.sleep = time.sleep
+
+        self.stats = LatencyStats()
+        self.http = self.create_session()
+
+    def create_session(self):
+        http = requests.Session()
+        http.auth = (self.account_sid, self.auth_token)
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+        )
+        http.mount("https://", adapter)
+        http.mount("http://", adapter)
+        return http
+
+    @property
+    def messages_url(self):
+        return urljoin(
+            self.base_url,
+            f"/2010-04-01/Accounts/{self.account_sid}/Messages.json",
+        )
+
+    def backoff(self, attempt: int, retry_after: str = None):
+        try:
+            seconds = float(retry_after)
+        except (TypeError, ValueError):
+            seconds = self.backoff_factor * (2 ** attempt)
+        self.sleep(seconds)
+
+    def send(self, to: str, body: str, from_: str, bucket=None) -> str:
+        """sends one message and returns its sid.
+
+        Only connection failures and 429 responses are retried, twilio
+        did not queue the message then. Read timeouts and 5xx raise
+        :py:class:`TwilioUnknownOutcome`, other errors
+        :py:class:`TwilioError`. A token is taken from ``bucket``
+        before every attempt.
+        """
+        data = {"To": to, "From": from_, "Body": body}
+        url = self.messages_url
+        retry_after = None
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.backoff(attempt - 1, retry_after)
+            if bucket is not None:
+                bucket.acquire()
+
+            started = time.perf_counter()
+            try:
+                response = self.http.post(url, data=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.stats.record(time.perf_counter() - started, error=True)
+                if not never_sent(e):
+                    raise TwilioUnknownOutcome(
+                        f"no answer to the message to {to}: {e}"
+                    )
+                logger.warning(f"failed to POST to {url!r}: {e}")
+                error = TwilioError(str(e))
+                retry_after = None
+                continue
+
+            status = response.status_code
+            failed = status >= 400
+            self.stats.record(time.perf_counter() - started, error=failed)
+            if not failed:
+                return response.json().get("sid")
+
+            message = f"twilio answered {status} to {to}: {response.text}"
+            if status == 429:
+                error = TwilioError(message, status)
+                retry_after = response.headers.get("Retry-After")
+                continue
+            if status >= 500:
+                raise TwilioUnknownOutcome(message, status)
+
+            # the message itself is wrong, retrying will not help
+            raise TwilioError(message, status)
+
+        raise error
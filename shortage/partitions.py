@@ -0,0 +1,371 @@
+import os
+import zlib
+import errno
+import shutil
+import struct
+import bisect
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from shortage.filesystem import (
+    sanitize,
+    sort_key,
+    write_all,
+    ensure_path_exists_as_directory,
+)
+from shortage.serialization import Codecs
+
+logger = logging.getLogger(__name__)
+
+
+# partition of the key values that aren't timestamps
+UNDATED = "undated"
+
+
+def partition_of(key_value) -> str:
+    """returns the UTC day, as ``YYYY-MM-DD``, of a timestamp key"""
+    try:
+        moment = datetime.fromtimestamp(float(key_value), timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return UNDATED
+    return moment.strftime("%Y-%m-%d")
+
+
+def partition_range(partition: str) -> tuple:
+    """the ``[since, until)`` timestamps of the keys of a partition"""
+    day = datetime.strptime(partition, "%Y-%m-%d")
+    since = day.replace(tzinfo=timezone.utc).timestamp()
+    return since, since + 24 * 60 * 60
+
+
+class Archive(object):
+    """a compacted partition: every record compressed on its own,
+    followed by an offset table sorted by key value and a footer.
+
+    ``record* | table | table offset | count | MAGIC``, where each
+    table entry is ``offset | length | key length | key``. Reading a
+    single record costs one read of the table and one seek.
+    """
+
+    MAGIC = b"SHARC1"
+    footer = struct.Struct(">QI6s")
+    entry = struct.Struct(">QIH")
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def __eq__(self, other):
+        return isinstance(other, Archive) and self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @classmethod
+    def write(cls, path: Path, records, level: int = 6):
+        """writes ``(key_value, blob)`` records to ``path`` atomically"""
+        records = sorted(records, key=lambda record: sort_key(record[0]))
+        table = bytearray()
+        partial = path.with_name(f"{path.name}.tmp")
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            offset = 0
+            for key_value, blob in records:
+                compressed = zlib.compress(blob, level)
+                write_all(fd, compressed)
+                key = key_value.encode("utf-8")
+                table += cls.entry.pack(offset, len(compressed), len(key))
+                table += key
+                offset += len(compressed)
+
+            write_all(fd, bytes(table))
+            write_all(fd, cls.footer.pack(offset, len(records), cls.MAGIC))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(partial, path)
+        return cls(path)
+
+    def read_table(self, fd):
+        fd.seek(-self.footer.size, os.SEEK_END)
+        end = fd.tell()
+        table_offset, count, magic = self.footer.unpack(
+            fd.read(self.footer.size)
+        )
+        if magic != self.MAGIC:
+            raise IOError(f"{self.path} is not an archive")
+
+        fd.seek(table_offset)
+        raw = fd.read(end - table_offset)
+        keys, positions = [], []
+        position = 0
+        for _ in range(count):
+            offset, length, key_length = self.entry.unpack_from(raw, position)
+            position += self.entry.size
+            keys.append(raw[position: position + key_length].decode("utf-8"))
+            positions.append((offset, length))
+            position += key_length
+
+        return keys, positions
+
+    def get(self, key_value: str):
+        """returns the blob of ``key_value`` or None"""
+        with self.path.open("rb") as fd:
+            keys, sort_keys, positions = tables.get(self, fd)
+            index = bisect.bisect_left(sort_keys, sort_key(key_value))
+            if index == len(keys) or keys[index] != key_value:
+                return None
+
+            offset, length = positions[index]
+            fd.seek(offset)
+            return zlib.decompress(fd.read(length))
+
+    def records(self):
+        """yields ``(key_value, blob)`` in key order"""
+        with self.path.open("rb") as fd:
+            keys, positions = self.read_table(fd)
+            for key, (offset, length) in zip(keys, positions):
+                fd.seek(offset)
+                yield key, zlib.decompress(fd.read(length))
+
+
+class TableCache(object):
+    """the parsed offset tables of the last ``capacity`` archives read.
+
+    Tables are read from the fd the caller is about to seek in, and
+    cached by the identity of that file: an archive replaced by
+    ``compact()`` meanwhile is a new entry, never the old one's.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = int(capacity)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, archive: Archive, fd):
+        info = os.fstat(fd.fileno())
+        identity = (info.st_dev, info.st_ino, info.st_mtime_ns, info.st_size)
+        with self.lock:
+            table = self.entries.get(identity)
+            if table is not None:
+                self.entries.move_to_end(identity)
+                return table
+
+        keys, positions = archive.read_table(fd)
+        table = (keys, [sort_key(key) for key in keys], positions)
+        with self.lock:
+            self.entries[identity] = table
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return table
+
+
+tables = TableCache()
+
+
+class PartitionedStorage(object):
+    """stores the blobs of each key in one directory per UTC day.
+
+    ``<key>/<YYYY-MM-DD>/<key_value>.<ext>`` is written to while the
+    day is open, :py:meth:`compact` rolls closed days into a single
+    ``<key>/<YYYY-MM-DD>.archive`` and :py:meth:`expire` enforces
+    retention by dropping whole partitions.
+    """
+
+    extensions = (".json", ".blob")
+    archive_extension = ".archive"
+    write_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+
+    def __init__(self, base_path: [Path, str], codecs: Codecs = None):
+        self.base_path = Path(base_path)
+        self.codecs = codecs or Codecs()
+        self.known = set()
+        self.lock = threading.Lock()
+
+    def path_to_partition(self, key_name, partition: str) -> Path:
+        path = self.base_path.joinpath(sanitize(key_name), partition)
+        if path not in self.known:
+            ensure_path_exists_as_directory(path)
+            with self.lock:
+                self.known.add(path)
+        return path
+
+    def archive_path(self, key_path: Path, partition: str) -> Path:
+        return key_path.joinpath(f"{partition}{self.archive_extension}")
+
+    def add(self, key_name, key_value, data):
+        partition = partition_of(key_value)
+        partition_path = self.path_to_partition(key_name, partition)
+        blob_path = partition_path.joinpath(
+            f"{key_value}.{self.codecs.extension}"
+        )
+        try:
+            fd = os.open(blob_path, self.write_flags, 0o666)
+        except FileNotFoundError:
+            # another process compacted or expired the partition
+            with self.lock:
+                self.known.discard(partition_path)
+            self.path_to_partition(key_name, partition)
+            fd = os.open(blob_path, self.write_flags, 0o666)
+        try:
+            write_all(fd, self.codecs.dump(data))
+        finally:
+            os.close(fd)
+
+        logger.info(f"wrote blob: {blob_path}")
+        return blob_path
+
+    def keys(self):
+        return sorted(
+            entry.name
+            for entry in os.scandir(self.base_path)
+            if entry.is_dir() and not entry.name.startswith(".")
+        )
+
+    def partitions(self, key_path: Path):
+        """returns the sorted partition names of a key, compacted or
+        not"""
+        if not key_path.is_dir():
+            return []
+
+        names = set()
+        for entry in os.scandir(key_path):
+            if entry.name.endswith(self.archive_extension):
+                names.add(entry.name[: -len(self.archive_extension)])
+            elif entry.is_dir():
+                names.add(entry.name)
+        return sorted(names)
+
+    def open_records(self, partition_path: Path, read=None):
+        """yields ``(key_value, blob)`` of the loose files of a
+        partition, adding their paths to the ``read`` list if given"""
+        if not partition_path.is_dir():
+            return
+
+        for entry in os.scandir(partition_path):
+            if entry.name.endswith(self.extensions):
+                with open(entry.path, "rb") as fd:
+                    yield entry.name.rsplit(".", 1)[0], fd.read()
+                if read is not None:
+                    read.append(entry.path)
+
+    def records(self, key_path: Path, partition: str, read=None):
+        archive = self.archive_path(key_path, partition)
+        merged = {}
+        if archive.exists():
+            merged.update(Archive(archive).records())
+        merged.update(self.open_records(key_path.joinpath(partition), read))
+        return sorted(merged.items(), key=lambda record: sort_key(record[0]))
+
+    def scan(self, key_name):
+        """yields ``(key_value, data)`` for every blob of the given
+        key, oldest partition first"""
+        key_path = self.base_path.joinpath(sanitize(key_name))
+        for partition in self.partitions(key_path):
+            for key_value, blob in self.records(key_path, partition):
+                yield key_value, self.codecs.load(blob)
+
+    def get(self, key_name, key_value):
+        key_value = str(key_value)
+        key_path = self.base_path.joinpath(sanitize(key_name))
+        partition = partition_of(key_value)
+        partition_path = key_path.joinpath(partition)
+        for extension in self.extensions:
+            try:
+                with partition_path.joinpath(
+                    f"{key_value}{extension}"
+                ).open("rb") as fd:
+                    return self.codecs.load(fd.read())
+            except FileNotFoundError:
+                continue
+
+        archive = self.archive_path(key_path, partition)
+        try:
+            blob = Archive(archive).get(key_value)
+        except FileNotFoundError:
+            return None
+        return None if blob is None else self.codecs.load(blob)
+
+    def closed_partitions(self, key_path: Path, now: datetime = None):
+        today = partition_of((now or datetime.now(timezone.utc)).timestamp())
+        return [
+            partition
+            for partition in self.partitions(key_path)
+            if partition < today and key_path.joinpath(partition).is_dir()
+        ]
+
+    def compact(self, now: datetime = None) -> int:
+        """rolls every closed partition that still has loose files
+        into its archive, merging with the existing archive if any.
+        Returns the number of partitions compacted."""
+        compacted = 0
+        for key_name in self.keys():
+            key_path = self.base_path.joinpath(key_name)
+            for partition in self.closed_partitions(key_path, now):
+                if partition == UNDATED:
+                    continue
+
+                archived = []
+                records = self.records(key_path, partition, archived)
+                Archive.write(self.archive_path(key_path, partition), records)
+                # the archive is durable before the loose files go away,
+                # and only those it holds: blobs written since stay
+                # loose until the next compaction
+                self.remove_archived(key_path.joinpath(partition), archived)
+                logger.info(
+                    f"compacted {len(records)} blobs of {key_name} "
+                    f"into {partition}{self.archive_extension}"
+                )
+                compacted += 1
+
+        return compacted
+
+    def remove_archived(self, partition_path: Path, archived: list):
+        for path in archived:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        try:
+            os.rmdir(partition_path)
+        except OSError as e:
+            if e.errno != errno.ENOTEMPTY:
+                raise
+            return
+
+        with self.lock:
+            self.known.discard(partition_path)
+
+    def expire(
+        self, retention_days: int, now: datetime = None, index=None
+    ) -> int:
+        """drops every partition older than ``retention_days``, one
+        unlink per compacted partition, and its messages from the
+        :py:class:`~shortage.indexes.MessageIndex` if given. Returns
+        the number dropped."""
+        now = now or datetime.now(timezone.utc)
+        cutoff = (now - timedelta(days=retention_days)).strftime("%Y-%m-%d")
+        dropped = 0
+        for key_name in self.keys():
+            key_path = self.base_path.joinpath(key_name)
+            for partition in self.partitions(key_path):
+                if partition == UNDATED or partition >= cutoff:
+                    continue
+
+                archive = self.archive_path(key_path, partition)
+                if archive.exists():
+                    archive.unlink()
+                partition_path = key_path.joinpath(partition)
+                if partition_path.is_dir():
+                    shutil.rmtree(partition_path)
+                    with self.lock:
+                        self.known.discard(partition_path)
+                if index is not None:
+                    index.forget(key_name, *partition_range(partition))
+                logger.info(f"expired partition {partition} of {key_name}")
+                dropped += 1
+
+        return dropped
@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+import marshal
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+def frame_label(code) -> str:
+    filename = Path(code.co_filename).name
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def function_key(code) -> tuple:
+    """how pstats identifies a function"""
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class SamplingProfiler(object):
+    """samples the stacks of every thread of the process for a while,
+    then writes them out as collapsed stacks and pstats.
+
+    Nothing is hooked into the interpreter: when no profile is running
+    the only cost is the idle signal handler or admin route. While it
+    runs, a single thread wakes up every ``interval`` seconds and reads
+    :py:func:`sys._current_frames`.
+    """
+
+    max_depth = 128
+
+    def __init__(self, directory, interval: float = 0.005):
+        self.directory = Path(directory)
+        self.interval = float(interval)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.until = None
+        self.last = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float) -> bool:
+        """starts sampling for ``seconds``, returns False when a profile
+        is already running"""
+        with self.lock:
+            if self.running:
+                return False
+
+            self.until = time.time() + seconds
+            self.thread = threading.Thread(
+                target=self.run,
+                args=(seconds,),
+                name="shortage-profiler",
+                daemon=True,
+            )
+            self.thread.start()
+            return True
+
+    def sample(self, seconds: float) -> Counter:
+        """returns how many times each ``(thread name, stack)`` was
+        seen, stacks are tuples of code objects from the root"""
+        samples = Counter()
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                samples[names.get(ident, str(ident)), tuple(stack)] += 1
+
+            time.sleep(self.interval)
+        return samples
+
+    def run(self, seconds: float):
+        logger.warning(f"profiling process {os.getpid()} for {seconds}s")
+        try:
+            samples = self.sample(seconds)
+            self.last = self.write(samples)
+        except Exception:
+            logger.exception("profiling failed")
+            return
+        logger.warning(f"wrote profile {self.last}")
+
+    def collapsed(self, samples: Counter) -> str:
+        """the input format of flamegraph.pl and speedscope"""
+        lines = []
+        for (thread, stack), count in samples.most_common():
+            frames = [thread] + [frame_label(code) for code in stack]
+            lines.append(f"{';'.join(frames)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def stats(self, samples: Counter) -> dict:
+        """the samples in the format :py:class:`pstats.Stats` loads,
+        with ``interval`` seconds per sample"""
+        own = Counter()
+        inclusive = Counter()
+        calls = Counter()
+        for (_, stack), count in samples.items():
+            keys = [function_key(code) for code in stack]
+            if keys:
+                own[keys[-1]] += count
+            for key in set(keys):
+                inclusive[key] += count
+            for caller, callee in set(zip(keys, keys[1:])):
+                calls[caller, callee] += count
+
+        callers = {key: {} for key in inclusive}
+        for (caller, callee), count in calls.items():
+            seconds = count * self.interval
+            callers[callee][caller] = (count, count, seconds, seconds)
+
+        return {
+            key: (
+                count,
+                count,
+                own[key] * self.interval,
+                count * self.interval,
+                callers[key],
+            )
+            for key, count in inclusive.items()
+        }
+
+    def write(self, samples: Counter) -> Path:
+        """writes ``<time>-<pid>.collapsed`` and ``.pstats`` files and
+        returns the path of the first"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        base = self.directory.joinpath(f"{stamp}-{os.getpid()}")
+
+        collapsed = base.with_suffix(".collapsed")
+        temp = collapsed.with_suffix(".tmp")
+        temp.write_text(self.collapsed(samples))
+        os.replace(temp, collapsed)
+
+        with temp.open("wb") as fd:
+            marshal.dump(self.stats(samples), fd)
+        os.replace(temp, base.with_suffix(".pstats"))
+        return collapsed
+
+    def profiles(self) -> list:
+        if not self.directory.is_dir():
+            return []
+        return sorted(
+            entry.name
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith((".collapsed", ".pstats"))
+        )
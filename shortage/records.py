@@ -0,0 +1,321 @@
+import os
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+# version of the compact schema, blobs without it were written by
+# serialize_request() before records existed
+SCHEMA_VERSION = 1
+
+# (attribute, twilio names, key in the compact schema, type)
+#
+# Twilio sends some values under several names, they are stored once
+# along with a bitmask of the names that carried them.
+FIELDS = (
+    ("sid", ("MessageSid", "SmsSid", "SmsMessageSid"), "s", str),
+    ("account_sid", ("AccountSid",), "a", str),
+    ("messaging_service_sid", ("MessagingServiceSid",), "ms", str),
+    ("sender", ("From",), "f", str),
+    ("recipient", ("To",), "t", str),
+    ("body", ("Body",), "b", str),
+    ("status", ("SmsStatus", "MessageStatus"), "st", str),
+    ("error_code", ("ErrorCode",), "ec", str),
+    ("api_version", ("ApiVersion",), "av", str),
+    ("num_media", ("NumMedia",), "nm", int),
+    ("num_segments", ("NumSegments",), "ns", int),
+    ("from_city", ("FromCity",), "fc", str),
+    ("from_state", ("FromState",), "fs", str),
+    ("from_zip", ("FromZip",), "fz", str),
+    ("from_country", ("FromCountry",), "fn", str),
+    ("to_city", ("ToCity",), "tc", str),
+    ("to_state", ("ToState",), "ts", str),
+    ("to_zip", ("ToZip",), "tz", str),
+    ("to_country", ("ToCountry",), "tn", str),
+)
+
+
+def build_lookup():
+    """maps every twilio name to ``(attribute, type, bit)``, the bit is
+    0 for names that are the only name of their attribute"""
+    lookup = {}
+    bit = 1
+    for attribute, names, _, kind in FIELDS:
+        for name in names:
+            lookup[name] = (attribute, kind, bit if len(names) > 1 else 0)
+            if len(names) > 1:
+                bit <<= 1
+    return lookup
+
+
+BY_NAME = build_lookup()
+
+
+def parse(kind: type, value):
+    """returns ``value`` as ``kind``, or None when it would not be
+    written back exactly as it was received"""
+    if kind is str:
+        return value if isinstance(value, str) else None
+
+    if isinstance(value, str) and value.isdigit() and value == str(int(value)):
+        return int(value)
+    return None
+
+
+class MessageRecord(object):
+    """a twilio webhook request, as it is stored.
+
+    Known twilio fields are typed attributes, anything else lands in
+    ``extras``. Request headers are not kept: the signature was
+    checked before the record was built.
+    """
+
+    __slots__ = ("method", "url", "names", "extras") + tuple(
+        attribute for attribute, _, _, _ in FIELDS
+    )
+
+    def __init__(self, method=None, url=None, names=0, extras=None, **fields):
+        self.method = method
+        self.url = url
+        self.names = names
+        self.extras = extras or {}
+        for attribute, _, _, _ in FIELDS:
+            setattr(self, attribute, fields.pop(attribute, None))
+
+        if fields:
+            raise TypeError(f"unknown message fields: {', '.join(fields)}")
+
+    def __repr__(self):
+        return f"<MessageRecord sid={self.sid!r} to={self.recipient!r}>"
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, MessageRecord)
+            and self.to_blob() == other.to_blob()
+        )
+
+    @classmethod
+    def from_values(cls, values: dict, method=None, url=None):
+        """builds a record out of the twilio request parameters"""
+        record = cls(method, url)
+        extras = record.extras
+        for name, value in values.items():
+            found = BY_NAME.get(name)
+            if found is None:
+                extras[name] = value
+                continue
+
+            attribute, kind, bit = found
+            parsed = parse(kind, value)
+            current = getattr(record, attribute)
+            if parsed is None or (bit and current not in (None, parsed)):
+                extras[name] = value
+                continue
+
+            setattr(record, attribute, parsed)
+            record.names |= bit
+
+        return record
+
+    @classmethod
+    def from_blob(cls, blob):
+        """reads both the compact schema and the blobs written before
+        it, see :py:meth:`to_blob`"""
+        if not isinstance(blob, dict):
+            return cls()
+
+        if blob.get("v") != SCHEMA_VERSION:
+            return cls.from_values(
+                legacy_values(blob),
+                method=blob.get("method"),
+                url=blob.get("url"),
+            )
+
+        record = cls(
+            blob.get("m"), blob.get("u"), blob.get("n", 0), blob.get("x")
+        )
+        for attribute, _, key, _ in FIELDS:
+            value = blob.get(key)
+            if value is not None:
+                setattr(record, attribute, value)
+        return record
+
+    def to_blob(self) -> dict:
+        """the compact schema: short keys and no empty values"""
+        blob = {"v": SCHEMA_VERSION}
+        if self.method:
+            blob["m"] = self.method
+        if self.url:
+            blob["u"] = self.url
+        for attribute, _, key, _ in FIELDS:
+            value = getattr(self, attribute)
+            if value is not None:
+                blob[key] = value
+        if self.names:
+            blob["n"] = self.names
+        if self.extras:
+            blob["x"] = self.extras
+        return blob
+
+    def to_data(self) -> dict:
+        """the twilio request parameters the record was built from"""
+        data = {}
+        for attribute, names, _, kind in FIELDS:
+            value = getattr(self, attribute)
+            if value is None:
+                continue
+
+            value = value if kind is str else str(value)
+            if len(names) == 1:
+                data[names[0]] = value
+                continue
+
+            for name in names:
+                if self.names & BY_NAME[name][2]:
+                    data[name] = value
+
+        data.update(self.extras)
+        return data
+
+    def is_complete(self) -> bool:
+        """whether the record carries what is needed to index it"""
+        return bool(self.sid and self.sender and self.recipient)
+
+
+def legacy_values(blob: dict) -> dict:
+    """the twilio parameters of a blob written by serialize_request():
+    json posts are parsed into ``data``, form posts leave it empty or
+    holding only the ``raw`` body and carry their fields in ``values``
+    and ``form``"""
+    for key in ("data", "values", "form"):
+        values = blob.get(key)
+        if isinstance(values, dict) and set(values) - {"raw"}:
+            return values
+    return {}
+
+
+def is_compact(blob) -> bool:
+    return isinstance(blob, dict) and blob.get("v") == SCHEMA_VERSION
+
+
+_migration_codecs = None
+
+
+def start_migration_worker(codec_name: str, dictionaries_path: str):
+    from shortage.serialization import create_codecs
+
+    global _migration_codecs
+    _migration_codecs = create_codecs(codec_name, dictionaries_path)
+
+
+def write_atomically(path: Path, blob: bytes):
+    temp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with temp.open("wb") as fd:
+        fd.write(blob)
+    os.replace(temp, path)
+
+
+def migrate_files(paths) -> dict:
+    """rewrites the given blob files with the compact schema, runs in
+    the processes of :py:func:`migrate_storage`"""
+    codecs = _migration_codecs
+    counts = {
+        "converted": 0,
+        "skipped": 0,
+        "refused": 0,
+        "failed": 0,
+        "saved": 0,
+    }
+    for path in map(Path, paths):
+        try:
+            raw = path.read_bytes()
+            blob = codecs.load(raw)
+        except Exception as e:
+            logger.error(f"failed to read {path}: {e}")
+            counts["failed"] += 1
+            continue
+
+        if is_compact(blob):
+            counts["skipped"] += 1
+            continue
+
+        record = MessageRecord.from_blob(blob)
+        if not record.is_complete():
+            logger.error(f"refusing to rewrite {path}: no sid, From or To")
+            counts["refused"] += 1
+            continue
+
+        compact = codecs.dump(record.to_blob())
+        target = path.with_name(f"{path.stem}.{codecs.extension}")
+        write_atomically(target, compact)
+        if target != path:
+            path.unlink()
+
+        counts["converted"] += 1
+        counts["saved"] += len(raw) - len(compact)
+
+    return counts
+
+
+def blob_paths(storage):
+    for key_name in storage.keys():
+        key_path = storage.base_path.joinpath(key_name)
+        with os.scandir(key_path) as entries:
+            for entry in entries:
+                if entry.name.endswith(storage.extensions):
+                    yield entry.path
+
+
+def chunked(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def migrate_storage(
+    storage,
+    codec_name: str = "json",
+    dictionaries_path=None,
+    workers: int = None,
+    chunk_size: int = 500,
+) -> dict:
+    """converts every blob of a :py:class:`FileStorage` to the compact
+    schema in a pool of processes.
+
+    The tree is listed lazily and handed out ``chunk_size`` files at a
+    time, with at most two chunks per worker in flight. Files are
+    replaced atomically, so the migration can run next to the web
+    server and be interrupted and resumed.
+    """
+    workers = workers or os.cpu_count() or 1
+    totals = {
+        "converted": 0,
+        "skipped": 0,
+        "refused": 0,
+        "failed": 0,
+        "saved": 0,
+    }
+    pending = []
+    with ProcessPoolExecutor(
+        workers,
+        initializer=start_migration_worker,
+        initargs=(codec_name, str(dictionaries_path or "")),
+    ) as executor:
+        for chunk in chunked(blob_paths(storage), chunk_size):
+            pending.append(executor.submit(migrate_files, chunk))
+            if len(pending) >= workers * 2:
+                for name, count in pending.pop(0).result().items():
+                    totals[name] += count
+
+        for future in pending:
+            for name, count in future.result().items():
+                totals[name] += count
+
+    return totals
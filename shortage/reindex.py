@@ -0,0 +1,298 @@
+import os
+import json
+import time
+import logging
+from pathlib import Path
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
+
+from shortage.indexes import message_fields
+from shortage.records import chunked, write_atomically
+
+logger = logging.getLogger(__name__)
+
+
+# what can be wrong with a blob file, as reported by `shortage reindex`
+EMPTY = "empty"
+PARTIAL = "partial"
+UNREADABLE = "unreadable"
+UNDECODABLE = "undecodable"
+INVALID = "invalid"
+
+_reindex_codecs = None
+
+
+def start_reindex_worker(codec_name: str, dictionaries_path: str):
+    from shortage.serialization import create_codecs
+
+    global _reindex_codecs
+    _reindex_codecs = create_codecs(codec_name, dictionaries_path)
+
+
+def read_fields(path: str, codecs):
+    """returns ``(fields, None)`` for a valid blob file, ``(None,
+    problem)`` otherwise"""
+    try:
+        with open(path, "rb") as fd:
+            raw = fd.read()
+    except OSError as e:
+        return None, (UNREADABLE, str(e))
+
+    if not raw:
+        return None, (EMPTY, "no bytes")
+
+    try:
+        blob = codecs.load(raw)
+    except Exception as e:
+        return None, (UNDECODABLE, f"{type(e).__name__}: {e}")
+
+    if not isinstance(blob, dict):
+        return None, (INVALID, f"a {type(blob).__name__}, not a message")
+
+    fields = message_fields(blob)
+    if not (fields["sid"] or fields["sender"] or fields["recipient"]):
+        return None, (INVALID, "no twilio fields")
+    return fields, None
+
+
+def index_files(key_name: str, names: list, key_path: str) -> dict:
+    """parses and validates blob files of one key, runs in the
+    processes of :py:class:`Reindex`"""
+    rows = []
+    problems = []
+    for name in names:
+        path = os.path.join(key_path, name)
+        fields, problem = read_fields(path, _reindex_codecs)
+        if problem:
+            problems.append((path,) + problem)
+        else:
+            rows.append((key_name, name.rsplit(".", 1)[0], fields))
+    return {"rows": rows, "problems": problems}
+
+
+class ReindexState(object):
+    """what an interrupted ``shortage reindex`` already did.
+
+    Keys are recorded once every file of theirs is indexed, a resumed
+    run skips them without listing them. Within the other keys, files
+    already in the index are skipped as they are listed.
+    """
+
+    def __init__(self, path: [Path, str]):
+        self.path = Path(path)
+        self.started = time.time()
+        self.done = set()
+        self.totals = {"indexed": 0, "skipped": 0, "problems": 0}
+
+    @property
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load(self):
+        state = json.loads(self.path.read_text())
+        self.started = state["started"]
+        self.done = set(state["done"])
+        self.totals.update(state["totals"])
+        return self
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        state = {
+            "started": self.started,
+            "done": sorted(self.done),
+            "totals": self.totals,
+        }
+        write_atomically(self.path, json.dumps(state).encode("utf-8"))
+
+    def remove(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class Reindex(object):
+    """rebuilds the :py:class:`~shortage.indexes.MessageIndex` and the
+    sids of the bloom filter from every blob of a
+    :py:class:`~shortage.filesystem.FileStorage`.
+
+    The parent process lists each key directory with ``os.scandir()``
+    and hands the files out ``chunk_size`` at a time, so a single huge
+    directory is spread over every worker like many small ones are.
+    Workers read, decode and validate the blobs, which is where the
+    time goes, and send back the indexed fields. The parent writes
+    them in one transaction per chunk, as sqlite only has one writer.
+    """
+
+    max_reported = 20
+
+    def __init__(
+        self,
+        storage,
+        index,
+        state: ReindexState,
+        report: [Path, str],
+        bloom=None,
+        codec_name: str = "json",
+        dictionaries_path=None,
+        workers: int = None,
+        chunk_size: int = 500,
+    ):
+        self.storage = storage
+        self.index = index
+        self.state = state
+        self.report_path = Path(report)
+        self.bloom = bloom
+        self.codec_name = codec_name
+        self.dictionaries_path = str(dictionaries_path or "")
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = max(1, min(int(chunk_size), 900))
+        self.problems = []
+        self.report = None
+        self.reported = set()
+        # futures of every key still being indexed, and whether the
+        # key was listed entirely
+        self.pending = {}
+        self.outstanding = {}
+        self.listed = set()
+
+    def files(self, key_name: str):
+        """yields the blob file names of a key, reporting leftovers of
+        interrupted writes"""
+        key_path = self.storage.base_path.joinpath(key_name)
+        with os.scandir(key_path) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.storage.extensions):
+                    yield entry.name
+                elif entry.name.endswith(".tmp"):
+                    self.record_problem(
+                        (entry.path, PARTIAL, "unfinished write")
+                    )
+
+    def unindexed(self, key_name: str, names: list, resuming: bool):
+        """the files left to index, on resume those that are neither
+        indexed nor already reported"""
+        if not resuming:
+            return names
+        key_path = self.storage.base_path.joinpath(key_name)
+        names = [
+            name
+            for name in names
+            if str(key_path.joinpath(name)) not in self.reported
+        ]
+        key_values = [name.rsplit(".", 1)[0] for name in names]
+        indexed = self.index.indexed(key_name, key_values)
+        self.state.totals["skipped"] += len(indexed)
+        return [
+            name
+            for name, key_value in zip(names, key_values)
+            if key_value not in indexed
+        ]
+
+    def load_report(self):
+        with self.report_path.open() as fd:
+            for line in fd:
+                try:
+                    self.reported.add(json.loads(line)["path"])
+                except (ValueError, KeyError):
+                    # the last line of an interrupted run
+                    continue
+
+    def record_problem(self, problem: tuple):
+        path, kind, detail = problem
+        if path in self.reported:
+            return
+        self.reported.add(path)
+        self.state.totals["problems"] += 1
+        if len(self.problems) < self.max_reported:
+            self.problems.append(
+                {"path": path, "problem": kind, "detail": detail}
+            )
+        self.report.write(
+            json.dumps({"path": path, "problem": kind, "detail": detail})
+            + "\n"
+        )
+
+    def collect(self, future):
+        key_name = self.pending.pop(future)
+        result = future.result()
+        rows = result["rows"]
+        self.state.totals["indexed"] += self.index.add_fields(rows)
+        if self.bloom is not None:
+            self.bloom.add_many(
+                fields["sid"] for _, _, fields in rows if fields["sid"]
+            )
+        for problem in result["problems"]:
+            self.record_problem(problem)
+
+        self.outstanding[key_name] -= 1
+        self.finish_key(key_name)
+
+    def finish_key(self, key_name: str):
+        if key_name in self.listed and not self.outstanding[key_name]:
+            self.state.done.add(key_name)
+            self.report.flush()
+            self.state.save()
+
+    def wait_for(self, most: int):
+        while len(self.pending) > most:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                self.collect(future)
+
+    def run(self) -> dict:
+        started = time.perf_counter()
+        resuming = self.state.exists
+        if resuming:
+            self.state.load()
+            if self.report_path.exists():
+                self.load_report()
+            logger.info(
+                f"resuming reindex, {len(self.state.done)} keys done"
+            )
+        else:
+            self.index.clear()
+            self.state.save()
+
+        self.report_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.report_path.open("a" if resuming else "w") as report:
+            self.report = report
+            with ProcessPoolExecutor(
+                self.workers,
+                initializer=start_reindex_worker,
+                initargs=(self.codec_name, self.dictionaries_path),
+            ) as executor:
+                for key_name in self.storage.keys():
+                    if key_name in self.state.done:
+                        continue
+
+                    self.outstanding[key_name] = 0
+                    key_path = str(self.storage.base_path.joinpath(key_name))
+                    for names in chunked(
+                        self.files(key_name), self.chunk_size
+                    ):
+                        names = self.unindexed(key_name, names, resuming)
+                        if not names:
+                            continue
+                        future = executor.submit(
+                            index_files, key_name, names, key_path
+                        )
+                        self.pending[future] = key_name
+                        self.outstanding[key_name] += 1
+                        self.wait_for(self.workers * 2)
+
+                    self.listed.add(key_name)
+                    self.finish_key(key_name)
+
+                self.wait_for(0)
+
+        summary = dict(self.state.totals)
+        summary["keys"] = len(self.state.done)
+        summary["elapsed"] = round(time.perf_counter() - started, 3)
+        summary["report"] = str(self.report_path)
+        summary["problem_files"] = self.problems
+        self.state.remove()
+        return summary
@@ -0,0 +1,284 @@
+import os
+import json
+import uuid
+import struct
+import logging
+import threading
+from urllib.parse import quote
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    from botocore.config import Config
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+from shortage.export import ordered_map
+from shortage.filesystem import sanitize, sort_key
+from shortage.groupcommit import GroupCommit
+from shortage.serialization import Codecs
+
+logger = logging.getLogger(__name__)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def encode_bound(key_value: str) -> str:
+    """a key value as a batch name bound, which sorts like the key
+    values do and can't contain the ``_`` separating the bounds.
+
+    Numbers are the hex of their float64 bits with the sign flipped,
+    anything else is percent-encoded after them."""
+    try:
+        number = float(key_value)
+    except ValueError:
+        return "s" + quote(key_value, safe="").replace("_", "%5F")
+
+    (bits,) = struct.unpack(">Q", struct.pack(">d", number))
+    bits ^= 0xFFFFFFFFFFFFFFFF if bits >> 63 else 1 << 63
+    return f"n{bits:016x}"
+
+
+def batch_bounds(object_key: str):
+    """the encoded first and last key values of a batch, from its
+    name"""
+    name = object_key.rsplit("/", 1)[-1]
+    parts = name.split("_")
+    if len(parts) != 3:
+        return None
+    return parts[0], parts[1]
+
+
+def batch_runs(records, span: float):
+    """splits ``(key_value, ...)`` tuples sorted by key value into the
+    runs uploaded as one batch each: numbers spanning at most ``span``,
+    other key values one by one"""
+    run = []
+    start = None
+    for record in records:
+        try:
+            number = float(record[0])
+        except ValueError:
+            number = None
+
+        if run and (
+            number is None or start is None or number - start > span
+        ):
+            yield run
+            run = []
+        if not run:
+            start = number
+        run.append(record)
+
+    if run:
+        yield run
+
+
+def get_s3_client(endpoint_url: str = None, pool_size: int = 16):
+    """returns a process-wide S3 client whose connection pool is
+    shared by every thread of the process"""
+    if boto3 is None:
+        raise RuntimeError(
+            "S3Storage requires boto3, install shortage-app[s3]"
+        )
+
+    key = (os.getpid(), endpoint_url, pool_size)
+    if key not in _clients:
+        with _clients_lock:
+            if key not in _clients:
+                config = Config(
+                    max_pool_connections=pool_size,
+                    retries={"max_attempts": 5, "mode": "standard"},
+                )
+                _clients[key] = boto3.session.Session().client(
+                    "s3", endpoint_url=endpoint_url, config=config
+                )
+    return _clients[key]
+
+
+class S3Storage(object):
+    """stores messages in S3, many messages per object.
+
+    Concurrent ``add()`` calls are coalesced by a
+    :py:class:`~shortage.groupcommit.GroupCommit` into one object per
+    key and batch: ``<prefix>/<key>/<first>_<last>_<id>.batch``, the
+    bounds being encoded by :py:func:`encode_bound`. The object holds
+    the encoded blobs followed by a json manifest of ``[key_value,
+    offset, length]`` and the manifest length as 8 bytes, so a single
+    GET is enough to read any message of a batch. Each call to
+    ``add()`` returns once its batch is uploaded.
+
+    Batches span at most ``span`` seconds of key values, so that
+    ``get()`` lists the objects of its key from ``span`` seconds before
+    the message instead of all of them.
+    """
+
+    footer = struct.Struct(">Q")
+
+    def __init__(
+        self,
+        bucket_name: str,
+        prefix: str = "shortage",
+        client=None,
+        codecs: Codecs = None,
+        batch_size: int = 100,
+        max_wait: float = 0.0,
+        workers: int = 8,
+        span: float = 60.0,
+    ):
+        self.bucket_name = bucket_name
+        self.workers = workers
+        self.span = span
+        self.prefix = prefix.strip("/")
+        self.client = client or get_s3_client()
+        self.codecs = codecs or Codecs()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.group_commit = GroupCommit(
+            self.upload_batch, batch_size=batch_size, max_wait=max_wait
+        )
+
+    def key_prefix(self, key_name: str) -> str:
+        return f"{self.prefix}/{sanitize(key_name)}/"
+
+    def add(self, key_name, key_value, data):
+        blob = self.codecs.dump(data)
+        return self.group_commit.submit((key_name, str(key_value), blob))
+
+    def encode_batch(self, records):
+        body = bytearray()
+        manifest = []
+        for key_value, blob in records:
+            manifest.append([key_value, len(body), len(blob)])
+            body += blob
+
+        raw_manifest = json.dumps(manifest).encode("utf-8")
+        body += raw_manifest + self.footer.pack(len(raw_manifest))
+        return bytes(body)
+
+    def decode_batch(self, body: bytes):
+        end = len(body) - self.footer.size
+        (length,) = self.footer.unpack_from(body, end)
+        manifest = json.loads(body[end - length: end].decode("utf-8"))
+        for key_value, offset, size in manifest:
+            yield key_value, self.codecs.load(body[offset: offset + size])
+
+    def put_batch(self, key_name, records):
+        records.sort(key=lambda record: sort_key(record[0]))
+        first, last = records[0][0], records[-1][0]
+        object_key = (
+            f"{self.key_prefix(key_name)}"
+            f"{encode_bound(first)}_{encode_bound(last)}_"
+            f"{uuid.uuid4().hex[:8]}.batch"
+        )
+        self.client.put_object(
+            Bucket=self.bucket_name,
+            Key=object_key,
+            Body=self.encode_batch(records),
+        )
+        logger.info(f"uploaded {len(records)} messages to {object_key}")
+        return object_key
+
+    def upload_batch(self, items):
+        by_key = defaultdict(list)
+        for position, (key_name, key_value, blob) in enumerate(items):
+            by_key[sanitize(key_name)].append((key_value, blob, position))
+
+        uploads = [None] * len(items)
+        for key_name, records in by_key.items():
+            records.sort(key=lambda record: sort_key(record[0]))
+            for run in batch_runs(records, self.span):
+                upload = self.executor.submit(
+                    self.put_batch,
+                    key_name,
+                    [(key_value, blob) for key_value, blob, _ in run],
+                )
+                for _, _, position in run:
+                    uploads[position] = upload
+
+        results = []
+        for upload in uploads:
+            try:
+                results.append(upload.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def list_objects(
+        self, prefix: str, delimiter: str = None, start_after: str = None
+    ):
+        paginator = self.client.get_paginator("list_objects_v2")
+        params = {"Bucket": self.bucket_name, "Prefix": prefix}
+        if delimiter:
+            params["Delimiter"] = delimiter
+        if start_after:
+            params["StartAfter"] = start_after
+
+        for page in paginator.paginate(**params):
+            if delimiter:
+                yield from page.get("CommonPrefixes", [])
+            else:
+                yield from page.get("Contents", [])
+
+    def keys(self):
+        prefixes = self.list_objects(f"{self.prefix}/", delimiter="/")
+        return sorted(
+            prefix["Prefix"].rstrip("/").rsplit("/", 1)[-1]
+            for prefix in prefixes
+        )
+
+    def batches(self, key_name):
+        return [o["Key"] for o in self.list_objects(self.key_prefix(key_name))]
+
+    def batches_of(self, key_names):
+        """lists the batches of many keys in parallel"""
+        return dict(zip(key_names, self.executor.map(self.batches, key_names)))
+
+    def read_batch(self, object_key: str):
+        response = self.client.get_object(
+            Bucket=self.bucket_name, Key=object_key
+        )
+        return list(self.decode_batch(response["Body"].read()))
+
+    def scan(self, key_name):
+        """yields ``(key_value, data)`` for every message of the given
+        key, downloading a few batches ahead in parallel"""
+        batches = self.batches(key_name)
+        for records in ordered_map(
+            self.read_batch, batches, self.executor, self.workers
+        ):
+            yield from records
+
+    def get(self, key_name, key_value):
+        """reads a message out of the batches that may hold it, listed
+        from the first one that can"""
+        key_value = str(key_value)
+        target = encode_bound(key_value)
+        try:
+            lowest = encode_bound(str(float(key_value) - self.span))
+        except ValueError:
+            lowest = target
+
+        prefix = self.key_prefix(key_name)
+        for found in self.list_objects(prefix, start_after=prefix + lowest):
+            object_key = found["Key"]
+            bounds = batch_bounds(object_key)
+            if bounds is None:
+                logger.warning(f"skipping unknown object {object_key}")
+                continue
+            first, last = bounds
+            if first > target:
+                break
+            if last < target:
+                continue
+
+            for found_value, data in self.read_batch(object_key):
+                if found_value == key_value:
+                    return data
+
+        return None
+
+    def list_all(self, key_name):
+        return [data for _, data in self.scan(key_name)]
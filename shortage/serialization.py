@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import zlib
+import struct
+import logging
+from pathlib import Path
+from collections import Counter
+
+from shortage.metrics import BYTES_WRITTEN
+
+logger = logging.getLogger(__name__)
+
+# json text never starts with a NUL byte, so blobs written by any
+# other codec are prefixed with MAGIC followed by the codec code.
+# Blobs without the prefix are plain json, which keeps every blob
+# written before codecs existed readable.
+MAGIC = b"\x00SC"
+
+
+class CodecError(Exception):
+    """raised when a blob can't be decoded"""
+
+
+class Codec(object):
+    name = None
+    code = None
+    extension = "blob"
+
+    def encode(self, data) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, payload: bytes):
+        raise NotImplementedError
+
+    def dump(self, data) -> bytes:
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+
+        return MAGIC + bytes([self.code]) + self.encode(data)
+
+
+class JSONCodec(Codec):
+    name = "json"
+    code = 0
+    extension = "json"
+
+    def __init__(self, indent: int = None):
+        self.indent = indent
+        self.name = f"json-indent-{indent}" if indent else "json"
+        self.separators = None if indent else (",", ":")
+
+    def encode(self, data) -> bytes:
+        return json.dumps(
+            data, indent=self.indent, separators=self.separators, default=str
+        ).encode("utf-8")
+
+    def decode(self, payload: bytes):
+        return json.loads(payload.decode("utf-8"))
+
+    def dump(self, data) -> bytes:
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+
+        return self.encode(data)
+
+
+def write_varint(value: int, out: bytearray):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(payload: bytes, position: int):
+    result = shift = 0
+    while True:
+        byte = payload[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+class BinaryCodec(Codec):
+    """length-prefixed binary encoding of json-like values.
+
+    Every value is a one byte tag followed by its payload; strings,
+    bytes, lists and dicts are prefixed with their length as a varint.
+    """
+
+    name = "binary"
+    code = 1
+
+    double = struct.Struct(">d")
+    integer = struct.Struct(">q")
+
+    def encode(self, data) -> bytes:
+        out = bytearray()
+        self.write(data, out)
+        return bytes(out)
+
+    def write(self, value, out: bytearray):
+        if value is None:
+            out += b"N"
+        elif value is True:
+            out += b"T"
+        elif value is False:
+            out += b"F"
+        elif isinstance(value, str):
+            raw = value.encode("utf-8")
+            out += b"s"
+            write_varint(len(raw), out)
+            out += raw
+        elif isinstance(value, int) and -(2 ** 63) <= value < 2 ** 63:
+            out += b"i" + self.integer.pack(value)
+        elif isinstance(value, float):
+            out += b"d" + self.double.pack(value)
+        elif isinstance(value, (bytes, bytearray)):
+            out += b"b"
+            write_varint(len(value), out)
+            out += value
+        elif isinstance(value, dict):
+            out += b"m"
+            write_varint(len(value), out)
+            for key, item in value.items():
+                self.write(str(key), out)
+                self.write(item, out)
+        elif isinstance(value, (list, tuple)):
+            out += b"l"
+            write_varint(len(value), out)
+            for item in value:
+                self.write(item, out)
+        else:
+            self.write(str(value), out)
+
+    def decode(self, payload: bytes):
+        value, position = self.read(payload, 0)
+        return value
+
+    def read(self, payload: bytes, position: int):
+        tag = payload[position: position + 1]
+        position += 1
+        if tag == b"s" or tag == b"b":
+            length, position = read_varint(payload, position)
+            raw = payload[position: position + length]
+            position += length
+            return (raw.decode("utf-8") if tag == b"s" else raw), position
+        if tag == b"m":
+            count, position = read_varint(payload, position)
+            value = {}
+            for _ in range(count):
+                key, position = self.read(payload, position)
+                value[key], position = self.read(payload, position)
+            return value, position
+        if tag == b"l":
+            count, position = read_varint(payload, position)
+            value = []
+            for _ in range(count):
+                item, position = self.read(payload, position)
+                value.append(item)
+            return value, position
+        if tag == b"i":
+            value = self.integer.unpack_from(payload, position)[0]
+            return value, position + self.integer.size
+        if tag == b"d":
+            value = self.double.unpack_from(payload, position)[0]
+            return value, position + self.double.size
+        if tag == b"N":
+            return None, position
+        if tag == b"T":
+            return True, position
+        if tag == b"F":
+            return False, position
+
+        raise CodecError(f"unknown tag {tag!r} at position {position - 1}")
+
+
+def dictionary_id(zdict: bytes) -> int:
+    return zlib.crc32(zdict) if zdict else 0
+
+
+class ZlibJSONCodec(Codec):
+    """compact json compressed with zlib, optionally primed with a
+    shared dictionary trained from existing messages.
+
+    The payload starts with the crc32 of the dictionary it was
+    compressed with, so blobs stay readable after a new dictionary is
+    trained as long as the old one is kept around.
+    """
+
+    name = "zlib"
+    code = 2
+
+    dictionary_header = struct.Struct(">I")
+
+    def __init__(self, zdict: bytes = b"", dictionaries=None, level: int = 6):
+        self.zdict = zdict or b""
+        self.level = level
+        self.dictionaries = {0: b""}
+        self.dictionaries.update(dictionaries or {})
+        self.dictionaries[dictionary_id(self.zdict)] = self.zdict
+        self.json = JSONCodec()
+
+    def encode(self, data) -> bytes:
+        if self.zdict:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+        else:
+            compressor = zlib.compressobj(self.level)
+
+        compressed = compressor.compress(self.json.encode(data))
+        compressed += compressor.flush()
+        header = self.dictionary_header.pack(dictionary_id(self.zdict))
+        return header + compressed
+
+    def decode(self, payload: bytes):
+        (zdict_id,) = self.dictionary_header.unpack_from(payload)
+        zdict = self.dictionaries.get(zdict_id)
+        if zdict is None:
+            raise CodecError(f"unknown zlib dictionary {zdict_id:08x}")
+
+        if zdict:
+            decompressor = zlib.decompressobj(zdict=zdict)
+        else:
+            decompressor = zlib.decompressobj()
+
+        body = payload[self.dictionary_header.size:]
+        raw = decompressor.decompress(body) + decompressor.flush()
+        return self.json.decode(raw)
+
+
+def load_dictionaries(path: [Path, str]) -> dict:
+    """reads every ``*.zdict`` file under ``path`` keyed by its id"""
+    path = Path(path)
+    if not path.is_dir():
+        return {}
+
+    dictionaries = {}
+    for entry in os.scandir(path):
+        if entry.name.endswith(".zdict"):
+            zdict = Path(entry.path).read_bytes()
+            dictionaries[dictionary_id(zdict)] = zdict
+    return dictionaries
+
+
+def fragments(value, prefix=""):
+    """yields the json fragments a dictionary should contain: every
+    ``"key":`` and every short ``"key":value`` pair"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            name = json.dumps(str(key)) + ":"
+            yield name
+            if isinstance(item, (dict, list)):
+                yield from fragments(item)
+            else:
+                pair = name + json.dumps(item, default=str)
+                if len(pair) <= 64:
+                    yield pair
+    elif isinstance(value, list):
+        for item in value:
+            yield from fragments(item)
+
+
+def train_zdict(samples, size: int = 32 * 1024) -> bytes:
+    """builds a zlib preset dictionary out of the fragments that repeat
+    the most across ``samples``.
+
+    zlib prefers matches closer to the end of the dictionary, so the
+    most valuable fragments are placed last.
+    """
+    counter = Counter()
+    for sample in samples:
+        counter.update(set(fragments(sample)))
+
+    ranked = sorted(
+        (fragment for fragment, count in counter.items() if count > 1),
+        key=lambda fragment: counter[fragment] * len(fragment),
+    )
+    chosen = []
+    total = 0
+    for fragment in reversed(ranked):
+        raw = fragment.encode("utf-8")
+        if total + len(raw) > size:
+            continue
+        chosen.append(raw)
+        total += len(raw)
+
+    return b"".join(reversed(chosen))
+
+
+class Codecs(object):
+    """reads blobs written by any codec and writes them with one"""
+
+    def __init__(self, default: Codec = None, dictionaries=None):
+        self.default = default or JSONCodec()
+        zlib_codec = (
+            self.default
+            if isinstance(self.default, ZlibJSONCodec)
+            else ZlibJSONCodec(dictionaries=dictionaries)
+        )
+        if dictionaries:
+            zlib_codec.dictionaries.update(dictionaries)
+
+        self.by_code = {
+            JSONCodec.code: JSONCodec(),
+            BinaryCodec.code: BinaryCodec(),
+            ZlibJSONCodec.code: zlib_codec,
+        }
+
+    @property
+    def extension(self):
+        return self.default.extension
+
+    def dump(self, data) -> bytes:
+        blob = self.default.dump(data)
+        BYTES_WRITTEN.inc(len(blob))
+        return blob
+
+    def load(self, raw: bytes):
+        if not raw.startswith(MAGIC):
+            return self.by_code[JSONCodec.code].decode(raw)
+
+        code = raw[len(MAGIC)]
+        codec = self.by_code.get(code)
+        if codec is None:
+            raise CodecError(f"unknown codec {code}")
+        return codec.decode(raw[len(MAGIC) + 1:])
+
+
+def create_codecs(name: str = "json", dictionaries_path=None) -> Codecs:
+    dictionaries = load_dictionaries(dictionaries_path or "")
+    if name == "binary":
+        default = BinaryCodec()
+    elif name == "zlib":
+        newest = max(
+            Path(dictionaries_path).glob("*.zdict"),
+            key=lambda path: path.stat().st_mtime,
+            default=None,
+        ) if dictionaries_path else None
+        zdict = newest.read_bytes() if newest else b""
+        default = ZlibJSONCodec(zdict, dictionaries)
+    elif name == "json":
+        default = JSONCodec()
+    else:
+        raise ValueError(f"unknown codec {name!r}")
+
+    return Codecs(default, dictionaries)
+
+
+def benchmark(codec: Codec, samples, rounds: int = 3) -> dict:
+    """measures bytes per message and encode/decode time per message"""
+    samples = list(samples)
+    encoded = [codec.dump(sample) for sample in samples]
+    codecs = Codecs(codec)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for sample in samples:
+            codec.dump(sample)
+    encode_time = (time.perf_counter() - started) / (rounds * len(samples))
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for raw in encoded:
+            codecs.load(raw)
+    decode_time = (time.perf_counter() - started) / (rounds * len(samples))
+
+    return {
+        "codec": codec.name,
+        "messages": len(samples),
+        "bytes_per_message": sum(map(len, encoded)) / len(samples),
+        "encode_us": encode_time * 1e6,
+        "decode_us": decode_time * 1e6,
+    }
@@ -0,0 +1,202 @@
+import os
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from shortage.filesystem import sanitize
+from shortage.groupcommit import GroupCommit
+from shortage.indexes import message_fields, to_timestamp
+from shortage.serialization import Codecs, CodecError
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    key_name TEXT NOT NULL,
+    key_value TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    sid TEXT,
+    sender TEXT,
+    recipient TEXT,
+    blob BLOB NOT NULL,
+    UNIQUE (key_name, key_value)
+);
+CREATE INDEX IF NOT EXISTS messages_by_sid ON messages (sid);
+CREATE INDEX IF NOT EXISTS messages_by_sender
+    ON messages (sender, received_at);
+CREATE INDEX IF NOT EXISTS messages_by_recipient
+    ON messages (recipient, received_at);
+CREATE INDEX IF NOT EXISTS messages_by_time ON messages (received_at);
+"""
+
+# the statements are constant strings so that sqlite3 reuses the
+# prepared statement from its per-connection cache on every call
+INSERT = (
+    "INSERT OR REPLACE INTO messages "
+    "(key_name, key_value, received_at, sid, sender, recipient, blob) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SELECT_ONE = (
+    "SELECT blob FROM messages WHERE key_name = ? AND key_value = ?"
+)
+SELECT_KEY = (
+    "SELECT key_value, blob FROM messages WHERE key_name = ? "
+    "ORDER BY received_at, key_value"
+)
+
+
+class SQLiteStorage(object):
+    """stores every message as a row of a single sqlite database in
+    WAL mode.
+
+    Writes of concurrent ``add()`` calls are coalesced by a
+    :py:class:`~shortage.groupcommit.GroupCommit` into one transaction,
+    so each batch costs a single WAL sync. Each thread of each worker
+    process gets its own connection.
+    """
+
+    def __init__(
+        self,
+        path: [Path, str],
+        codecs: Codecs = None,
+        batch_size: int = 64,
+        max_wait: float = 0.002,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.codecs = codecs or Codecs()
+        self.local = threading.local()
+        self.group_commit = GroupCommit(
+            self.write_batch, batch_size=batch_size, max_wait=max_wait
+        )
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads or fork()
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(
+            str(self.path), timeout=30, cached_statements=32
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode FULL syncs once per transaction, that is once
+        # per batch of the group commit
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.executescript(SCHEMA)
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def row(self, key_name, key_value, data, blob: bytes):
+        fields = message_fields(data)
+        return (
+            sanitize(key_name),
+            str(key_value),
+            to_timestamp(key_value),
+            fields["sid"],
+            fields["sender"],
+            fields["recipient"],
+            blob,
+        )
+
+    def add(self, key_name, key_value, data):
+        blob = self.codecs.dump(data)
+        row = self.row(key_name, key_value, data, blob)
+        rowid = self.group_commit.submit(row)
+        logger.info(f"wrote row {rowid}: {row[0]}/{row[1]}")
+        return rowid
+
+    def write_batch(self, rows):
+        """inserts a batch of rows in a single transaction and returns
+        their row ids"""
+        with self.connection as connection:
+            return [connection.execute(INSERT, row).lastrowid for row in rows]
+
+    def add_many(self, rows) -> int:
+        """inserts ``(key_name, key_value, data, blob)`` tuples in one
+        transaction, bypassing the group commit"""
+        with self.connection as connection:
+            cursor = connection.executemany(
+                INSERT, (self.row(*row) for row in rows)
+            )
+            return cursor.rowcount
+
+    def keys(self):
+        cursor = self.connection.execute(
+            "SELECT DISTINCT key_name FROM messages ORDER BY key_name"
+        )
+        return [key_name for (key_name,) in cursor]
+
+    def get(self, key_name, key_value):
+        found = self.connection.execute(
+            SELECT_ONE, (sanitize(key_name), str(key_value))
+        ).fetchone()
+        return self.codecs.load(found[0]) if found else None
+
+    def scan(self, key_name):
+        """yields ``(key_value, data)`` for every message of the given
+        key, oldest first"""
+        cursor = self.connection.execute(SELECT_KEY, (sanitize(key_name),))
+        for key_value, blob in cursor:
+            yield key_value, self.codecs.load(blob)
+
+    def find(self, sid=None, sender=None, recipient=None, limit=None):
+        """yields ``(key_name, key_value, data)`` of the messages
+        matching every given field, oldest first"""
+        clauses, params = [], []
+        for column, value in (
+            ("sid", sid),
+            ("sender", sender),
+            ("recipient", recipient),
+        ):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+
+        where = " AND ".join(clauses) or "1"
+        sql = (
+            f"SELECT key_name, key_value, blob FROM messages WHERE {where} "
+            "ORDER BY received_at"
+        )
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        for key_name, key_value, blob in self.connection.execute(sql, params):
+            yield key_name, key_value, self.codecs.load(blob)
+
+    def count(self) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM messages"
+        ).fetchone()[0]
+
+    def migrate(self, storage, batch_size: int = 1000) -> int:
+        """bulk-loads every blob of a :py:class:`FileStorage`.
+
+        Blobs are streamed straight from ``os.scandir()`` and inserted
+        ``batch_size`` at a time, so memory use doesn't grow with the
+        size of the tree. The raw bytes are kept as they are, any codec
+        can read them back.
+        """
+        total = 0
+        batch = []
+        for key_name, key_value, raw in storage.raw_blobs():
+            try:
+                data = self.codecs.load(raw)
+            except (CodecError, ValueError) as e:
+                logger.error(f"skipping {key_name}/{key_value}: {e}")
+                continue
+
+            batch.append((key_name, key_value, data, raw))
+            if len(batch) >= batch_size:
+                total += self.add_many(batch)
+                batch = []
+                logger.info(f"migrated {total} messages into {self.path}")
+
+        if batch:
+            total += self.add_many(batch)
+
+        logger.info(f"migrated {total} messages into {self.path}")
+        return total
@@ -0,0 +1,463 @@
+import time
+import asyncio
+import logging
+from pathlib import Path
+from functools import partial
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from aiohttp import web
+except ImportError:  # pragma: no cover
+    web = None
+
+from shortage import config
+from shortage.dispatch import NotificationSpool
+from shortage.events import SubscriberDropped, default_broadcaster, replay
+from shortage.metrics import (
+    NOTIFICATIONS,
+    QUEUE_DEPTH,
+    STAGE_SECONDS,
+    registry,
+)
+from shortage.web.signature import TwilioSignature, bearer_token_matches
+from shortage.ingest import (
+    serialize_request,
+    store_message,
+    notification_for,
+    empty_twiml,
+    show_desktop_notification,
+)
+
+logger = logging.getLogger(__name__)
+
+
+FORM_TYPES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+# milliseconds an EventSource waits before reconnecting
+STREAM_RETRY = 2000
+
+
+class AsyncNotifier(object):
+    """asyncio counterpart of
+    :py:class:`~shortage.dispatch.NotificationDispatcher`.
+
+    Notifications are spooled the same way, so both servers can share
+    a spool, but they are delivered by tasks of the event loop with a
+    non-blocking client instead of by a pool of threads.
+    """
+
+    def __init__(
+        self,
+        deliver: Callable,
+        spool: NotificationSpool,
+        executor,
+        workers: int = 2,
+        maxsize: int = 1000,
+        scan_interval: float = 30.0,
+        drain_timeout: float = 5.0,
+    ):
+        self.deliver = deliver
+        self.spool = spool
+        self.executor = executor
+        self.workers = max(1, int(workers))
+        self.maxsize = int(maxsize)
+        self.scan_interval = float(scan_interval)
+        self.drain_timeout = float(drain_timeout)
+        self.queue = None
+        self.tasks = []
+
+    @classmethod
+    def from_config(cls, executor):
+        from shortage.networking.aio import AsyncPushOverClient
+
+        client = AsyncPushOverClient(
+            token=config.PUSHOVER_API_TOKEN,
+            user_key=config.PUSHOVER_API_USER_KEY,
+            base_url=config.PUSHOVER_API_URL,
+            pool_size=config.PUSHOVER_POOL_SIZE,
+            max_retries=config.PUSHOVER_MAX_RETRIES,
+            backoff_factor=config.PUSHOVER_BACKOFF_FACTOR,
+            timeout=config.PUSHOVER_TIMEOUT,
+        )
+
+        async def deliver(body, title):
+            await client.send_notification(body, title)
+            await asyncio.get_running_loop().run_in_executor(
+                executor, show_desktop_notification, body, title
+            )
+
+        notifier = cls(
+            deliver,
+            NotificationSpool(
+                config.NOTIFICATION_SPOOL_PATH,
+                max_attempts=config.NOTIFICATION_MAX_ATTEMPTS,
+                backoff=config.NOTIFICATION_RETRY_BACKOFF,
+            ),
+            executor,
+            workers=config.NOTIFICATION_WORKERS,
+            maxsize=config.NOTIFICATION_QUEUE_SIZE,
+            drain_timeout=config.NOTIFICATION_DRAIN_TIMEOUT,
+        )
+        notifier.client = client
+        return notifier
+
+    async def blocking(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.tasks = [
+            asyncio.create_task(self.work()) for _ in range(self.workers)
+        ]
+        await self.scan()
+
+    def enqueue(self, path: Path) -> bool:
+        try:
+            self.queue.put_nowait(path)
+        except asyncio.QueueFull:
+            logger.warning(
+                f"notification queue is full, leaving {path.name} in spool"
+            )
+            return False
+        QUEUE_DEPTH.labels("notifications").set(self.queue.qsize())
+        return True
+
+    async def scan(self):
+        for path in await self.blocking(self.spool.pending):
+            if not self.enqueue(path):
+                break
+
+    async def work(self):
+        while True:
+            try:
+                path = await asyncio.wait_for(
+                    self.queue.get(), self.scan_interval
+                )
+            except asyncio.TimeoutError:
+                await self.scan()
+                continue
+
+            QUEUE_DEPTH.labels("notifications").set(self.queue.qsize())
+            try:
+                await self.process(path)
+            finally:
+                self.queue.task_done()
+
+    async def process(self, path: Path):
+        claimed = await self.blocking(self.spool.claim, path)
+        if not claimed:
+            return
+
+        try:
+            payload = await self.blocking(self.spool.load, claimed)
+        except (OSError, ValueError) as e:
+            logger.error(f"dropping unreadable notification {path}: {e}")
+            await self.blocking(self.spool.remove, claimed)
+            return
+
+        try:
+            with STAGE_SECONDS.labels("notify").time():
+                await self.deliver(**payload)
+        except Exception as e:
+            logger.exception(f"failed to deliver notification {path}: {e}")
+            NOTIFICATIONS.labels("failed").inc()
+            if not await self.blocking(self.spool.retry, claimed):
+                NOTIFICATIONS.labels("dead").inc()
+            return
+
+        NOTIFICATIONS.labels("sent").inc()
+        await self.blocking(self.spool.remove, claimed)
+
+    async def stop(self, timeout: float = None):
+        """waits up to ``timeout`` seconds for the queue to drain,
+        whatever is left stays in the spool"""
+        timeout = self.drain_timeout if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.queue.qsize()} notifications left in spool")
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        client = getattr(self, "client", None)
+        if client is not None:
+            await client.close()
+
+
+class LoopWaker(object):
+    """wakes the event streams of an event loop from the thread of the
+    :py:class:`~shortage.events.Broadcaster`, one future at a time for
+    all of them"""
+
+    def __init__(self):
+        self.loop = None
+        self.future = None
+
+    def start(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def wake(self):
+        future, self.future = self.future, self.loop.create_future()
+        future.set_result(None)
+
+    def notify(self):
+        try:
+            self.loop.call_soon_threadsafe(self.wake)
+        except RuntimeError:
+            # the loop was closed
+            pass
+
+
+def app_key(name: str, kind: type):
+    # typed application keys only exist since aiohttp 3.9
+    if web is not None and hasattr(web, "AppKey"):
+        return web.AppKey(name, kind)
+    return name
+
+
+EXECUTOR = app_key("executor", ThreadPoolExecutor)
+NOTIFIER = app_key("notifier", AsyncNotifier)
+WAKER = app_key("waker", LoopWaker)
+
+
+def first_values(multidict) -> dict:
+    """like werkzeug's ``MultiDict.to_dict()``: the first value of
+    every key"""
+    values = {}
+    for key, value in multidict.items():
+        if isinstance(value, str):
+            values.setdefault(key, value)
+    return values
+
+
+def store_and_spool(message, deduplicate: bool, spool: NotificationSpool):
+    if store_message(message, deduplicate) is None:
+        return None
+    return spool.put(notification_for(message))
+
+
+def signature_middleware(signature: TwilioSignature, paths):
+    """the aiohttp counterpart of
+    :py:class:`~shortage.web.signature.SignatureMiddleware`"""
+    paths = frozenset(paths)
+
+    @web.middleware
+    async def check_signature(request, handler):
+        if request.path not in paths:
+            return await handler(request)
+
+        value = request.headers.get("X-Twilio-Signature")
+        if not value:
+            signature.count("unsigned")
+            raise web.HTTPForbidden()
+
+        started = time.perf_counter()
+        url = request.url
+        proto = request.headers.get("X-Forwarded-Proto")
+        if proto:
+            url = url.with_scheme(proto)
+
+        body = await request.read()
+        valid = signature.validate_request(
+            str(url), request.content_type, body, value
+        )
+        STAGE_SECONDS.labels("validate").observe(
+            time.perf_counter() - started
+        )
+        if not valid:
+            raise web.HTTPForbidden()
+        return await handler(request)
+
+    return check_signature
+
+
+async def handle_webhook(request, deduplicate=True):
+    started = time.perf_counter()
+    body = await request.read()
+    form = {}
+    if request.content_type in FORM_TYPES:
+        form = first_values(await request.post())
+
+    message = serialize_request(
+        request.method,
+        str(request.url),
+        body,
+        form,
+        first_values(request.query),
+    )
+    STAGE_SECONDS.labels("parse").observe(time.perf_counter() - started)
+    app = request.app
+    notifier = app[NOTIFIER]
+    path = await asyncio.get_running_loop().run_in_executor(
+        app[EXECUTOR], store_and_spool, message, deduplicate, notifier.spool
+    )
+    if path is not None:
+        notifier.enqueue(path)
+
+    return web.Response(
+        body=empty_twiml().encode("utf-8"),
+        headers={"Content-Type": "application/xml"},
+    )
+
+
+async def handle_metrics(request):
+    exposition = await asyncio.get_running_loop().run_in_executor(
+        request.app[EXECUTOR], registry.expose
+    )
+    return web.Response(
+        text=exposition, content_type="text/plain", charset="utf-8"
+    )
+
+
+def last_event_id(request):
+    value = request.headers.get("Last-Event-ID") or request.query.get(
+        "last_event_id"
+    )
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"invalid Last-Event-ID: {value!r}")
+
+
+def require_reader(request):
+    """like the flask app, messages are served with the api or the
+    admin token only"""
+    tokens = [config.API_TOKEN, config.ADMIN_TOKEN]
+    tokens = [token for token in tokens if token]
+    if not tokens:
+        raise web.HTTPNotFound()
+    authorization = request.headers.get("Authorization")
+    if not bearer_token_matches(authorization, tokens):
+        raise web.HTTPForbidden()
+
+
+async def handle_stream(request):
+    """the aiohttp counterpart of GET /sms/stream, open streams only
+    cost a task waiting on the future of the :py:class:`LoopWaker`"""
+    require_reader(request)
+    sender = request.query.get("from")
+    recipient = request.query.get("to")
+    resume_from = last_event_id(request)
+    keepalive = config.SMS_STREAM_KEEPALIVE
+    app = request.app
+
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await response.prepare(request)
+
+    def write(frame: str):
+        return response.write(frame.encode("utf-8"))
+
+    with default_broadcaster().subscribe(sender, recipient) as subscription:
+        await write(f"retry: {STREAM_RETRY}\n\n")
+        last = 0
+        if resume_from is not None:
+            frames = await asyncio.get_running_loop().run_in_executor(
+                app[EXECUTOR],
+                lambda: list(
+                    replay(
+                        resume_from,
+                        sender,
+                        recipient,
+                        config.SMS_STREAM_REPLAY,
+                    )
+                ),
+            )
+            for id, frame in frames:
+                last = id
+                await write(frame)
+
+        written = time.monotonic()
+        try:
+            while True:
+                changed = app[WAKER].future
+                events = [e for e in subscription.poll() if e.id > last]
+                for event in events:
+                    await write(event.frame)
+                if events:
+                    written = time.monotonic()
+                    continue
+
+                remaining = written + keepalive - time.monotonic()
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(changed), max(remaining, 0)
+                    )
+                except asyncio.TimeoutError:
+                    await write(": keepalive\n\n")
+                    written = time.monotonic()
+        except SubscriberDropped as e:
+            logger.warning(f"dropped slow event stream: {e}")
+            await write("event: dropped\ndata: {}\n\n")
+
+    return response
+
+
+async def start_notifier(app):
+    app[WAKER].start(asyncio.get_running_loop())
+    default_broadcaster().add_waker(app[WAKER].notify)
+    await app[NOTIFIER].start()
+
+
+async def stop_notifier(app):
+    default_broadcaster().remove_waker(app[WAKER].notify)
+    await app[NOTIFIER].stop()
+    app[EXECUTOR].shutdown(wait=True)
+
+
+def create_app(executor=None, notifier=None, signature=None):
+    """the webhook routes of the flask app, served from an asyncio
+    event loop. Storage writes run in ``executor``."""
+    if web is None:
+        raise RuntimeError("the async server requires shortage-app[async]")
+
+    if signature is None and config.TWILIO_AUTH_TOKEN:
+        signature = TwilioSignature(config.TWILIO_AUTH_TOKEN)
+
+    middlewares = []
+    if signature is not None:
+        middlewares.append(
+            signature_middleware(signature, config.TWILIO_SIGNED_PATHS)
+        )
+
+    app = web.Application(middlewares=middlewares)
+    app[EXECUTOR] = executor or ThreadPoolExecutor(
+        config.WEB_ASYNC_STORAGE_WORKERS,
+        thread_name_prefix="shortage-storage",
+    )
+    app[NOTIFIER] = notifier or AsyncNotifier.from_config(app[EXECUTOR])
+    app[WAKER] = LoopWaker()
+    app.on_startup.append(start_notifier)
+    app.on_cleanup.append(stop_notifier)
+
+    # status callbacks reuse the sid of their message, so they are
+    # never deduplicated
+    for path, deduplicate in (
+        ("/sms/in", True),
+        ("/sms/status", False),
+        ("/sms/fallback", True),
+    ):
+        handler = partial(handle_webhook, deduplicate=deduplicate)
+        app.router.add_route("GET", path, handler)
+        app.router.add_route("POST", path, handler)
+
+    app.router.add_get("/sms/stream", handle_stream)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def run(host: str = "127.0.0.1", port: int = 3000):
+    web.run_app(create_app(), host=host, port=port, backlog=2048)
@@ -1,18 +1,33 @@
-import time
-
-try:
-    import pync
-except:  # noqa
-    pync = None
-
+import os
+import json
+import base64
+import hashlib
 import logging
-from datetime import datetime
 from pathlib import Path
-from flask import Response
-from twilio.twiml.messaging_response import MessagingResponse
+from flask import Response, request, abort
+from werkzeug.http import http_date
 
+from shortage.dispatch import NotificationDispatcher
 from shortage.filesystem import default_storage, slugify  # noqa
-from .base import app, serialized_flask_request, validate_twilio_request
+from shortage.indexes import default_index
+from shortage.dedup import default_deduplicator
+from shortage.records import MessageRecord
+from shortage.events import (
+    SubscriberDropped,
+    default_broadcaster,
+    message_json,
+    replay,
+)
+from shortage.metrics import registry
+from shortage.web.signature import bearer_token_matches
+from shortage.ingest import (
+    store_message,
+    notification_for,
+    empty_twiml,
+    show_desktop_notification,
+)
+from .base import app, serialized_flask_request
+from . import base
 
 
 logger = logging.getLogger(__name__)
@@ -27,69 +42,39 @@ logger = logging.getLogger(__name__)
 #         logger.error(f'cannot retrieve PUSHOVER_API_TOKEN from config')
 
 
-class MessageData(object):
-    __required_keys__ = ("Body", "From", "To")
-
-    __optional_keys__ = (
-        "ApiVersion",
-        "MessageSid",
-        "SmsStatus",
-        "SmsSid",
-        "MessagingServiceSid",
-        "AccountSid",
-        "MessageStatus",
-    )
+def default_sms_handling(deduplicate=True):
+    store_sms_request(deduplicate=deduplicate)
+    return Response(empty_twiml(), headers={"Content-Type": "application/xml"})
 
-    def __init__(self, request_data: dict):
-        self.data = dict(request_data)
-        self.data["requested_at"] = datetime.utcnow().isoformat()
-        for key in self.__required_keys__:
-            value = self.data.get(key)
-            if not value:
-                logger.error(
-                    f"missing required key {key} from response: {self.data}"
-                )
-            setattr(self, key, value)
-
-        for key in self.__optional_keys__:
-            value = self.data.get(key)
-            setattr(self, key, value)
 
+def show_notification(body, title):
+    app.pushover.send_notification(body, title)
+    show_desktop_notification(body, title)
 
-def default_sms_handling():
-    store_sms_request()
-    resp = MessagingResponse()
-    # resp.message("Ahoy! Thanks so much for your message.")
-    return Response(str(resp), headers={"Content-Type": "application/xml"})
 
+notifications = NotificationDispatcher.from_config(
+    app.config, deliver=show_notification
+)
 
-def show_notification(body, title):
-    app.pushover.send_notification(body, title)
-    if not pync:
-        logger.info(f"{title} - {body}")
-        return
 
-    try:
-        pync.notify(body, title=title)
-    except Exception as err:
-        logger.debug(
-            f'failed to show notification "{body}" (title={title}) - {err}'
-        )
+@app.before_request
+def start_notification_dispatcher():
+    # started from the main thread by shortage.wsgi and `shortage web`,
+    # this only restarts the worker threads of servers forking without
+    # telling us
+    notifications.start()
 
 
-def store_sms_request() -> Path:
-    storage = default_storage()
-    logger.debug(f"storing SMS request")
-    timestamp = str(time.time())
-    raw = serialized_flask_request()
-    message = MessageData(raw["data"])
+def store_sms_request(deduplicate=True) -> Path:
+    message = serialized_flask_request()
+    path = store_message(message, deduplicate)
+    if path is None:
+        return None
 
-    show_notification(message.Body, title=f"{message.To} SMS")
-    key = message.To or "webhook"
-    return storage.add(key, timestamp, raw)
+    notifications.submit(**notification_for(message))
+    return path
 
 
-@validate_twilio_request
 @app.route("/sms/in", methods=["GET", "POST"])
 def handle_sms_in():
     logger.warning("/sms/in")
@@ -99,7 +84,7 @@ def handle_sms_in():
 @app.route("/sms/status", methods=["GET", "POST"])
 def handle_status():
     logger.warning("/sms/status")
-    return default_sms_handling()
+    return default_sms_handling(deduplicate=False)
 
 
 @app.route("/sms/fallback", methods=["GET", "POST"])
@@ -108,7 +93,388 @@ def handle_sms_fallback():
     return default_sms_handling()
 
 
+def encode_cursor(received_at: float, id: int) -> str:
+    position = f"{received_at!r}:{id}".encode("ascii")
+    return base64.urlsafe_b64encode(position).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        received_at, id = position.decode("ascii").split(":")
+        return float(received_at), int(id)
+    except (ValueError, UnicodeError):
+        abort(400, description=f"invalid cursor: {cursor!r}")
+
+
+def message_to_json(entry, blob) -> dict:
+    record = MessageRecord.from_blob(blob) if blob is not None else None
+    return message_json(entry, record)
+
+
+def not_modified(etag: str, last_modified: float):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    since = request.if_modified_since
+    return bool(since) and int(last_modified) <= since.timestamp()
+
+
+def conditional_headers(etag: str, last_modified: float) -> dict:
+    return {
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(last_modified),
+        "Cache-Control": "no-cache",
+    }
+
+
+@app.route("/sms/messages", methods=["GET"])
+def list_messages():
+    require_reader()
+    sender = request.args.get("from")
+    recipient = request.args.get("to")
+    cursor = request.args.get("cursor")
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    before = decode_cursor(cursor) if cursor else None
+
+    index = default_index()
+    latest = index.latest(sender, recipient)
+    state = f"{request.query_string!r}:{latest and latest.id}"
+    etag = hashlib.sha1(state.encode("utf-8")).hexdigest()
+    last_modified = latest.received_at if latest else 0
+    headers = conditional_headers(etag, last_modified)
+    if not_modified(etag, last_modified):
+        return Response(status=304, headers=headers)
+
+    entries = index.page(sender, recipient, before, limit + 1)
+    return messages_page(entries, limit, headers)
+
+
+def messages_page(entries: list, limit: int, headers: dict = None):
+    """streams the first ``limit`` entries, with the cursor of the
+    next page when there are more"""
+    next_cursor = None
+    if len(entries) > limit:
+        last = entries[limit - 1]
+        next_cursor = encode_cursor(last.received_at, last.id)
+    storage = default_storage()
+
+    def stream():
+        yield '{"messages": ['
+        for position, entry in enumerate(entries[:limit]):
+            blob = storage.get(entry.key_name, entry.key_value)
+            if position:
+                yield ", "
+            yield json.dumps(message_to_json(entry, blob), default=str)
+
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return Response(stream(), mimetype="application/json", headers=headers)
+
+
+def thread_to_json(thread) -> dict:
+    last_message = None
+    if thread.last_received_at is not None:
+        last_message = {
+            "sid": thread.last_sid,
+            "from": thread.last_sender,
+            "body": thread.last_body,
+            "received_at": thread.last_received_at,
+        }
+    return {
+        "id": thread.id,
+        "participants": [thread.participant_a, thread.participant_b],
+        "message_count": thread.message_count,
+        "unread_count": thread.unread_count,
+        "last_message": last_message,
+    }
+
+
+@app.route("/sms/threads", methods=["GET"])
+def list_threads():
+    """conversations, most recently active first, read from their
+    summaries without touching the messages"""
+    require_reader()
+    cursor = request.args.get("cursor")
+    unread = request.args.get("unread", "").lower() in ("1", "true", "yes")
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    before = decode_cursor(cursor) if cursor else None
+
+    threads = default_index().threads(before, unread, limit + 1)
+    next_cursor = None
+    if len(threads) > limit:
+        last = threads[limit - 1]
+        next_cursor = encode_cursor(last.last_received_at, last.id)
+
+    return {
+        "threads": [thread_to_json(thread) for thread in threads[:limit]],
+        "next_cursor": next_cursor,
+    }
+
+
+def thread_or_404(id: int):
+    thread = default_index().thread(id)
+    if not thread:
+        abort(404)
+    return thread
+
+
+@app.route("/sms/threads/<int:id>", methods=["GET"])
+def retrieve_thread(id):
+    require_reader()
+    return thread_to_json(thread_or_404(id))
+
+
+@app.route("/sms/threads/<int:id>/messages", methods=["GET"])
+def list_thread_messages(id):
+    require_reader()
+    thread_or_404(id)
+    cursor = request.args.get("cursor")
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    before = decode_cursor(cursor) if cursor else None
+
+    entries = default_index().page(
+        before=before, limit=limit + 1, thread_id=id
+    )
+    return messages_page(entries, limit)
+
+
+@app.route("/sms/threads/<int:id>/read", methods=["POST"])
+def mark_thread_read(id):
+    require_reader()
+    thread_or_404(id)
+    return thread_to_json(default_index().mark_read(id))
+
+
+@app.route("/sms/messages/<sid>", methods=["GET"])
+def retrieve_message(sid):
+    require_reader()
+    entry = default_index().by_sid(sid)
+    if not entry:
+        abort(404)
+
+    etag = hashlib.sha1(
+        f"{entry.key_name}:{entry.key_value}".encode("utf-8")
+    ).hexdigest()
+    headers = conditional_headers(etag, entry.received_at)
+    if not_modified(etag, entry.received_at):
+        return Response(status=304, headers=headers)
+
+    blob = default_storage().get(entry.key_name, entry.key_value)
+    if blob is None:
+        abort(404)
+
+    return Response(
+        json.dumps(message_to_json(entry, blob), default=str),
+        mimetype="application/json",
+        headers=headers,
+    )
+
+
+def encode_offset(offset: int) -> str:
+    return base64.urlsafe_b64encode(str(offset).encode("ascii")).decode()
+
+
+def decode_offset(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        abort(400, description=f"invalid cursor: {cursor!r}")
+
+
+@app.route("/sms/search", methods=["GET"])
+def search_messages():
+    require_reader()
+    query = request.args.get("q", "").strip()
+    if not query:
+        abort(400, description="missing search query: ?q=")
+
+    cursor = request.args.get("cursor")
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    offset = decode_offset(cursor) if cursor else 0
+
+    results = default_index().search(query, limit + 1, offset)
+    next_cursor = None
+    if len(results) > limit:
+        next_cursor = encode_offset(offset + limit)
+    storage = default_storage()
+
+    def stream():
+        yield '{"messages": ['
+        for position, (entry, snippet) in enumerate(results[:limit]):
+            blob = storage.get(entry.key_name, entry.key_value)
+            message = message_to_json(entry, blob)
+            message["snippet"] = snippet
+            if position:
+                yield ", "
+            yield json.dumps(message, default=str)
+
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return Response(stream(), mimetype="application/json")
+
+
+def last_event_id():
+    """where a reconnecting EventSource resumes, the query string is
+    for clients that can't set headers"""
+    value = request.headers.get("Last-Event-ID") or request.args.get(
+        "last_event_id"
+    )
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, description=f"invalid Last-Event-ID: {value!r}")
+
+
+# milliseconds an EventSource waits before reconnecting
+STREAM_RETRY = 2000
+
+
+@app.route("/sms/stream", methods=["GET"])
+def stream_messages():
+    """server-sent events of the messages stored by this process from
+    now on, preceded by the ones stored since ``Last-Event-ID``.
+
+    Each open stream holds a worker thread, which sleeps until the
+    broadcaster has new messages, so the process refuses streams past
+    ``SMS_STREAM_LIMIT`` to keep threads for the webhooks.
+    """
+    require_reader()
+    sender = request.args.get("from")
+    recipient = request.args.get("to")
+    resume_from = last_event_id()
+    keepalive = app.config["SMS_STREAM_KEEPALIVE"]
+    limit = app.config["SMS_STREAM_REPLAY"]
+    subscription = default_broadcaster().subscribe(
+        sender, recipient, app.config["SMS_STREAM_LIMIT"]
+    )
+    if subscription is None:
+        return Response(
+            "too many open streams, use shortage web --async\n",
+            status=503,
+            mimetype="text/plain",
+            headers={"Retry-After": str(STREAM_RETRY // 1000)},
+        )
+
+    def stream():
+        with subscription:
+            yield f"retry: {STREAM_RETRY}\n\n"
+            last = 0
+            if resume_from is not None:
+                for id, frame in replay(resume_from, sender, recipient, limit):
+                    last = id
+                    yield frame
+
+            try:
+                while True:
+                    events = subscription.wait(keepalive)
+                    if not events:
+                        yield ": keepalive\n\n"
+                    for event in events:
+                        if event.id > last:
+                            yield event.frame
+            except SubscriberDropped as e:
+                logger.warning(f"dropped slow event stream: {e}")
+                yield "event: dropped\ndata: {}\n\n"
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # the stream may be closed before it was ever iterated
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.route("/sms/dedup", methods=["GET"])
+def dedup_stats():
+    return default_deduplicator().stats()
+
+
+@app.route("/sms/signatures", methods=["GET"])
+def signature_stats():
+    if base.twilio_signature is None:
+        return {"enabled": False}
+    return dict(base.twilio_signature.stats(), enabled=True)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(
+        registry.expose(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+def require_token(*names: str):
+    tokens = [app.config.get(name) for name in names]
+    tokens = [token for token in tokens if token]
+    if not tokens:
+        abort(404)
+
+    authorization = request.headers.get("Authorization")
+    if not bearer_token_matches(authorization, tokens):
+        abort(403)
+
+
+def require_admin():
+    require_token("ADMIN_TOKEN")
+
+
+def require_reader():
+    """message bodies hold one-time codes, they are only served with
+    the api or the admin token"""
+    require_token("API_TOKEN", "ADMIN_TOKEN")
+
+
+def profiler_status() -> dict:
+    profiler = app.profiler
+    return {
+        "pid": os.getpid(),
+        "running": profiler.running,
+        "until": profiler.until if profiler.running else None,
+        "last": profiler.last and profiler.last.name,
+        "profiles": profiler.profiles(),
+    }
+
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    """starts sampling the worker that answers for ?seconds=, uwsgi
+    workers can be targeted one by one with PROFILE_SIGNAL instead"""
+    require_admin()
+    if request.method == "GET":
+        return profiler_status()
+
+    seconds = request.args.get(
+        "seconds", app.config["PROFILE_SECONDS"], type=float
+    )
+    if not app.profile(seconds):
+        return dict(profiler_status(), error="already profiling"), 409
+    return profiler_status(), 202
+
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     logger.warning("/")
-    return {"endpoints": ["/sms/in", "/sms/status", "/sms/fallback"]}
+    return {
+        "endpoints": [
+            "/sms/in",
+            "/sms/status",
+            "/sms/fallback",
+            "/sms/messages",
+            "/sms/messages/<sid>",
+            "/sms/threads",
+            "/sms/threads/<id>",
+            "/sms/threads/<id>/messages",
+            "/sms/threads/<id>/read",
+            "/sms/search",
+            "/sms/stream",
+            "/sms/dedup",
+            "/sms/signatures",
+            "/metrics",
+        ]
+    }
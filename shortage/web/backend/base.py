@@ -1,122 +1,99 @@
-import time
-import json
+import signal
 import logging
-from collections import OrderedDict
+import threading
 from functools import wraps
-from twilio.request_validator import RequestValidator
 from flask import Flask, request, abort
-from pathlib import Path
-from flask_restplus import Resource, Api  # noqa
-from twilio.twiml.messaging_response import MessagingResponse
 
-from shortage.filesystem import default_storage
-from shortage.networking import PushOverClient
+from shortage.ingest import serialize_request
+from shortage.web.signature import TwilioSignature, SignatureMiddleware
+from shortage.metrics import STAGE_SECONDS
+from shortage.profiling import SamplingProfiler
+from shortage.config import PROFILE_MAX_SECONDS
+
+logger = logging.getLogger(__name__)
 
 
 class Application(Flask):
     def __init__(self):
         super().__init__(__name__)
         self.config.from_object("shortage.config")
+        self.profiler = SamplingProfiler(
+            self.config["SMS_PROFILES_PATH"],
+            interval=self.config["PROFILE_INTERVAL"],
+        )
+        self.install_profile_signal(self.config.get("PROFILE_SIGNAL"))
+
+    def install_profile_signal(self, name: str):
+        """starts a profile of PROFILE_SECONDS when the process receives
+        the signal ``name``, e.g. ``kill -USR2 <worker pid>``"""
+        if not name:
+            return
+        if threading.current_thread() is not threading.main_thread():
+            logger.debug(f"not handling {name} outside of the main thread")
+            return
+
+        def handle_signal(signum, frame):
+            self.profile(self.config["PROFILE_SECONDS"])
+
+        signal.signal(getattr(signal, name), handle_signal)
+
+    def profile(self, seconds: float) -> bool:
+        seconds = min(max(float(seconds), 0.1), PROFILE_MAX_SECONDS)
+        return self.profiler.start(seconds)
 
     @property
     def pushover(self):
-        token = self.config.get('PUSHOVER_API_TOKEN')
-        user_key = self.config.get('PUSHOVER_API_USER_KEY')
-        config = json.dumps(dict(self.config.items()), indent=4, default=str)
-        logger.info(f'CONFIG: {config}')
-        return PushOverClient(token=token, user_key=user_key)
+        from shortage.networking import get_pushover_client
+
+        return get_pushover_client(
+            token=self.config.get('PUSHOVER_API_TOKEN'),
+            user_key=self.config.get('PUSHOVER_API_USER_KEY'),
+            base_url=self.config.get('PUSHOVER_API_URL'),
+            pool_size=self.config.get('PUSHOVER_POOL_SIZE'),
+            max_retries=self.config.get('PUSHOVER_MAX_RETRIES'),
+            backoff_factor=self.config.get('PUSHOVER_BACKOFF_FACTOR'),
+            timeout=self.config.get('PUSHOVER_TIMEOUT'),
+        )
 
 
 app = Application()
 
-
-# api = Api(
-#     app,
-#     version='1.0',
-#     title='Shortage',
-#     description='SMS Inbox as a service',
-# )
-# sms = api.namespace('sms', description='Twilio Webhooks')
-
-logger = logging.getLogger(__name__)
+# validated before flask builds the request, see SignatureMiddleware
+twilio_signature = None
+if app.config.get("TWILIO_AUTH_TOKEN"):
+    twilio_signature = TwilioSignature(app.config["TWILIO_AUTH_TOKEN"])
+    app.wsgi_app = SignatureMiddleware(
+        app.wsgi_app, twilio_signature, app.config["TWILIO_SIGNED_PATHS"]
+    )
 
 
 def serialized_flask_request():
-    url = getattr(request, "url", None)
-    method = getattr(request, "method", None)
-    data = OrderedDict()
-
-    if method:
-        data["method"] = method
-
-    if url:
-        data["url"] = url
-
-    data["data"] = {}
-    data["form"] = request.form
-    data["args"] = request.args
-    data["values"] = request.values
-    data["headers"] = dict(request.headers)
-
-    raw = request.data
-    if isinstance(raw, bytes):
-        try:
-            data["data"] = json.loads(str(request.data.decode('utf-8')))
-        except Exception as e:
-            data["data"] = {'raw': raw}
-            logger.warning(f'failed to parse json from bytes: {raw!r}: {e}')
-    elif isinstance(request.data, str):
-        try:
-            data["data"] = request.json()
-        except Exception as e:
-            logger.warning(f'failed to parse json from string: {raw!r}: {e}')
-            data["data"] = {'raw': raw}
-
-    elif request.values:
-        data["data"] = dict(request.values)
-    elif request.form:
-        data["data"] = dict(request.form)
-
-    if request.args:
-        data["args"] = request.args
-
-    return data
-
-
-class StorageAwareResource(Resource):
-    def __init__(self, *args, **kw):
-        super().__init__(*args, **kw)
-        self.storage = default_storage()
-
-    def default_sms_handling(self):
-        self.store_sms_request()
-        return self.respond()
-
-    def store_sms_request(self) -> Path:
-        logger.debug(f"storing SMS request")
-        timestamp = str(time.time())
-        data = serialized_flask_request()
-        return self.storage.add("sms", timestamp, data)
-
-    def respond(self, **kw):
-        resp = MessagingResponse()
-        # resp.message("Ahoy! Thanks so much for your message.")
-        return str(resp)
+    with STAGE_SECONDS.labels("parse").time():
+        # read the body before the form, werkzeug parses the form from
+        # the cached body then
+        body = request.get_data()
+        return serialize_request(
+            getattr(request, "method", None),
+            getattr(request, "url", None),
+            body,
+            request.form.to_dict(),
+            request.args.to_dict(),
+        )
 
 
 def validate_twilio_request(f):
-    """Validates that incoming requests genuinely originated from Twilio"""
+    """Validates that incoming requests genuinely originated from Twilio,
+    for routes outside of TWILIO_SIGNED_PATHS"""
 
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Create an instance of the RequestValidator class
-        validator = RequestValidator(app.config.get("TWILIO_AUTH_TOKEN"))
+        if twilio_signature is None:
+            return abort(403)
 
-        # Validate the request using its URL, POST data,
-        # and X-TWILIO-SIGNATURE header
-        request_valid = validator.validate(
+        request_valid = twilio_signature.validate_request(
             request.url,
-            request.form,
+            request.content_type,
+            request.get_data(),
             request.headers.get("X-TWILIO-SIGNATURE", ""),
         )
 
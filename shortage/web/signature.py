@@ -0,0 +1,166 @@
+import io
+import hmac
+import base64
+import hashlib
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs
+from wsgiref.util import request_uri
+
+from shortage.metrics import SIGNATURES, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+FORM_TYPE = "application/x-www-form-urlencoded"
+
+
+def bearer_token_matches(authorization: str, tokens) -> bool:
+    """compares an ``Authorization`` header to every accepted token in
+    constant time"""
+    given = (authorization or "").encode("utf-8")
+    matched = False
+    for token in tokens:
+        expected = f"Bearer {token}".encode("utf-8")
+        matched |= hmac.compare_digest(given, expected)
+    return matched
+
+
+def url_variants(url: str):
+    """twilio signs the url as it was configured, with or without the
+    default port, so both have to be tried"""
+    parts = urlsplit(url)
+    default = "443" if parts.scheme == "https" else "80"
+    host = parts.netloc.rsplit(":", 1)[0] if parts.port else parts.netloc
+    without_port = parts._replace(netloc=host).geturl()
+    with_port = parts._replace(
+        netloc=f"{host}:{parts.port or default}"
+    ).geturl()
+    return without_port, with_port
+
+
+class TwilioSignature(object):
+    """validates ``X-Twilio-Signature`` headers.
+
+    The HMAC-SHA1 is keyed once with the auth token and copied for
+    every request. Counters keep track of what was rejected.
+    """
+
+    def __init__(self, auth_token: str):
+        key = auth_token.encode("utf-8")
+        self.mac = hmac.new(key, digestmod=hashlib.sha1)
+        self.lock = threading.Lock()
+        self.counters = {"accepted": 0, "unsigned": 0, "invalid": 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+        SIGNATURES.labels(name).inc()
+
+    def compute(self, url: str, params: dict) -> str:
+        mac = self.mac.copy()
+        mac.update(url.encode("utf-8"))
+        for name in sorted(params):
+            for value in sorted(set(params[name])):
+                mac.update(f"{name}{value}".encode("utf-8"))
+        return base64.b64encode(mac.digest()).decode("ascii")
+
+    def validate(self, url: str, params: dict, body: bytes, signature):
+        """``params`` maps names to lists of values, like
+        :py:func:`urllib.parse.parse_qs`"""
+        if not signature:
+            self.count("unsigned")
+            return False
+
+        # json bodies are signed through a hash in the query string
+        body_hash = parse_qs(urlsplit(url).query).get("bodySHA256")
+        valid_body = True
+        if body_hash:
+            computed = hashlib.sha256(body).hexdigest()
+            valid_body = hmac.compare_digest(computed, body_hash[0])
+            params = {}
+
+        valid = valid_body and any(
+            hmac.compare_digest(self.compute(variant, params), signature)
+            for variant in url_variants(url)
+        )
+        self.count("accepted" if valid else "invalid")
+        return valid
+
+    def validate_request(self, url, content_type, body, signature) -> bool:
+        params = {}
+        if body and (content_type or "").startswith(FORM_TYPE):
+            params = parse_qs(
+                body.decode("utf-8", "replace"), keep_blank_values=True
+            )
+        return self.validate(url, params, body, signature)
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = dict(self.counters)
+        stats["rejected"] = stats["unsigned"] + stats["invalid"]
+        return stats
+
+
+class SignatureMiddleware(object):
+    """WSGI middleware answering 403 to webhook requests that are not
+    signed by twilio, before the wrapped app parses anything.
+
+    Unsigned requests are rejected without reading their body.
+    """
+
+    forbidden_headers = [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", "9"),
+    ]
+
+    def __init__(
+        self, app, signature: TwilioSignature, paths, max_body: int = 65536
+    ):
+        self.app = app
+        self.signature = signature
+        self.paths = frozenset(paths)
+        self.max_body = int(max_body)
+
+    def forbidden(self, start_response):
+        start_response("403 FORBIDDEN", list(self.forbidden_headers))
+        return [b"Forbidden"]
+
+    def url(self, environ) -> str:
+        # behind a proxy twilio signed the public https url
+        proto = environ.get("HTTP_X_FORWARDED_PROTO")
+        if proto:
+            environ = dict(environ, **{"wsgi.url_scheme": proto})
+        return request_uri(environ, include_query=True)
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") not in self.paths:
+            return self.app(environ, start_response)
+
+        signature = environ.get("HTTP_X_TWILIO_SIGNATURE")
+        if not signature:
+            self.signature.count("unsigned")
+            return self.forbidden(start_response)
+
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= self.max_body:
+            self.signature.count("invalid")
+            return self.forbidden(start_response)
+
+        with STAGE_SECONDS.labels("validate").time():
+            body = environ["wsgi.input"].read(length) if length else b""
+            environ["wsgi.input"] = io.BytesIO(body)
+            valid = self.signature.validate_request(
+                self.url(environ),
+                environ.get("CONTENT_TYPE"),
+                body,
+                signature,
+            )
+        if not valid:
+            logger.debug(f"rejected invalid signature: {self.url(environ)}")
+            return self.forbidden(start_response)
+
+        return self.app(environ, start_response)
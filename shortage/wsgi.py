@@ -1,4 +1,18 @@
-from shortage.web.backend import app as server
+from shortage.web.backend.api import app as server, notifications
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:  # not running under uwsgi
+    postfork = None
+
+
+if postfork is not None:
+
+    @postfork
+    def start_notification_dispatcher():
+        # runs in the main thread of every worker, where the SIGTERM
+        # handler draining the notifications can be installed
+        notifications.start()
 
 
 __all__ = ["server"]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import boto3
+from sure import expect
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_s3 as mock_aws
+
+from shortage.s3 import S3Storage
+
+
+def create_storage(**kw):
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    client = boto3.client("s3", region_name="us-east-1")
+    client.create_bucket(Bucket="shortage-tests")
+    return S3Storage("shortage-tests", client=client, **kw), client
+
+
+@mock_aws
+def test_s3_storage_batches_concurrent_messages():
+    ("S3Storage.add() should upload concurrent messages of a key "
+     "as a single batch object")
+
+    storage, client = create_storage(batch_size=50, max_wait=0.2)
+    threads = [
+        threading.Thread(
+            target=storage.add,
+            args=("+18482259319", f"{1000 + index}.5", {"Body": index}),
+        )
+        for index in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    objects = client.list_objects_v2(Bucket="shortage-tests")["Contents"]
+    expect(len(objects)).to.be.lower_than(20)
+    expect(storage.group_commit.stats()["writes"]).to.equal(20)
+
+    storage.keys().should.equal(["_18482259319"])
+    sorted(m["Body"] for m in storage.list_all("+18482259319")).should.equal(
+        list(range(20))
+    )
+
+
+@mock_aws
+def test_s3_storage_retrieve_single_message():
+    ("S3Storage.get() should read one message out of its batch")
+
+    storage, _ = create_storage(max_wait=0)
+    storage.add("inbox", "100.5", {"Body": "first"})
+    storage.add("inbox", "200.5", {"Body": "second"})
+    storage.add("outbox", "150.5", {"Body": "other key"})
+    storage.add("inbox", "a_b_c", {"Body": "underscores"})
+
+    storage.get("inbox", "200.5").should.equal({"Body": "second"})
+    storage.get("inbox", "a_b_c").should.equal({"Body": "underscores"})
+    storage.get("inbox", "150.5").should.be.none
+    storage.batches_of(["inbox", "outbox"])["outbox"].should.have.length_of(1)
+
+
+@mock_aws
+def test_s3_storage_get_lists_only_nearby_batches():
+    ("S3Storage.get() should start listing at the batches that can "
+     "hold the message and download only the one that does")
+
+    storage, client = create_storage(max_wait=0, span=60)
+    storage.upload_batch(
+        [("inbox", f"{1000 + index * 30}.5", b"{}") for index in range(40)]
+    )
+    storage.add("inbox", "1615.5", {"Body": "wanted"})
+    storage.add("inbox", "-5", {"Body": "negative"})
+    expect(len(storage.batches("inbox"))).to.be.greater_than(15)
+
+    calls = []
+    for operation in ("ListObjectsV2", "GetObject"):
+        client.meta.events.register(
+            f"before-parameter-build.s3.{operation}",
+            lambda model, params, **kw: calls.append(
+                (model.name, params.get("StartAfter"))
+            ),
+        )
+
+    storage.get("inbox", "1615.5").should.equal({"Body": "wanted"})
+    [name for name, _ in calls].should.equal(["ListObjectsV2", "GetObject"])
+    calls[0][1].should.contain("inbox/n")
+    storage.get("inbox", "-5").should.equal({"Body": "negative"})
+    storage.get("inbox", "1616.5").should.be.none
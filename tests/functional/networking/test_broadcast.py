@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from sure import expect
+from shortage.broadcast import (
+    Broadcast,
+    Checkpoint,
+    TokenBucket,
+    read_recipients,
+)
+from shortage.networking.messaging import TwilioMessagesClient
+
+
+class TwilioStandIn(ThreadingHTTPServer):
+    """local stand-in for api.twilio.com that accepts every message
+    except the ones sent to ``rejected``, answers 500 to ``broken``,
+    0.5s late to ``slow`` and 429 to the first ``throttled`` ones"""
+
+    daemon_threads = True
+
+    def __init__(self, rejected=(), broken=(), slow=(), throttled=0):
+        super().__init__(("127.0.0.1", 0), TwilioHandler)
+        self.rejected = set(rejected)
+        self.broken = set(broken)
+        self.slow = set(slow)
+        self.throttled = throttled
+        self.received = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address)
+
+
+class TwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        message = {key: values[0] for key, values in form.items()}
+        with self.server.lock:
+            self.server.received.append((self.path, message))
+            sid = f"SM{len(self.server.received)}"
+            throttled = self.server.throttled > 0
+            self.server.throttled -= 1
+
+        status = 201
+        if message["To"] in self.server.slow:
+            time.sleep(0.5)
+        if message["To"] in self.server.rejected:
+            status = 400
+        elif message["To"] in self.server.broken:
+            status = 500
+        elif throttled:
+            status = 429
+        body = json.dumps({"sid": sid}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def write_recipients(path, count):
+    with Path(path).open("w") as fd:
+        fd.write("to,body\n")
+        for index in range(count):
+            fd.write(f"+1555{index:07d},hello {index}\n")
+    return path
+
+
+def create_broadcast(server, checkpoint_path, rate=1000):
+    client = TwilioMessagesClient("AC123", "secret", base_url=server.url)
+    client.sleep = lambda seconds: None
+    checkpoint = Checkpoint(checkpoint_path).load()
+    return Broadcast(
+        client,
+        TokenBucket(rate),
+        checkpoint,
+        workers=4,
+        from_="+18482259204",
+    )
+
+
+def test_broadcast_sends_every_row_and_reports_failures():
+    ("Broadcast.run() should send every row of a csv file through "
+     "the twilio API and report the rejected ones")
+
+    server = TwilioStandIn(rejected={"+15550000003"})
+    with TemporaryDirectory() as path:
+        recipients = write_recipients(Path(path, "recipients.csv"), 20)
+        broadcast = create_broadcast(server, Path(path, "checkpoint"))
+        summary = broadcast.run(read_recipients(recipients))
+
+        expect(summary["sent"]).to.equal(19)
+        expect(summary["failed"]).to.equal(1)
+        summary["failures"][0]["row"].should.equal(4)
+        server.received.should.have.length_of(20)
+        url, message = server.received[0]
+        url.should.equal("/2010-04-01/Accounts/AC123/Messages.json")
+        message["From"].should.equal("+18482259204")
+
+    broadcast.client.http.close()
+    server.shutdown()
+
+
+def test_broadcast_resumes_from_checkpoint():
+    ("Broadcast.run() should skip the rows a previous run already "
+     "sent and retry the ones that failed")
+
+    server = TwilioStandIn(rejected={"+15550000003"})
+    with TemporaryDirectory() as path:
+        recipients = write_recipients(Path(path, "recipients.csv"), 10)
+        checkpoint = Path(path, "checkpoint")
+        create_broadcast(server, checkpoint).run(read_recipients(recipients))
+
+        server.rejected.clear()
+        server.received.clear()
+        broadcast = create_broadcast(server, checkpoint)
+        summary = broadcast.run(read_recipients(recipients))
+
+        expect(summary["skipped"]).to.equal(9)
+        expect(summary["sent"]).to.equal(1)
+        [m["To"] for _, m in server.received].should.equal(["+15550000003"])
+
+    broadcast.client.http.close()
+    server.shutdown()
+
+
+def test_token_bucket_limits_rate():
+    ("TokenBucket.acquire() should wait once the burst is spent")
+
+    bucket = TokenBucket(rate=10, capacity=2)
+    waits = []
+    bucket.sleep = lambda seconds: (
+        waits.append(seconds),
+        setattr(bucket, "tokens", bucket.tokens + seconds * 10),
+    )
+    for _ in range(3):
+        bucket.acquire()
+
+    waits.should.have.length_of(1)
+    expect(waits[0]).to.be.greater_than(0.05)
+
+    TokenBucket.when.called_with(rate=0).should.throw(ValueError)
+
+
+def test_checkpoint_is_closed_when_sending_fails():
+    ("Broadcast.run() should close its checkpoint when reading the "
+     "rows fails halfway")
+
+    server = TwilioStandIn()
+    with TemporaryDirectory() as path:
+        broadcast = create_broadcast(server, Path(path, "checkpoint"))
+
+        def rows():
+            yield 1, {"to": "+15550000001", "body": "hi"}
+            raise ValueError("corrupt recipients file")
+
+        broadcast.run.when.called_with(rows()).should.throw(ValueError)
+        expect(broadcast.checkpoint.fd).to.be.none
+        expect(1 in broadcast.checkpoint).to.be.true
+
+    broadcast.client.http.close()
+    server.shutdown()
+
+
+class CountingBucket(TokenBucket):
+    def __init__(self):
+        super().__init__(rate=1000)
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        super().acquire()
+
+
+def test_broadcast_never_resends_what_twilio_may_have_accepted():
+    ("Broadcast.run() should POST a message only once when twilio "
+     "answers late or with a 5xx, and report it for a manual check")
+
+    server = TwilioStandIn(broken={"+15550000001"}, slow={"+15550000002"})
+    with TemporaryDirectory() as path:
+        recipients = write_recipients(Path(path, "recipients.csv"), 4)
+        checkpoint = Path(path, "checkpoint")
+        broadcast = create_broadcast(server, checkpoint)
+        broadcast.client.timeout = 0.2
+        summary = broadcast.run(read_recipients(recipients))
+
+        expect(summary["sent"]).to.equal(2)
+        expect(summary["unknown"]).to.equal(2)
+        expect(summary["failed"]).to.equal(0)
+        sorted(f["row"] for f in summary["check_manually"]).should.equal(
+            [2, 3]
+        )
+        sorted(m["To"] for _, m in server.received).should.equal(
+            [f"+1555{index:07d}" for index in range(4)]
+        )
+
+        server.received.clear()
+        resumed = create_broadcast(server, checkpoint)
+        expect(resumed.run(read_recipients(recipients))["skipped"]).to.equal(
+            4
+        )
+        server.received.should.be.empty
+
+    broadcast.client.http.close()
+    resumed.client.http.close()
+    server.shutdown()
+
+
+def test_throttled_messages_are_retried_within_the_rate_limit():
+    ("a message answered with 429 should be sent again, taking a new "
+     "token for every attempt")
+
+    server = TwilioStandIn(throttled=2)
+    client = TwilioMessagesClient("AC123", "secret", base_url=server.url)
+    client.sleep = lambda seconds: None
+    bucket = CountingBucket()
+
+    sid = client.send("+15550000001", "hi", "+18482259204", bucket=bucket)
+
+    sid.should.equal("SM3")
+    expect(bucket.acquired).to.equal(3)
+    server.received.should.have.length_of(3)
+    client.http.close()
+    server.shutdown()
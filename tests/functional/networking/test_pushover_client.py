@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from sure import expect
+from shortage.networking import PushOverClient
+from shortage.networking import PushOverError
+from shortage.networking import PushOverRateLimited
+
+
+class PushOverStandIn(ThreadingHTTPServer):
+    """local stand-in for api.pushover.net that replies with a
+    scripted sequence of ``(status, headers)``"""
+
+    daemon_threads = True
+
+    def __init__(self, replies):
+        super().__init__(("127.0.0.1", 0), PushOverHandler)
+        self.replies = list(replies)
+        self.received = []
+        self.connections = set()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return "http://{}:{}/".format(*self.server_address)
+
+
+class PushOverHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        self.server.received.append(json.loads(self.rfile.read(length)))
+        self.server.connections.add(self.client_address)
+
+        status, headers = self.server.replies.pop(0)
+        body = b'{"status": 1}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_client(server, **kw):
+    client = PushOverClient("token", "user", base_url=server.url, **kw)
+    client.sleep = lambda seconds: None
+    return client
+
+
+def test_send_notification_reuses_connection():
+    ("PushOverClient.send_notification() should keep the "
+     "connection alive between calls")
+
+    server = PushOverStandIn([(200, {})] * 3)
+    client = create_client(server)
+
+    for index in range(3):
+        client.send_notification(f"body {index}", "title")
+
+    server.received.should.have.length_of(3)
+    server.received[0].should.equal(
+        {"token": "token", "user": "user", "message": "body 0", "title": "title"}
+    )
+    server.connections.should.have.length_of(1)
+    client.stats.to_dict().should.have.key("calls").being.equal(3)
+    client.http.close()
+    server.shutdown()
+
+
+def test_send_notification_retries_server_errors():
+    ("PushOverClient.send_notification() should retry 5xx "
+     "responses and give up after max_retries")
+
+    server = PushOverStandIn([(503, {}), (502, {}), (200, {})])
+    client = create_client(server, max_retries=2)
+
+    client.send_notification("body", "title").status_code.should.equal(200)
+    client.stats.to_dict()["errors"].should.equal(2)
+
+    server.replies = [(500, {})] * 3
+    expect(client.send_notification).when.called_with(
+        "body", "title"
+    ).should.throw(PushOverError)
+    client.http.close()
+    server.shutdown()
+
+
+def test_send_notification_honours_app_limit():
+    ("PushOverClient.send_notification() should not call the API "
+     "once X-Limit-App-Remaining reaches zero")
+
+    reset = int(time.time()) + 3600
+    server = PushOverStandIn(
+        [(200, {"X-Limit-App-Remaining": "0", "X-Limit-App-Reset": reset})]
+    )
+    client = create_client(server)
+    client.send_notification("body", "title")
+
+    expect(client.send_notification).when.called_with(
+        "body", "title"
+    ).should.throw(PushOverRateLimited)
+    server.received.should.have.length_of(1)
+    client.http.close()
+    server.shutdown()
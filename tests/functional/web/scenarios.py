@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import json
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from unittest import mock
+from sure import VariablesBag
+
+from shortage import metrics
+from shortage.dispatch import NotificationSpool
+from shortage.filesystem import storage_manager
+from shortage.web.backend import api
+
+
+request_fixture = Path(__file__).parents[3].joinpath(".request.json")
+API_TOKEN = "test-api-token"
+AUTHORIZATION = f"Bearer {API_TOKEN}"
+
+
+def prepare_inbox(context):
+    """setup function for HTTP tests against an empty, temporary
+    data directory"""
+    context.path = Path(tempfile.mkdtemp(prefix="shortage-tests-"))
+    context.patches = [
+        mock.patch(
+            "shortage.filesystem.SMS_STORAGE_PATH",
+            str(context.path.joinpath("data")),
+        ),
+        mock.patch(
+            "shortage.indexes.SMS_INDEX_PATH",
+            str(context.path.joinpath("index")),
+        ),
+        mock.patch(
+            "shortage.dedup.SMS_INDEX_PATH",
+            str(context.path.joinpath("index")),
+        ),
+        mock.patch.object(
+            metrics.registry, "path", str(context.path.joinpath("metrics"))
+        ),
+        mock.patch.dict(api.app.config, {"API_TOKEN": API_TOKEN}),
+        mock.patch("shortage.config.API_TOKEN", API_TOKEN),
+        mock.patch.object(api.notifications, "deliver", mock.Mock()),
+        mock.patch.object(
+            api.notifications,
+            "spool",
+            NotificationSpool(context.path.joinpath("spool")),
+        ),
+    ]
+    for patch in context.patches:
+        patch.start()
+
+    storage_manager.reset()
+    metrics.registry.reset()
+
+    context.http = api.app.test_client()
+    context.http.environ_base["HTTP_AUTHORIZATION"] = AUTHORIZATION
+
+    def post_sms(**fields):
+        data = json.loads(request_fixture.read_text())
+        data.update(fields)
+        return context.http.post(
+            "/sms/in", data=json.dumps(data), content_type="application/json"
+        )
+
+    context.post_sms = post_sms
+
+
+def cleanup_inbox(context):
+    api.notifications.stop(timeout=1)
+    for patch in reversed(context.patches):
+        patch.stop()
+
+    storage_manager.reset()
+    metrics.registry.reset()
+
+    shutil.rmtree(context.path, ignore_errors=True)
+
+
+@contextmanager
+def inbox():
+    context = VariablesBag()
+    prepare_inbox(context)
+    try:
+        yield context
+    finally:
+        cleanup_inbox(context)
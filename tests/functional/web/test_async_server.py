@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp.test_utils import TestClient, TestServer
+from sure import expect
+
+from shortage.dispatch import NotificationSpool
+from shortage.web.aio import AsyncNotifier, create_app
+from shortage.web.signature import TwilioSignature
+from tests.functional.web.scenarios import inbox, request_fixture
+
+
+def run_async_server(context, scenario, signature=None):
+    """runs ``scenario(client, delivered)`` against the asyncio server
+    of the given inbox"""
+    delivered = []
+
+    async def deliver(body, title):
+        delivered.append((body, title))
+
+    async def main():
+        executor = ThreadPoolExecutor(4)
+        notifier = AsyncNotifier(
+            deliver,
+            NotificationSpool(context.path.joinpath("async-spool")),
+            executor,
+        )
+        app = create_app(executor, notifier, signature)
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            await scenario(client, delivered)
+            await asyncio.wait_for(notifier.queue.join(), 5)
+        finally:
+            await client.close()
+
+    asyncio.run(main())
+    return delivered
+
+
+def test_async_server_matches_flask_responses():
+    ("shortage web --async should answer twilio webhooks exactly "
+     "like the flask app and store the same message")
+
+    fields = json.loads(request_fixture.read_text())
+    with inbox() as context:
+        flask_response = context.http.post(
+            "/sms/in", data=dict(fields, MessageSid="SM1")
+        )
+
+        async def scenario(client, delivered):
+            response = await client.post(
+                "/sms/in", data=dict(fields, MessageSid="SM2")
+            )
+            context.status = response.status
+            context.content_type = response.headers["Content-Type"]
+            context.body = await response.read()
+
+        delivered = run_async_server(context, scenario)
+
+        expect(context.status).to.equal(flask_response.status_code)
+        context.content_type.should.equal(
+            flask_response.headers["Content-Type"]
+        )
+        context.body.should.equal(flask_response.data)
+        delivered.should.equal([(fields["Body"], f"{fields['To']} SMS")])
+
+        messages = context.http.get("/sms/messages").get_json()["messages"]
+        [m["sid"] for m in messages].should.equal(["SM2", "SM1"])
+        messages[0]["data"].should.equal(
+            dict(messages[1]["data"], MessageSid="SM2")
+        )
+
+
+def test_async_server_deduplicates_retries():
+    ("shortage web --async should store and notify a retried "
+     "MessageSid once but every status callback")
+
+    with inbox() as context:
+
+        async def scenario(client, delivered):
+            for path in ("/sms/in", "/sms/in", "/sms/status"):
+                response = await client.post(
+                    path, data={"MessageSid": "SM1", "To": "+1", "Body": "x"}
+                )
+                expect(response.status).to.equal(200)
+
+        delivered = run_async_server(context, scenario)
+
+        delivered.should.have.length_of(2)
+        messages = context.http.get("/sms/messages").get_json()["messages"]
+        messages.should.have.length_of(2)
+
+
+def test_async_server_rejects_unsigned_webhooks():
+    ("shortage web --async should answer 403 to webhooks that are not "
+     "signed with the auth token")
+
+    signature = TwilioSignature("12345")
+    with inbox() as context:
+
+        async def scenario(client, delivered):
+            response = await client.post("/sms/in", data={"Body": "x"})
+            expect(response.status).to.equal(403)
+            response = await client.post(
+                "/sms/in",
+                data={"Body": "x"},
+                headers={"X-Twilio-Signature": "bogus"},
+            )
+            expect(response.status).to.equal(403)
+
+        delivered = run_async_server(context, scenario, signature)
+
+        delivered.should.be.empty
+        signature.stats().should.equal(
+            {"accepted": 0, "unsigned": 1, "invalid": 1, "rejected": 2}
+        )
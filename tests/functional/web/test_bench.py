@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import json
+import itertools
+from unittest import mock
+
+from sure import expect
+
+from shortage.bench import Benchmark, WSGITarget, payloads
+from shortage.web.backend import api
+from shortage.web.signature import TwilioSignature, SignatureMiddleware
+from tests.functional.web.scenarios import inbox, request_fixture
+
+
+template = json.loads(request_fixture.read_text())
+
+
+def test_payloads_are_randomized():
+    ("payloads() should give every request a new sid, sender and body")
+
+    generated = list(itertools.islice(payloads(template, seed=1), 50))
+
+    expect(len({fields["MessageSid"] for fields in generated})).to.equal(50)
+    expect(len({fields["From"] for fields in generated})).to.equal(50)
+    generated[0]["SmsSid"].should.equal(generated[0]["MessageSid"])
+    generated[0]["To"].should.equal(template["To"])
+
+
+def test_bench_in_process_with_signed_requests():
+    ("Benchmark should send signed webhooks that the signature "
+     "middleware accepts and report their latencies")
+
+    signature = TwilioSignature("12345")
+    middleware = SignatureMiddleware(api.app.wsgi_app, signature, ["/sms/in"])
+    with inbox() as context, mock.patch.object(
+        api.app, "wsgi_app", middleware
+    ):
+        benchmark = Benchmark(
+            WSGITarget(api.app),
+            payloads(template, seed=1),
+            signature=TwilioSignature("12345"),
+        )
+        report = benchmark.run_concurrent(20, concurrency=4)
+
+        expect(report["requests"]).to.equal(20)
+        expect(report["errors"]).to.equal(0)
+        report["statuses"].should.equal({"200": 20})
+        latency = report["latency_ms"]
+        expect(latency["p50"]).to.be.lower_than_or_equal_to(latency["max"])
+        expect(signature.stats()["accepted"]).to.equal(20)
+
+        messages = context.http.get("/sms/messages?limit=50").get_json()
+        messages["messages"].should.have.length_of(20)
+
+
+def test_bench_open_loop_counts_errors():
+    ("Benchmark.run_rate() should start requests at a fixed rate and "
+     "count the rejected ones as errors")
+
+    signature = TwilioSignature("12345")
+    middleware = SignatureMiddleware(api.app.wsgi_app, signature, ["/sms/in"])
+    with inbox(), mock.patch.object(api.app, "wsgi_app", middleware):
+        benchmark = Benchmark(WSGITarget(api.app), payloads(template))
+        report = benchmark.run_rate(10, rate=200, concurrency=2)
+
+        expect(report["errors"]).to.equal(10)
+        report["statuses"].should.equal({"403": 10})
+        expect(report["rate"]).to.equal(200)
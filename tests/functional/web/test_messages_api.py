@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from unittest import mock
+
+from shortage.web.backend import api
+from tests.functional.web.scenarios import inbox
+
+
+def test_list_messages_with_cursor():
+    ("GET /sms/messages should page through messages, "
+     "newest first, using an opaque cursor")
+
+    with inbox() as context:
+        for index in range(5):
+            context.post_sms(MessageSid=f"SM{index}", Body=f"body {index}")
+
+        response = context.http.get("/sms/messages?limit=2")
+        response.status_code.should.equal(200)
+        page = response.get_json()
+        [m["sid"] for m in page["messages"]].should.equal(["SM4", "SM3"])
+        page["messages"][0]["body"].should.equal("body 4")
+
+        response = context.http.get(
+            f"/sms/messages?limit=2&cursor={page['next_cursor']}"
+        )
+        page = response.get_json()
+        [m["sid"] for m in page["messages"]].should.equal(["SM2", "SM1"])
+
+        response = context.http.get(
+            f"/sms/messages?limit=2&cursor={page['next_cursor']}"
+        )
+        page = response.get_json()
+        [m["sid"] for m in page["messages"]].should.equal(["SM0"])
+        page["next_cursor"].should.be.none
+
+
+def test_messages_require_a_token():
+    ("the routes serving message bodies should be hidden without "
+     "SHORTAGE_API_TOKEN and require it, or the admin token, as a "
+     "bearer token")
+
+    with inbox() as context:
+        context.post_sms(MessageSid="SM1", Body="your code is 482913")
+        anonymous = api.app.test_client()
+        for url in ("/sms/messages", "/sms/messages/SM1", "/sms/threads"):
+            anonymous.get(url).status_code.should.equal(403)
+        anonymous.post("/sms/threads/1/read").status_code.should.equal(403)
+
+        with mock.patch.dict(api.app.config, {"ADMIN_TOKEN": "secret"}):
+            response = anonymous.get(
+                "/sms/search?q=482913",
+                headers={"Authorization": "Bearer secret"},
+            )
+            response.status_code.should.equal(200)
+
+        with mock.patch.dict(api.app.config, {"API_TOKEN": None}):
+            anonymous.get("/sms/messages").status_code.should.equal(404)
+
+
+def test_list_messages_conditional_get():
+    ("GET /sms/messages should answer 304 while the inbox is unchanged")
+
+    with inbox() as context:
+        context.post_sms(MessageSid="SM1")
+        etag = context.http.get("/sms/messages").headers["ETag"]
+
+        response = context.http.get(
+            "/sms/messages", headers={"If-None-Match": etag}
+        )
+        response.status_code.should.equal(304)
+
+        context.post_sms(MessageSid="SM2")
+        response = context.http.get(
+            "/sms/messages", headers={"If-None-Match": etag}
+        )
+        response.status_code.should.equal(200)
+
+
+def test_retrieve_message_by_sid():
+    ("GET /sms/messages/<sid> should return a single message")
+
+    with inbox() as context:
+        context.post_sms(MessageSid="SM42", Body="the answer")
+
+        response = context.http.get("/sms/messages/SM42")
+        response.status_code.should.equal(200)
+        response.get_json().should.have.key("body").being.equal("the answer")
+
+        context.http.get("/sms/messages/SM404").status_code.should.equal(404)
+
+
+def test_search_messages():
+    ("GET /sms/search should return ranked, paginated messages "
+     "whose body contains the query")
+
+    with inbox() as context:
+        context.post_sms(MessageSid="SM1", Body="your code is 482913")
+        context.post_sms(MessageSid="SM2", Body="see you at noon")
+        context.post_sms(MessageSid="SM3", Body="code 111111")
+
+        response = context.http.get("/sms/search?q=482913")
+        response.status_code.should.equal(200)
+        page = response.get_json()
+        [m["sid"] for m in page["messages"]].should.equal(["SM1"])
+        page["messages"][0]["snippet"].should.contain("[482913]")
+
+        page = context.http.get("/sms/search?q=code&limit=1").get_json()
+        page["messages"].should.have.length_of(1)
+        page = context.http.get(
+            f"/sms/search?q=code&limit=1&cursor={page['next_cursor']}"
+        ).get_json()
+        page["messages"].should.have.length_of(1)
+        page["next_cursor"].should.be.none
+
+        context.http.get("/sms/search").status_code.should.equal(400)
+
+
+def test_webhook_retries_are_stored_once():
+    ("POST /sms/in should store and notify a retried MessageSid once")
+
+    with inbox() as context:
+        context.post_sms(MessageSid="SM1").status_code.should.equal(200)
+        context.post_sms(MessageSid="SM1").status_code.should.equal(200)
+
+        messages = context.http.get("/sms/messages").get_json()["messages"]
+        messages.should.have.length_of(1)
+        stats = context.http.get("/sms/dedup").get_json()
+        stats["duplicates"].should.equal(1)
+
+
+def test_metrics_endpoint():
+    ("GET /metrics should expose the stage latencies and counters in "
+     "the prometheus text format")
+
+    with inbox() as context:
+        context.post_sms(MessageSid="SM1")
+        context.post_sms(MessageSid="SM2")
+
+        response = context.http.get("/metrics")
+        response.status_code.should.equal(200)
+        response.content_type.should.contain("version=0.0.4")
+        lines = response.get_data(as_text=True).splitlines()
+        lines.should.contain("shortage_messages_stored_total 2")
+        lines.should.contain(
+            'shortage_stage_seconds_count{stage="store"} 2'
+        )
+        lines.should.contain(
+            'shortage_stage_seconds_count{stage="parse"} 2'
+        )
+
+
+def test_admin_profile_requires_token():
+    ("POST /admin/profile should be hidden without SHORTAGE_ADMIN_TOKEN "
+     "and require it as a bearer token")
+
+    with inbox() as context, mock.patch.dict(
+        api.app.config, {"ADMIN_TOKEN": None}
+    ):
+        context.http.post("/admin/profile").status_code.should.equal(404)
+
+        api.app.config["ADMIN_TOKEN"] = "secret"
+        response = context.http.post(
+            "/admin/profile", headers={"Authorization": "Bearer wrong"}
+        )
+        response.status_code.should.equal(403)
+
+        with mock.patch.object(api.app, "profile") as profile:
+            response = context.http.post(
+                "/admin/profile?seconds=2",
+                headers={"Authorization": "Bearer secret"},
+            )
+        response.status_code.should.equal(202)
+        profile.assert_called_once_with(2.0)
+        response.get_json().should.have.key("pid")
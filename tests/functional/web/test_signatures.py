@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+from unittest import mock
+
+from sure import expect
+from twilio.request_validator import RequestValidator
+
+from shortage.web.backend import api, base
+from shortage.web.signature import TwilioSignature, SignatureMiddleware
+from tests.functional.web.scenarios import inbox
+
+
+TOKEN = "12345"
+URL = "http://localhost/sms/in"
+
+
+@contextmanager
+def signed_inbox():
+    signature = TwilioSignature(TOKEN)
+    middleware = SignatureMiddleware(
+        api.app.wsgi_app, signature, ["/sms/in", "/sms/status"]
+    )
+    with inbox() as context, mock.patch.object(
+        api.app, "wsgi_app", middleware
+    ), mock.patch.object(base, "twilio_signature", signature):
+        context.signature = signature
+        yield context
+
+
+def test_unsigned_webhook_is_rejected():
+    ("webhooks without a X-Twilio-Signature header should get a 403 "
+     "and never reach the storage")
+
+    with signed_inbox() as context:
+        response = context.http.post(
+            "/sms/in", data={"Body": "hi", "MessageSid": "SM1"}
+        )
+        response.status_code.should.equal(403)
+        response.data.should.equal(b"Forbidden")
+
+        response = context.http.get("/sms/messages")
+        expect(response.get_json()["messages"]).to.be.empty
+        expect(context.signature.stats()["unsigned"]).to.equal(1)
+
+
+def test_signed_webhook_is_accepted():
+    ("webhooks signed with the auth token should be stored, with the "
+     "form fields still readable by flask")
+
+    fields = {"Body": "hi", "From": "+1", "To": "+2", "MessageSid": "SM1"}
+    header = RequestValidator(TOKEN).compute_signature(URL, fields)
+
+    with signed_inbox() as context:
+        response = context.http.post(
+            "/sms/in", data=fields, headers={"X-Twilio-Signature": header}
+        )
+        response.status_code.should.equal(200)
+
+        response = context.http.get("/sms/messages/SM1")
+        response.get_json().should.have.key("body").being.equal("hi")
+
+        stats = context.http.get("/sms/signatures").get_json()
+        expect(stats["enabled"]).to.be.true
+        expect(stats["accepted"]).to.equal(1)
+        expect(stats["rejected"]).to.equal(0)
+
+
+def test_tampered_webhook_is_rejected():
+    ("a signature computed for other fields should get a 403")
+
+    fields = {"Body": "hi", "MessageSid": "SM1"}
+    header = RequestValidator(TOKEN).compute_signature(URL, fields)
+
+    with signed_inbox() as context:
+        response = context.http.post(
+            "/sms/in",
+            data=dict(fields, Body="tampered"),
+            headers={"X-Twilio-Signature": header},
+        )
+        response.status_code.should.equal(403)
+        expect(context.signature.stats()["invalid"]).to.equal(1)
+
+
+def test_other_paths_are_not_signed():
+    ("routes outside of the signed paths should not require a signature")
+
+    with signed_inbox() as context:
+        context.http.get("/sms/messages").status_code.should.equal(200)
+        expect(context.signature.stats()["rejected"]).to.equal(0)
+
+
+def test_signature_with_default_port():
+    ("urls configured in twilio with an explicit default port should "
+     "validate too")
+
+    signature = TwilioSignature(TOKEN)
+    fields = {"Body": "hi"}
+    header = RequestValidator(TOKEN).compute_signature(
+        "https://example.com:443/sms/in", fields
+    )
+    params = {key: [value] for key, value in fields.items()}
+    expect(
+        signature.validate("https://example.com/sms/in", params, b"", header)
+    ).to.be.true
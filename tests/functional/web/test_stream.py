@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import json
+import asyncio
+from unittest import mock
+
+from sure import expect
+
+from shortage.events import default_broadcaster
+from shortage.web.backend import api
+from tests.functional.web.scenarios import AUTHORIZATION, inbox
+from tests.functional.web.test_async_server import run_async_server
+
+
+def read_event(chunks) -> dict:
+    """the fields of the next event of an event stream, skipping
+    comments and the retry hint"""
+    while True:
+        fields = {}
+        for line in next(chunks).decode("utf-8").strip().splitlines():
+            name, _, value = line.partition(": ")
+            fields[name] = value
+        if "event" in fields:
+            return fields
+
+
+def test_stream_pushes_stored_messages():
+    ("GET /sms/stream should push every message as it is stored, "
+     "filtered by To and From")
+
+    with inbox() as context:
+        response = context.http.get(
+            "/sms/stream?from=%2B15550001", buffered=False
+        )
+        response.status_code.should.equal(200)
+        response.mimetype.should.equal("text/event-stream")
+        chunks = iter(response.response)
+        next(chunks).should.equal(b"retry: 2000\n\n")
+        expect(default_broadcaster().subscribers).to.equal(1)
+
+        context.post_sms(MessageSid="SM1", From="+15550002")
+        context.post_sms(MessageSid="SM2", From="+15550001", Body="hi")
+
+        event = read_event(chunks)
+        event["event"].should.equal("message")
+        message = json.loads(event["data"])
+        message["sid"].should.equal("SM2")
+        message["body"].should.equal("hi")
+        message["from"].should.equal("+15550001")
+
+        response.close()
+        expect(default_broadcaster().subscribers).to.equal(0)
+
+
+def test_stream_resumes_from_last_event_id():
+    ("GET /sms/stream should replay the messages stored since the "
+     "Last-Event-ID before the live ones, without duplicates")
+
+    with inbox() as context:
+        for index in range(4):
+            context.post_sms(MessageSid=f"SM{index}")
+        response = context.http.get("/sms/stream?last_event_id=x")
+        response.status_code.should.equal(400)
+
+        response = context.http.get(
+            "/sms/stream", headers={"Last-Event-ID": "1"}, buffered=False
+        )
+        chunks = iter(response.response)
+        replayed = [json.loads(read_event(chunks)["data"]) for _ in range(3)]
+        [m["sid"] for m in replayed].should.equal(["SM1", "SM2", "SM3"])
+
+        context.post_sms(MessageSid="SM4")
+        event = read_event(chunks)
+        event["id"].should.equal("5")
+        json.loads(event["data"])["sid"].should.equal("SM4")
+        response.close()
+
+
+def test_stream_keeps_threads_for_webhooks():
+    ("GET /sms/stream should be refused past SMS_STREAM_LIMIT open "
+     "streams, so that webhooks still find a worker thread")
+
+    with inbox() as context, mock.patch.dict(
+        api.app.config, {"SMS_STREAM_LIMIT": 1}
+    ):
+        first = context.http.get("/sms/stream", buffered=False)
+        first.status_code.should.equal(200)
+
+        refused = context.http.get("/sms/stream", buffered=False)
+        refused.status_code.should.equal(503)
+        refused.headers["Retry-After"].should.equal("2")
+        expect(default_broadcaster().subscribers).to.equal(1)
+
+        first.close()
+        expect(default_broadcaster().subscribers).to.equal(0)
+        context.http.get("/sms/stream", buffered=False).close()
+
+
+def test_async_stream_pushes_stored_messages():
+    ("shortage web --async should stream messages like the flask app")
+
+    with inbox() as context:
+
+        async def scenario(client, delivered):
+            response = await client.get(
+                "/sms/stream", headers={"Authorization": AUTHORIZATION}
+            )
+            (await response.content.readuntil(b"\n\n")).should.equal(
+                b"retry: 2000\n\n"
+            )
+            await client.post(
+                "/sms/in",
+                data={"MessageSid": "SM9", "From": "+1", "To": "+2"},
+            )
+            frame = await asyncio.wait_for(
+                response.content.readuntil(b"\n\n"), 5
+            )
+            context.frame = frame.decode("utf-8")
+            response.close()
+
+        run_async_server(context, scenario)
+
+        context.frame.should.contain("event: message")
+        context.frame.should.contain('"sid": "SM9"')
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from sure import expect
+
+from tests.functional.web.scenarios import inbox
+
+
+def test_threads_summarize_conversations():
+    ("GET /sms/threads should list conversations by normalized "
+     "(From, To) pair, most recent first, with their last message and "
+     "unread count")
+
+    with inbox() as context:
+        for sid, sender in (
+            ("SM1", "+1 555-0001"),
+            ("SM2", "+15550002"),
+            ("SM3", "+15550001"),
+        ):
+            context.post_sms(MessageSid=sid, From=sender, To="+15550100")
+
+        response = context.http.get("/sms/threads?limit=1")
+        response.status_code.should.equal(200)
+        page = response.get_json()
+        [thread] = page["threads"]
+        thread["participants"].should.equal(["+15550001", "+15550100"])
+        expect(thread["message_count"]).to.equal(2)
+        expect(thread["unread_count"]).to.equal(2)
+        thread["last_message"]["sid"].should.equal("SM3")
+        thread["last_message"]["from"].should.equal("+15550001")
+
+        response = context.http.get(
+            f"/sms/threads?limit=1&cursor={page['next_cursor']}"
+        )
+        page = response.get_json()
+        [t["participants"][0] for t in page["threads"]].should.equal(
+            ["+15550002"]
+        )
+        page["next_cursor"].should.be.none
+
+        url = f"/sms/threads/{thread['id']}/messages"
+        page = context.http.get(f"{url}?limit=1").get_json()
+        [m["sid"] for m in page["messages"]].should.equal(["SM3"])
+        response = context.http.get(f"{url}?cursor={page['next_cursor']}")
+        [m["sid"] for m in response.get_json()["messages"]].should.equal(
+            ["SM1"]
+        )
+
+
+def test_mark_thread_read():
+    ("POST /sms/threads/<id>/read should reset the unread count until "
+     "the next message of the thread")
+
+    with inbox() as context:
+        context.post_sms(MessageSid="SM1", From="+15550001")
+        context.post_sms(MessageSid="SM2", From="+15550001")
+        [thread] = context.http.get("/sms/threads").get_json()["threads"]
+
+        response = context.http.post(f"/sms/threads/{thread['id']}/read")
+        expect(response.get_json()["unread_count"]).to.equal(0)
+        response = context.http.get("/sms/threads?unread=1")
+        response.get_json()["threads"].should.equal([])
+
+        context.post_sms(MessageSid="SM3", From="+15550001")
+        thread = context.http.get(f"/sms/threads/{thread['id']}").get_json()
+        expect(thread["unread_count"]).to.equal(1)
+        expect(thread["message_count"]).to.equal(3)
+
+        context.http.get("/sms/threads/404").status_code.should.equal(404)
+        response = context.http.post("/sms/threads/404/read")
+        response.status_code.should.equal(404)
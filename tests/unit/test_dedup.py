@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from sure import expect
+
+from shortage.dedup import BloomFilter, Deduplicator, LRUSet
+from shortage.indexes import MessageIndex
+
+
+def test_bloom_filter_persists_members():
+    ("BloomFilter should remember members across instances sharing "
+     "the same file")
+
+    with TemporaryDirectory() as path:
+        bloom = BloomFilter(Path(path, "sids.bloom"), capacity=1000)
+        for index in range(500):
+            bloom.add(f"SM{index}")
+
+        reopened = BloomFilter(Path(path, "sids.bloom"), capacity=1000)
+        expect(all(f"SM{i}" in reopened for i in range(500))).to.be.true
+        false_positives = sum(f"XX{i}" in reopened for i in range(10000))
+        expect(false_positives).to.be.lower_than(100)
+
+
+def test_lru_set_is_bounded():
+    ("LRUSet should forget its least recently used members")
+
+    members = LRUSet(capacity=2)
+    members.add("a")
+    members.add("b")
+    expect("a" in members).to.be.true
+    members.add("c")
+    expect("b" in members).to.be.false
+    expect(len(members)).to.equal(2)
+
+
+def test_deduplicator_confirms_bloom_hits_with_the_index():
+    ("Deduplicator.claim() should refuse sids seen before and use "
+     "the index to rule out bloom filter false positives")
+
+    with TemporaryDirectory() as path:
+        index = MessageIndex(Path(path, "messages.db"))
+        bloom = BloomFilter(Path(path, "sids.bloom"), capacity=1000)
+        deduplicator = Deduplicator(index, bloom, lru_size=10)
+
+        expect(deduplicator.claim("SM1")).to.be.true
+        index.add("inbox", "100", {"data": {"MessageSid": "SM1"}})
+        expect(deduplicator.claim("SM1")).to.be.false
+
+        # a restarted worker has an empty LRU but the same filter
+        restarted = Deduplicator(index, bloom, lru_size=10)
+        expect(restarted.claim("SM1")).to.be.false
+        expect(restarted.claim("SM2")).to.be.true
+        restarted.release("SM2")
+        expect(restarted.claim("SM2")).to.be.true
+
+        stats = restarted.stats()
+        expect(stats["duplicates"]).to.equal(1)
+        expect(stats["index_hits"]).to.equal(1)
+        expect(stats["false_positives"]).to.equal(1)
+        expect(stats["hit_rate"]).to.equal(1 / 3)
+
+
+def test_deduplicator_refuses_sids_being_stored_by_another_worker():
+    ("Deduplicator.claim() should refuse a retry arriving on another "
+     "worker while the first delivery is still being stored")
+
+    with TemporaryDirectory() as path:
+        index = MessageIndex(Path(path, "messages.db"))
+        bloom = BloomFilter(Path(path, "sids.bloom"), capacity=1000)
+        worker_a = Deduplicator(index, bloom, lru_size=10)
+        worker_b = Deduplicator(index, bloom, lru_size=10)
+
+        expect(worker_a.claim("SM1")).to.be.true
+        expect(worker_b.claim("SM1")).to.be.false
+        expect(worker_b.stats()["in_flight"]).to.equal(1)
+
+        index.add("inbox", "100", {"data": {"MessageSid": "SM1"}})
+        expect(worker_b.claim("SM1")).to.be.false
+        expect(worker_b.stats()["index_hits"]).to.equal(1)
+
+        # a failed store lets the next retry through
+        expect(worker_a.claim("SM2")).to.be.true
+        worker_a.release("SM2")
+        expect(worker_b.claim("SM2")).to.be.true
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+from sure import expect
+
+from shortage.dispatch import NotificationSpool
+from shortage.dispatch import NotificationDispatcher
+
+
+class Recorder(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.delivered = []
+        self.done = threading.Event()
+
+    def __call__(self, body, title):
+        if self.fail:
+            raise RuntimeError("pushover is down")
+        self.delivered.append((title, body))
+        self.done.set()
+
+
+def test_dispatcher_delivers_in_background():
+    ("NotificationDispatcher.submit() should return immediately "
+     "and deliver from a worker thread")
+
+    with TemporaryDirectory() as path:
+        deliver = Recorder()
+        dispatcher = NotificationDispatcher(
+            deliver, NotificationSpool(path), workers=1
+        )
+
+        dispatcher.submit(body="hello", title="+1555 SMS")
+
+        expect(deliver.done.wait(2)).to.be.true
+        dispatcher.stop()
+
+        deliver.delivered.should.equal([("+1555 SMS", "hello")])
+        list(Path(path).iterdir()).should.be.empty
+
+
+def test_spooled_notifications_survive_restart():
+    ("notifications that could not be delivered should be "
+     "delivered by the next dispatcher using the same spool")
+
+    with TemporaryDirectory() as path:
+        failing = NotificationDispatcher(
+            Recorder(fail=True), NotificationSpool(path, backoff=0), workers=1
+        )
+        failing.submit(body="hello", title="+1555 SMS")
+        failing.stop()
+
+        deliver = Recorder()
+        NotificationDispatcher(
+            deliver, NotificationSpool(path), workers=1
+        ).start()
+
+        expect(deliver.done.wait(2)).to.be.true
+        deliver.delivered.should.equal([("+1555 SMS", "hello")])
+
+
+def test_full_queue_keeps_notification_in_spool():
+    ("NotificationDispatcher.enqueue() should leave the notification "
+     "in the spool when the queue is full")
+
+    with TemporaryDirectory() as path:
+        spool = NotificationSpool(path)
+        dispatcher = NotificationDispatcher(Recorder(), spool, maxsize=1)
+        dispatcher.queue = queue.Queue(maxsize=1)
+
+        dispatcher.enqueue(spool.put({"body": "1", "title": "t"}))
+        expect(
+            dispatcher.enqueue(spool.put({"body": "2", "title": "t"}))
+        ).to.be.false
+
+        spool.pending().should.have.length_of(2)
+
+
+def test_failed_notifications_back_off_then_dead_letter():
+    ("NotificationSpool.retry() should spool a failed notification "
+     "again later, and move it to the dead letters after max_attempts")
+
+    with TemporaryDirectory() as path:
+        spool = NotificationSpool(path, max_attempts=2, backoff=60)
+        dispatcher = NotificationDispatcher(
+            Recorder(fail=True), spool, workers=1
+        )
+
+        dispatcher.process(spool.put({"body": "hello", "title": "t"}))
+
+        spool.pending().should.be.empty
+        retried = sorted(Path(path).glob("*.json"))
+        retried.should.have.length_of(1)
+        spool.load(retried[0]).should.equal({"body": "hello", "title": "t"})
+
+        dispatcher.process(retried[0])
+
+        list(Path(path).glob("*.json")).should.be.empty
+        dead = list(spool.dead_path.iterdir())
+        dead.should.have.length_of(1)
+        dead[0].name.should.equal(retried[0].name)
+
+
+def test_dispatcher_warns_when_it_cannot_drain_on_sigterm():
+    ("NotificationDispatcher.start() should say so when it runs outside "
+     "of the main thread, where no SIGTERM handler can be installed")
+
+    with TemporaryDirectory() as path:
+        dispatcher = NotificationDispatcher(
+            Recorder(), NotificationSpool(path), workers=1
+        )
+        with mock.patch("shortage.dispatch.logger") as logger:
+            thread = threading.Thread(target=dispatcher.start)
+            thread.start()
+            thread.join()
+        dispatcher.stop()
+
+        logger.warning.call_args[0][0].should.contain("SIGTERM")
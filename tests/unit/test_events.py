@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from sure import expect
+
+from shortage.events import Broadcaster, SubscriberDropped
+from shortage.indexes import IndexEntry
+from shortage.records import MessageRecord
+
+
+def entry(id, sender="+1555", recipient="+1666"):
+    return IndexEntry(id, f"SM{id}", sender, recipient, 1.5, recipient, "1.5")
+
+
+def record(id):
+    return MessageRecord(sid=f"SM{id}", body=f"body {id}")
+
+
+def test_broadcaster_ignores_messages_without_subscribers():
+    ("Broadcaster.publish() should not queue anything while no stream "
+     "is open")
+
+    broadcaster = Broadcaster(capacity=4)
+    broadcaster.publish(entry(1), record(1))
+
+    expect(broadcaster.inbox.empty()).to.be.true
+    expect(broadcaster.thread).to.be.none
+
+
+def test_broadcaster_fans_out_and_drops_slow_subscribers():
+    ("every subscriber should get the events it matches, and the ones "
+     "falling more than a ring behind should be dropped")
+
+    broadcaster = Broadcaster(capacity=4)
+    fast = broadcaster.subscribe()
+    slow = broadcaster.subscribe()
+    filtered = broadcaster.subscribe(sender="+1777")
+
+    for id in range(1, 4):
+        broadcaster.publish(entry(id), record(id))
+
+    events = []
+    while len(events) < 3:
+        events.extend(fast.wait(5))
+    [event.id for event in events].should.equal([1, 2, 3])
+    events[0].frame.should.contain("id: 1\nevent: message\n")
+    events[0].frame.should.contain('"body": "body 1"')
+    filtered.wait(0.01).should.equal([])
+
+    broadcaster.publish(entry(4, sender="+1777"), record(4))
+    [event.id for event in filtered.wait(5)].should.equal([4])
+
+    for id in range(5, 7):
+        broadcaster.publish(entry(id), record(id))
+    while broadcaster.sequence < 6:
+        fast.wait(5)
+
+    slow.poll.when.called_with().should.throw(SubscriberDropped)
+    for subscription in (fast, slow, filtered):
+        subscription.close()
+    expect(broadcaster.subscribers).to.equal(0)
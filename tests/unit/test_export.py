@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import csv
+import gzip
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from click.testing import CliRunner
+from sure import expect
+
+from shortage.cli import shortage
+from shortage.export import Export, ordered_map
+from shortage.filesystem import FileStorage
+from shortage.records import MessageRecord
+
+
+def fill(storage, count=30):
+    for index in range(count):
+        record = MessageRecord(
+            sid=f"SM{index}",
+            sender=f"+1555000{index % 3}",
+            recipient="+15550100" if index % 2 else "+15550200",
+            body=f"body {index}",
+        )
+        storage.add(record.recipient, f"{1000 + index}.5", record.to_blob())
+
+
+def test_ordered_map_keeps_order_with_bounded_window():
+    ("ordered_map() should return results in input order and never "
+     "read more than the window ahead")
+
+    consumed = []
+
+    def items():
+        for number in range(100):
+            consumed.append(number)
+            yield number
+
+    with ThreadPoolExecutor(4) as executor:
+        results = ordered_map(lambda n: n * 2, items(), executor, 5)
+        next(results).should.equal(0)
+        expect(len(consumed)).to.equal(5)
+        list(results).should.equal([n * 2 for n in range(1, 100)])
+
+
+def test_export_filters_during_the_walk():
+    ("Export should read in parallel in the order of a sequential walk "
+     "and apply time, number and limit filters")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(path)
+        fill(storage)
+        (Path(path) / "_15550100" / "1031.5.json").write_text("{broken")
+
+        sequential = list(Export(storage, workers=1, chunk=1).rows())
+        parallel = Export(storage, workers=4, chunk=3)
+        list(parallel.rows()).should.equal(sequential)
+        expect(parallel.counts["exported"]).to.equal(30)
+        expect(parallel.counts["failed"]).to.equal(1)
+
+        rows = list(
+            Export(
+                storage,
+                since=1010,
+                until=1020,
+                recipients=["+15550100"],
+                senders=["+1 555-0001"],
+            ).rows()
+        )
+        [row["sid"] for row in rows].should.equal(["SM13", "SM19"])
+        rows[0]["data"]["Body"].should.equal("body 13")
+        rows[0]["received_at"].should.equal(1013.5)
+
+        list(Export(storage, limit=4).rows()).should.have.length_of(4)
+
+
+def test_export_command_writes_gzipped_csv():
+    ("shortage export should write csv and gzip it for --output *.gz")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(Path(path) / "data")
+        storage.base_path.mkdir()
+        fill(storage, 6)
+        target = Path(path) / "messages.csv.gz"
+
+        with mock.patch(
+            "shortage.filesystem.default_storage", return_value=storage
+        ):
+            result = CliRunner().invoke(
+                shortage,
+                [
+                    "export",
+                    "--format=csv",
+                    f"--output={target}",
+                    "--to=+15550200",
+                ],
+            )
+            ndjson = CliRunner().invoke(shortage, ["export", "--limit", "2"])
+
+        expect(result.exit_code).to.equal(0)
+        with gzip.open(target, "rt", newline="") as fd:
+            rows = list(csv.DictReader(fd))
+        sorted(row["sid"] for row in rows).should.equal(["SM0", "SM2", "SM4"])
+        rows[0]["to"].should.equal("+15550200")
+
+        lines = ndjson.stdout.splitlines()
+        lines.should.have.length_of(2)
+        json.loads(lines[0]).should.have.key("data")
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from shortage.filesystem import FileStorage, write_blobs
+from shortage.groupcommit import GroupCommit
+
+
+def test_group_commit_coalesces_concurrent_writes():
+    ("GroupCommit.submit() should batch concurrent writes and "
+     "sync once per batch")
+
+    with TemporaryDirectory() as path, mock.patch(
+        "shortage.filesystem.sync_filesystem"
+    ) as sync_filesystem:
+        group_commit = GroupCommit(write_blobs, batch_size=50, max_wait=0.05)
+        storage = FileStorage(path, group_commit=group_commit)
+
+        threads = [
+            threading.Thread(
+                target=storage.add, args=("inbox", str(index), {"n": index})
+            )
+            for index in range(40)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = group_commit.stats()
+        stats["writes"].should.equal(40)
+        stats["batches"].should.be.lower_than(40)
+        stats["max_batch_size"].should.be.greater_than(1)
+        sync_filesystem.call_count.should.equal(stats["batches"])
+
+        storage.get("inbox", "7").should.equal({"n": 7})
+        len(list(Path(path, "inbox").iterdir())).should.equal(40)
+
+
+def test_group_commit_reports_errors_to_caller():
+    ("GroupCommit.submit() should raise the error of its own write")
+
+    def write_batch(items):
+        return [ValueError(item) if item == "bad" else item for item in items]
+
+    group_commit = GroupCommit(write_batch)
+    group_commit.submit("good").should.equal("good")
+    group_commit.submit.when.called_with("bad").should.throw(ValueError)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import subprocess
+
+from sure import expect
+
+
+# microseconds, importing the command line used to take ~250ms. Slow
+# machines can allow a margin with SHORTAGE_IMPORT_BUDGET_FACTOR.
+CLI_IMPORT_BUDGET = 150000 * float(
+    os.getenv("SHORTAGE_IMPORT_BUDGET_FACTOR", "1")
+)
+
+HEAVYWEIGHTS = ("flask", "twilio", "requests", "coloredlogs", "pync")
+
+
+def run_python(code: str, *options):
+    return subprocess.run(
+        [sys.executable, *options, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def cumulative_import_time(module: str) -> int:
+    stderr = run_python(f"import {module}", "-X", "importtime").stderr
+    for line in stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1])
+    raise AssertionError(f"{module} was not imported:\n{stderr}")
+
+
+def loaded_modules(module: str, candidates) -> list:
+    code = (
+        f"import sys, json, {module}; "
+        f"print(json.dumps([m for m in {list(candidates)!r} "
+        "if m in sys.modules]))"
+    )
+    return json.loads(run_python(code).stdout)
+
+
+def test_cli_imports_no_heavyweights():
+    ("importing shortage.cli should not import the web framework, the "
+     "twilio library or any http client")
+
+    expect(loaded_modules("shortage.cli", HEAVYWEIGHTS)).to.equal([])
+
+
+def test_webhooks_import_no_twilio_library():
+    ("the wsgi app should not import the twilio library, requests or "
+     "pync until they are needed")
+
+    expect(
+        loaded_modules("shortage.wsgi", ("twilio", "requests", "pync"))
+    ).to.equal([])
+
+
+def test_cli_import_time_budget():
+    ("importing shortage.cli should fit in the import-time budget")
+
+    best = min(cumulative_import_time("shortage.cli") for _ in range(5))
+    expect(best).to.be.lower_than(CLI_IMPORT_BUDGET)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from sure import expect
+
+from shortage.filesystem import FileStorage
+from shortage.indexes import MessageIndex
+from shortage.records import MessageRecord
+
+
+def blob(sid, sender, recipient="+18482259319"):
+    return {
+        "method": "POST",
+        "data": {"MessageSid": sid, "From": sender, "To": recipient},
+    }
+
+
+def test_message_index_lookups():
+    ("MessageIndex should find messages by sid, sender, "
+     "recipient and time range")
+
+    with TemporaryDirectory() as path:
+        index = MessageIndex(Path(path).joinpath("messages.db"))
+        index.add("+18482259319", "100.5", blob("SM1", "+1111"))
+        index.add("+18482259319", "200.5", blob("SM2", "+2222"))
+        index.add("+18482259319", "300.5", blob("SM3", "+1111"))
+
+        entry = index.by_sid("SM2")
+        entry.key_name.should.equal("_18482259319")
+        entry.key_value.should.equal("200.5")
+        index.by_sid("SM404").should.be.none
+
+        [e.sid for e in index.by_sender("+1111")].should.equal(["SM1", "SM3"])
+        [e.sid for e in index.by_sender("+1111", since=200)].should.equal(
+            ["SM3"]
+        )
+        index.by_recipient("+18482259319").should.have.length_of(3)
+        [e.sid for e in index.between(150, 300)].should.equal(["SM2"])
+
+
+def test_message_index_rebuild_from_storage():
+    ("MessageIndex.rebuild() should index every blob in the storage")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(Path(path).joinpath("data"))
+        storage.add("+18482259319", "100.5", blob("SM1", "+1111"))
+        storage.add("+18482259319", "200.5", blob("SM2", "+2222"))
+
+        index = MessageIndex(Path(path).joinpath("index", "messages.db"))
+        index.add("gone", "1", blob("SM0", "+0000"))
+
+        index.rebuild(storage).should.equal(2)
+        index.count().should.equal(2)
+        entry = index.by_sid("SM2")
+        storage.get(entry.key_name, entry.key_value).should.equal(
+            blob("SM2", "+2222")
+        )
+
+
+def test_message_index_full_text_search():
+    ("MessageIndex.search() should rank messages containing every "
+     "word of the query and forget replaced bodies")
+
+    with TemporaryDirectory() as path:
+        index = MessageIndex(Path(path).joinpath("messages.db"))
+        bodies = [
+            "Your verification code is 482913",
+            "Lunch at noon? code red",
+            "code 111111 expires soon, your code is 111111",
+            "unrelated",
+        ]
+        for position, body in enumerate(bodies):
+            message = blob(f"SM{position}", "+1111")
+            message["data"]["Body"] = body
+            index.add("inbox", str(100 + position), message)
+
+        [r.entry.sid for r in index.search("482913")].should.equal(["SM0"])
+        [r.entry.sid for r in index.search("your code")].should.equal(
+            ["SM0", "SM2"]
+        )
+        [r.entry.sid for r in index.search("code")][0].should.equal("SM2")
+        index.search("code", limit=1, offset=2).should.have.length_of(1)
+        index.search("482913")[0].snippet.should.contain("[482913]")
+        index.search('code" OR "x').should.equal([])
+        index.search("  ").should.equal([])
+
+        pages = [
+            index.search("code", limit=2, offset=offset, candidates=2)
+            for offset in (0, 2)
+        ]
+        [[r.entry.sid for r in page] for page in pages].should.equal(
+            [["SM2", "SM1"], ["SM0"]]
+        )
+
+        replaced = blob("SM0", "+1111")
+        replaced["data"]["Body"] = "changed"
+        index.add("inbox", "100", replaced)
+        index.search("482913").should.equal([])
+
+
+def record_blob(sid, sender, recipient, status="received"):
+    return MessageRecord(
+        sid=sid,
+        sender=sender,
+        recipient=recipient,
+        body=f"body of {sid}",
+        status=status,
+    ).to_blob()
+
+
+def test_thread_index_survives_rebuilds_and_upgrades():
+    ("threads should keep what was read when the index is rebuilt, "
+     "and be built for indexes created before threads")
+
+    with TemporaryDirectory() as path:
+        index = MessageIndex(Path(path).joinpath("messages.db"))
+        received = record_blob("SM1", "+15550001", "+15550100")
+        delivered = record_blob("SM2", "+15550100", "+1555-0001", "delivered")
+        index.add("+15550100", "1000.5", received)
+        index.add("+15550001", "1001.5", delivered)
+        [thread] = index.threads()
+        expect(thread.message_count).to.equal(2)
+        expect(thread.unread_count).to.equal(1)
+        thread.last_sid.should.equal("SM2")
+
+        index.mark_read(thread.id)
+        index.clear()
+        index.threads().should.equal([])
+        newer = record_blob("SM3", "+15550001", "+15550100")
+        index.add_many(
+            [("+15550100", "1000.5", received), ("+15550100", "1002.5", newer)]
+        )
+        [rebuilt] = index.threads()
+        expect(rebuilt.id).to.equal(thread.id)
+        expect(rebuilt.unread_count).to.equal(1)
+
+        legacy = Path(path).joinpath("legacy.db")
+        connection = sqlite3.connect(str(legacy))
+        connection.executescript(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, sid TEXT, "
+            "sender TEXT, recipient TEXT, received_at REAL NOT NULL, "
+            "key_name TEXT NOT NULL, key_value TEXT NOT NULL, "
+            "UNIQUE (key_name, key_value));"
+            "INSERT INTO messages VALUES "
+            "(1, 'SM1', '+15550001', '+15550100', 1.5, '+15550100', '1.5'),"
+            "(2, 'SM2', '+15550002', '+15550100', 2.5, '+15550100', '2.5'),"
+            "(3, 'SM3', '+15550001', '+15550100', 3.5, '+15550100', '3.5');"
+        )
+        connection.close()
+
+        upgraded = MessageIndex(legacy)
+        threads = upgraded.threads()
+        [t.last_sid for t in threads].should.equal(["SM3", "SM2"])
+        [t.message_count for t in threads].should.equal([2, 1])
+        entries = upgraded.page(thread_id=threads[0].id)
+        [e.sid for e in entries].should.equal(["SM3", "SM1"])
+
+
+def test_message_ids_are_never_reused():
+    ("message ids should keep growing across clear() and rebuilds, "
+     "including in indexes created before they were AUTOINCREMENT")
+
+    with TemporaryDirectory() as path:
+        legacy = Path(path).joinpath("legacy.db")
+        connection = sqlite3.connect(str(legacy))
+        connection.executescript(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, sid TEXT, "
+            "sender TEXT, recipient TEXT, received_at REAL NOT NULL, "
+            "key_name TEXT NOT NULL, key_value TEXT NOT NULL, "
+            "thread_id INTEGER, UNIQUE (key_name, key_value));"
+            "INSERT INTO messages VALUES "
+            "(7, 'SM1', '+15550001', '+15550100', 1.5, '+15550100', '1.5', "
+            "NULL);"
+        )
+        connection.close()
+
+        index = MessageIndex(legacy)
+        index.by_sid("SM1").id.should.equal(7)
+        index.clear()
+        index.add("+18482259319", "100.5", blob("SM2", "+1111"))
+        index.by_sid("SM2").id.should.equal(8)
+
+        reopened = MessageIndex(legacy)
+        reopened.add("+18482259319", "200.5", blob("SM3", "+1111"))
+        reopened.by_sid("SM3").id.should.equal(9)
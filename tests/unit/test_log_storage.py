@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from tempfile import TemporaryDirectory
+
+from shortage.filesystem import LogStorage
+
+
+def test_log_storage_add_and_scan():
+    ("LogStorage.add() should append records to a segment file "
+     "that LogStorage.scan() reads back in order")
+
+    with TemporaryDirectory() as path:
+        storage = LogStorage(path)
+        for index in range(5):
+            storage.add("+18482259319", f"{1000 + index}.5", {"Body": index})
+
+        list(storage.scan("+18482259319")).should.equal(
+            [(f"{1000 + index}.5", {"Body": index}) for index in range(5)]
+        )
+        storage.keys().should.equal(["_18482259319"])
+        storage.segments(
+            storage.path_to_key("+18482259319")
+        ).should.have.length_of(1)
+
+
+def test_log_storage_rotates_segments():
+    ("LogStorage.add() should open a new segment once "
+     "segment_size is reached")
+
+    with TemporaryDirectory() as path:
+        storage = LogStorage(path, segment_size=256, index_interval=64)
+        for index in range(50):
+            storage.add("inbox", str(1000 + index), {"Body": "x" * 20})
+
+        segments = storage.segments(storage.path_to_key("inbox"))
+        len(segments).should.be.greater_than(5)
+        for segment in segments:
+            segment.stat().st_size.should.be.lower_than_or_equal_to(256)
+
+        [k for k, _ in storage.scan("inbox")].should.equal(
+            [str(1000 + index) for index in range(50)]
+        )
+
+
+def test_log_storage_get_uses_sparse_index():
+    ("LogStorage.get() should find a single record by key value")
+
+    with TemporaryDirectory() as path:
+        storage = LogStorage(path, segment_size=4096, index_interval=128)
+        for index in range(200):
+            storage.add("inbox", str(1000 + index), {"Body": index})
+
+        storage.read_index(
+            storage.segments(storage.path_to_key("inbox"))[0]
+        ).should_not.be.empty
+        storage.get("inbox", "1137").should.equal({"Body": 137})
+        storage.get("inbox", "1000").should.equal({"Body": 0})
+        storage.get("inbox", "1199").should.equal({"Body": 199})
+        storage.get("inbox", "nope").should.be.none
+        storage.get("unknown", "1000").should.be.none
+
+
+def test_log_storage_stops_at_partial_record():
+    ("LogStorage.scan() should ignore a truncated record at the "
+     "end of a segment")
+
+    with TemporaryDirectory() as path:
+        storage = LogStorage(path)
+        storage.add("inbox", "1", {"Body": "complete"})
+        position = storage.add("inbox", "2", {"Body": "partial"})
+        with position.path.open("r+b") as fd:
+            fd.truncate(position.offset + 10)
+
+        list(storage.scan("inbox")).should.equal([("1", {"Body": "complete"})])
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import os
+from tempfile import TemporaryDirectory
+
+from sure import expect
+
+from shortage.metrics import Counter, Gauge, Histogram, Registry
+
+
+def create_registry(path):
+    registry = Registry(path)
+    registry.requests = Counter(
+        registry,
+        "requests_total",
+        "Requests.",
+        label="result",
+        values=("ok", "failed"),
+    )
+    registry.depth = Gauge(registry, "depth", "Queue depth.")
+    registry.latency = Histogram(
+        registry, "latency_seconds", "Latency.", buckets=(0.1, 1.0)
+    )
+    return registry
+
+
+def test_exposition_format():
+    ("Registry.expose() should render counters, gauges and cumulative "
+     "histogram buckets in the prometheus text format")
+
+    with TemporaryDirectory() as path:
+        registry = create_registry(path)
+        registry.requests.labels("ok").inc()
+        registry.requests.labels("ok").inc(2)
+        registry.depth.set(4)
+        registry.latency.observe(0.05)
+        registry.latency.observe(0.5)
+        registry.latency.observe(3)
+
+        lines = registry.expose().splitlines()
+
+        lines.should.contain("# TYPE requests_total counter")
+        lines.should.contain('requests_total{result="ok"} 3')
+        lines.should.contain('requests_total{result="failed"} 0')
+        lines.should.contain("depth 4")
+        lines.should.contain('latency_seconds_bucket{le="0.1"} 1')
+        lines.should.contain('latency_seconds_bucket{le="1.0"} 2')
+        lines.should.contain('latency_seconds_bucket{le="+Inf"} 3')
+        lines.should.contain("latency_seconds_sum 3.55")
+        lines.should.contain("latency_seconds_count 3")
+
+
+def test_values_are_summed_across_processes():
+    ("metrics written by forked processes should be summed, and the "
+     "counters of exited processes kept without their gauges")
+
+    with TemporaryDirectory() as path:
+        registry = create_registry(path)
+        registry.requests.labels("ok").inc()
+
+        children = []
+        for _ in range(3):
+            pid = os.fork()
+            if pid == 0:
+                registry.requests.labels("ok").inc()
+                registry.requests.labels("failed").inc()
+                registry.depth.set(7)
+                os._exit(0)
+            children.append(pid)
+
+        for pid in children:
+            os.waitpid(pid, 0)
+
+        lines = registry.expose().splitlines()
+        lines.should.contain('requests_total{result="ok"} 4')
+        lines.should.contain('requests_total{result="failed"} 3')
+        lines.should.contain("depth 0")
+
+        files = sorted(name for name in os.listdir(path) if name[0] != ".")
+        expect(files).to.equal(["0.metrics", f"{os.getpid()}.metrics"])
+        registry.expose().splitlines().should.contain(
+            'requests_total{result="ok"} 4'
+        )
+        registry.reset()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from pathlib import Path
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from sure import expect
+
+from shortage.indexes import MessageIndex
+from shortage.partitions import (
+    Archive,
+    PartitionedStorage,
+    TableCache,
+    partition_of,
+)
+from shortage.records import MessageRecord
+
+DAY = 24 * 60 * 60
+# 2020-01-01T00:00:00Z
+MIDNIGHT = 1577836800.0
+
+
+def test_partitioned_storage_writes_one_directory_per_day():
+    ("PartitionedStorage.add() should store blobs under the UTC day "
+     "of their timestamp")
+
+    partition_of(MIDNIGHT + 60).should.equal("2020-01-01")
+    partition_of("webhook").should.equal("undated")
+
+    with TemporaryDirectory() as path:
+        storage = PartitionedStorage(path)
+        storage.add("inbox", str(MIDNIGHT + 60), {"Body": "first"})
+        storage.add("inbox", str(MIDNIGHT + DAY + 60), {"Body": "second"})
+
+        storage.keys().should.equal(["inbox"])
+        storage.partitions(Path(path, "inbox")).should.equal(
+            ["2020-01-01", "2020-01-02"]
+        )
+        storage.get("inbox", str(MIDNIGHT + 60)).should.equal(
+            {"Body": "first"}
+        )
+
+
+def test_partitioned_storage_compacts_closed_days():
+    ("PartitionedStorage.compact() should roll closed days into an "
+     "archive that still serves single messages")
+
+    with TemporaryDirectory() as path:
+        storage = PartitionedStorage(path)
+        for index in range(30):
+            storage.add("inbox", str(MIDNIGHT + index), {"Body": index})
+        storage.add("inbox", str(MIDNIGHT + DAY), {"Body": "today"})
+
+        now = datetime.fromtimestamp(MIDNIGHT + DAY + 60, timezone.utc)
+        expect(storage.compact(now)).to.equal(1)
+
+        Path(path, "inbox", "2020-01-01").exists().should.be.false
+        Path(path, "inbox", "2020-01-01.archive").exists().should.be.true
+        storage.get("inbox", str(MIDNIGHT + 7)).should.equal({"Body": 7})
+        storage.get("inbox", str(MIDNIGHT + 99)).should.be.none
+        [data["Body"] for _, data in storage.scan("inbox")].should.equal(
+            list(range(30)) + ["today"]
+        )
+
+        # late arrivals are merged into the existing archive
+        storage.add("inbox", str(MIDNIGHT + 500), {"Body": "late"})
+        expect(storage.compact(now)).to.equal(1)
+        storage.get("inbox", str(MIDNIGHT + 500)).should.equal(
+            {"Body": "late"}
+        )
+        storage.get("inbox", str(MIDNIGHT + 7)).should.equal({"Body": 7})
+
+
+def test_partitioned_storage_expires_whole_partitions():
+    ("PartitionedStorage.expire() should drop partitions older than "
+     "the retention period")
+
+    with TemporaryDirectory() as path:
+        storage = PartitionedStorage(path)
+        for day in range(5):
+            storage.add("inbox", str(MIDNIGHT + day * DAY), {"Body": day})
+
+        now = datetime.fromtimestamp(MIDNIGHT + 4 * DAY + 60, timezone.utc)
+        storage.compact(now)
+        expect(storage.expire(2, now)).to.equal(2)
+
+        [data["Body"] for _, data in storage.scan("inbox")].should.equal(
+            [2, 3, 4]
+        )
+
+
+def test_compaction_keeps_blobs_written_meanwhile():
+    ("PartitionedStorage.compact() should only remove the loose files "
+     "it archived, not the ones written while it ran")
+
+    with TemporaryDirectory() as path:
+        storage = PartitionedStorage(path)
+        storage.add("inbox", str(MIDNIGHT), {"Body": "archived"})
+        write = Archive.write
+
+        def write_then_receive(*args, **kw):
+            archive = write(*args, **kw)
+            storage.add("inbox", str(MIDNIGHT + 1), {"Body": "late"})
+            return archive
+
+        now = datetime.fromtimestamp(MIDNIGHT + DAY, timezone.utc)
+        with mock.patch.object(Archive, "write", write_then_receive):
+            storage.compact(now)
+
+        storage.get("inbox", str(MIDNIGHT + 1)).should.equal(
+            {"Body": "late"}
+        )
+        expect(storage.compact(now)).to.equal(1)
+        Path(path, "inbox", "2020-01-01").exists().should.be.false
+        [data["Body"] for _, data in storage.scan("inbox")].should.equal(
+            ["archived", "late"]
+        )
+
+
+def test_expired_partitions_leave_the_index():
+    ("PartitionedStorage.expire() should remove the messages of dropped "
+     "partitions from the index and their threads")
+
+    with TemporaryDirectory() as path:
+        storage = PartitionedStorage(Path(path, "data"))
+        index = MessageIndex(Path(path, "messages.db"))
+        for day in range(3):
+            key_value = str(MIDNIGHT + day * DAY)
+            blob = MessageRecord(
+                sid=f"SM{day}", sender="+15550001", recipient="+15550100"
+            ).to_blob()
+            storage.add("+15550100", key_value, blob)
+            index.add("+15550100", key_value, blob)
+
+        now = datetime.fromtimestamp(MIDNIGHT + 2 * DAY + 60, timezone.utc)
+        expect(storage.expire(1, now, index=index)).to.equal(1)
+
+        [entry.sid for entry in index.page()].should.equal(["SM2", "SM1"])
+        [thread] = index.threads()
+        expect(thread.message_count).to.equal(2)
+        expect(thread.unread_count).to.equal(2)
+
+
+def test_archive_reads_the_table_of_the_file_it_opened():
+    ("Archive.get() should read the offsets of the archive it opened, "
+     "even when compact() replaces it before the table is read")
+
+    with TemporaryDirectory() as path:
+        archive = Archive.write(
+            Path(path, "day.archive"), [("1.5", b"old"), ("2.5", b"kept")]
+        )
+        replacement = [("0.5", b"merged late"), ("1.5", b"new")]
+        replacement += [("2.5", b"kept")]
+        read_table = TableCache.get
+
+        def replace_first(cache, archive, fd):
+            Archive.write(archive.path, replacement)
+            return read_table(cache, archive, fd)
+
+        with mock.patch.object(TableCache, "get", replace_first):
+            archive.get("1.5").should.equal(b"old")
+
+        archive.get("1.5").should.equal(b"new")
+        archive.get("0.5").should.equal(b"merged late")
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import time
+import pstats
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from sure import expect
+
+from shortage.profiling import SamplingProfiler
+
+
+def busy_handler(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profiler_writes_collapsed_stacks_and_pstats():
+    ("SamplingProfiler should sample other threads for the given time "
+     "and write flamegraph and pstats files")
+
+    stop = threading.Event()
+    worker = threading.Thread(
+        target=busy_handler, args=(stop,), name="request-1"
+    )
+    worker.start()
+    try:
+        with TemporaryDirectory() as path:
+            profiler = SamplingProfiler(path, interval=0.001)
+            expect(profiler.start(0.2)).to.be.true
+            expect(profiler.start(0.2)).to.be.false
+            profiler.thread.join(5)
+
+            collapsed = profiler.last.read_text().splitlines()
+            busy = [line for line in collapsed if "busy_handler" in line]
+            busy.should_not.be.empty
+            busy[0].should.match(r"^request-1;.*busy_handler \(test_")
+            int(busy[0].rsplit(" ", 1)[1]).should.be.greater_than(0)
+
+            stats = pstats.Stats(
+                str(profiler.last.with_suffix(".pstats"))
+            ).stats
+            keys = [key for key in stats if key[2] == "busy_handler"]
+            keys.should.have.length_of(1)
+            expect(Path(keys[0][0]).name).to.equal("test_profiling.py")
+
+            sorted(profiler.profiles()).should.have.length_of(2)
+    finally:
+        stop.set()
+        worker.join()
+
+
+def test_profiler_is_idle_by_default():
+    ("SamplingProfiler should not run any thread until started")
+
+    profiler = SamplingProfiler("/nonexistent", interval=0.001)
+    expect(profiler.running).to.be.false
+    expect(profiler.profiles()).to.equal([])
+    before = threading.active_count()
+    time.sleep(0.01)
+    expect(threading.active_count()).to.equal(before)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from sure import expect
+
+from shortage.filesystem import FileStorage
+from shortage.records import MessageRecord, migrate_storage
+from shortage.serialization import JSONCodec
+
+
+fields = json.loads(
+    Path(__file__).parents[2].joinpath(".request.json").read_text()
+)
+
+headers = {
+    "Host": "shortage.example.com",
+    "User-Agent": "TwilioProxy/1.1",
+    "Content-Type": "application/x-www-form-urlencoded",
+    "Content-Length": "590",
+    "Accept": "*/*",
+    "Cache-Control": "max-age=259200",
+    "X-Forwarded-For": "54.172.60.1",
+    "X-Forwarded-Proto": "https",
+    "X-Home-Region": "us1",
+    "X-Twilio-Signature": "RSOYDt4T1cUTdK1PDd93/VVr8B8=",
+    "I-Twilio-Idempotency-Token": "4a2d3a2c-4f2b-4c6e-8a39-6a8e6b4f1c2d",
+}
+
+
+def legacy_blob(data):
+    """a form post as serialize_request() stored them before records:
+    the raw body did not parse as json"""
+    return {
+        "method": "POST",
+        "url": "https://shortage.example.com/sms/in",
+        "data": {"raw": "b''"},
+        "form": data,
+        "args": {},
+        "values": data,
+        "headers": headers,
+    }
+
+
+def test_record_round_trips_twilio_fields():
+    ("MessageRecord should give back the exact parameters twilio "
+     "posted, with typed fields and unknown keys kept as extras")
+
+    values = dict(fields, Unknown="kept", NumSegments="1")
+    record = MessageRecord.from_values(values, "POST", "/sms/in")
+
+    record.sid.should.equal(fields["MessageSid"])
+    record.sender.should.equal(fields["From"])
+    expect(record.num_media).to.equal(0)
+    expect(record.num_segments).to.equal(1)
+    record.extras.should.equal({"Unknown": "kept"})
+    record.to_data().should.equal(values)
+    MessageRecord.from_blob(record.to_blob()).should.equal(record)
+
+
+def test_record_keeps_conflicting_aliases_as_extras():
+    ("values sent under several names should be stored once, unless "
+     "they differ")
+
+    record = MessageRecord.from_values(
+        {"SmsSid": "SM1", "MessageSid": "SM2", "NumMedia": "01"}
+    )
+
+    record.sid.should.equal("SM1")
+    record.extras.should.equal({"MessageSid": "SM2", "NumMedia": "01"})
+    record.to_data().should.equal(
+        {"SmsSid": "SM1", "MessageSid": "SM2", "NumMedia": "01"}
+    )
+
+
+def test_record_reads_legacy_blobs():
+    ("MessageRecord.from_blob() should read blobs written before the "
+     "compact schema")
+
+    record = MessageRecord.from_blob(legacy_blob(fields))
+
+    record.method.should.equal("POST")
+    record.body.should.equal(fields["Body"])
+    record.to_data().should.equal(fields)
+    MessageRecord.from_blob({"data": None}).sid.should.be.none
+
+    form_only = dict(legacy_blob(fields), values=None)
+    MessageRecord.from_blob(form_only).to_data().should.equal(fields)
+    json_post = dict(legacy_blob({}), data=fields)
+    MessageRecord.from_blob(json_post).to_data().should.equal(fields)
+
+
+def test_compact_schema_is_smaller():
+    ("the compact schema should take at least 3 times fewer bytes than "
+     "the legacy blobs")
+
+    codec = JSONCodec()
+    legacy = len(codec.dump(legacy_blob(fields)))
+    record = MessageRecord.from_blob(legacy_blob(fields))
+    compact = len(codec.dump(record.to_blob()))
+
+    expect(legacy).to.be.greater_than(compact * 3)
+
+
+def test_migrate_storage_converts_blobs_in_place():
+    ("migrate_storage() should rewrite legacy blobs with the compact "
+     "schema and skip the ones already converted")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(path)
+        for index in range(30):
+            data = dict(fields, MessageSid=f"SM{index}")
+            storage.add(fields["To"], f"{1000 + index}.5", legacy_blob(data))
+
+        totals = migrate_storage(storage, workers=2, chunk_size=4)
+
+        expect(totals["converted"]).to.equal(30)
+        expect(totals["saved"]).to.be.greater_than(0)
+        blob = storage.get(fields["To"], "1007.5")
+        blob.should.have.key("v").being.equal(1)
+        MessageRecord.from_blob(blob).to_data().should.equal(
+            dict(fields, MessageSid="SM7")
+        )
+
+        totals = migrate_storage(storage, workers=2, chunk_size=4)
+        expect(totals["skipped"]).to.equal(30)
+
+
+def test_migrate_storage_refuses_incomplete_records():
+    ("migrate_storage() should leave alone the blobs it cannot read a "
+     "sid, sender and recipient from")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(path)
+        blob = dict(legacy_blob(fields), form={}, values={})
+        storage.add(fields["To"], "1000.5", blob)
+
+        totals = migrate_storage(storage, workers=1)
+
+        expect(totals["refused"]).to.equal(1)
+        expect(totals["converted"]).to.equal(0)
+        storage.get(fields["To"], "1000.5").should.equal(blob)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from click.testing import CliRunner
+from sure import expect
+
+from shortage.cli import shortage
+from shortage.dedup import BloomFilter
+from shortage.filesystem import FileStorage
+from shortage.indexes import MessageIndex
+from shortage.records import MessageRecord
+from shortage.reindex import Reindex, ReindexState
+
+
+def fill(storage, key, count, start=0):
+    for number in range(start, start + count):
+        record = MessageRecord(
+            sid=f"SM{key}{number}",
+            sender=f"+1555000{number % 4}",
+            recipient=key,
+            body=f"body {number}",
+        )
+        storage.add(key, f"{1000 + number}.5", record.to_blob())
+
+
+def create_reindex(path, **kw):
+    path = Path(path)
+    return Reindex(
+        FileStorage(path.joinpath("data")),
+        MessageIndex(path.joinpath("index", "messages.db")),
+        ReindexState(path.joinpath("index", "reindex.json")),
+        report=path.joinpath("index", "problems.ndjson"),
+        bloom=BloomFilter(path.joinpath("index", "sids.bloom"), 1000),
+        workers=2,
+        chunk_size=7,
+        **kw,
+    )
+
+
+def test_reindex_rebuilds_indexes_and_reports_corrupt_files():
+    ("Reindex should index every valid blob in parallel, fill the "
+     "bloom filter and report corrupt and partial files")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(Path(path).joinpath("data"))
+        storage.base_path.mkdir()
+        fill(storage, "+15550100", 30)
+        fill(storage, "+15550200", 10)
+        key_path = storage.base_path.joinpath("_15550100")
+        key_path.joinpath("2000.5.json").write_bytes(b"")
+        key_path.joinpath("2001.5.json").write_text('{"v": 1, "s": "SM')
+        key_path.joinpath("2002.5.json").write_text("[1, 2]")
+        key_path.joinpath(".2003.5.json.42.tmp").write_text("{")
+
+        reindex = create_reindex(path)
+        reindex.index.add("stale", "1.5", {"data": {"MessageSid": "SMold"}})
+        summary = reindex.run()
+
+        expect(summary["indexed"]).to.equal(40)
+        expect(summary["problems"]).to.equal(4)
+        expect(summary["keys"]).to.equal(2)
+        expect(reindex.index.count()).to.equal(40)
+        reindex.index.by_sid("SMold").should.be.none
+        reindex.index.by_sid("SM+1555010029").should_not.be.none
+        expect("SM+155502007" in reindex.bloom).to.be.true
+        reindex.index.threads().should.have.length_of(8)
+
+        lines = Path(summary["report"]).read_text().splitlines()
+        problems = sorted(
+            (Path(line["path"]).name, line["problem"])
+            for line in map(json.loads, lines)
+        )
+        problems.should.equal(
+            [
+                (".2003.5.json.42.tmp", "partial"),
+                ("2000.5.json", "empty"),
+                ("2001.5.json", "undecodable"),
+                ("2002.5.json", "invalid"),
+            ]
+        )
+        expect(reindex.state.exists).to.be.false
+
+
+def test_reindex_resumes_where_it_stopped():
+    ("Reindex should skip the keys and files an interrupted run "
+     "already indexed")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(Path(path).joinpath("data"))
+        storage.base_path.mkdir()
+        fill(storage, "+15550100", 10)
+        fill(storage, "+15550200", 20)
+        corrupt = storage.base_path.joinpath("_15550100", "2000.5.json")
+        corrupt.write_bytes(b"")
+
+        interrupted = create_reindex(path)
+        interrupted.state.done = {"_15550100"}
+        interrupted.state.save()
+        for key_value, blob in list(storage.scan("+15550200"))[:12]:
+            interrupted.index.add("+15550200", key_value, blob)
+        interrupted.report_path.parent.mkdir(exist_ok=True)
+        interrupted.report_path.write_text("")
+
+        summary = create_reindex(path).run()
+
+        expect(summary["indexed"]).to.equal(8)
+        expect(summary["skipped"]).to.equal(12)
+        expect(summary["problems"]).to.equal(0)
+        expect(interrupted.index.count()).to.equal(20)
+
+
+def test_reindex_reads_legacy_form_posts():
+    ("Reindex should index the form posts stored before records, "
+     "whose twilio fields are in values and form, not data")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(Path(path).joinpath("data"))
+        fields = {"MessageSid": "SM1", "From": "+15550001", "To": "+1555"}
+        storage.add(
+            "+1555",
+            "1000.5",
+            {
+                "method": "POST",
+                "url": "https://shortage.example.com/sms/in",
+                "data": {"raw": "b''"},
+                "form": fields,
+                "args": {},
+                "values": fields,
+                "headers": {"Host": "shortage.example.com"},
+            },
+        )
+
+        reindex = create_reindex(path)
+        summary = reindex.run()
+
+        expect(summary["indexed"]).to.equal(1)
+        expect(summary["problems"]).to.equal(0)
+        reindex.index.by_sid("SM1").sender.should.equal("+15550001")
+
+
+def test_reindex_refuses_other_backends():
+    ("shortage reindex should not clear the index of a storage it "
+     "can't read the blob files of")
+
+    with mock.patch(
+        "shortage.cli.SMS_STORAGE_BACKEND", "partitioned"
+    ), mock.patch("shortage.indexes.default_index") as default_index:
+        result = CliRunner().invoke(shortage, ["reindex"])
+
+    expect(result.exit_code).to.equal(1)
+    default_index.called.should.be.false
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import json
+from tempfile import TemporaryDirectory
+
+from sure import expect
+from shortage.filesystem import FileStorage
+from shortage.serialization import (
+    BinaryCodec,
+    CodecError,
+    Codecs,
+    JSONCodec,
+    ZlibJSONCodec,
+    train_zdict,
+)
+
+
+def twilio_request(index):
+    return {
+        "method": "POST",
+        "url": "https://sms.example.com/sms/in",
+        "data": {
+            "ApiVersion": "2010-04-01",
+            "Body": f"your code is {index:06d}",
+            "From": f"+1555{index:07d}",
+            "FromCountry": "US",
+            "MessageSid": f"SM{index:032x}",
+            "NumMedia": "0",
+            "SmsStatus": "received",
+            "To": "+18482259319",
+        },
+        "headers": {"User-Agent": "TwilioProxy/1.1"},
+        "retries": [1, 2.5, None, True],
+    }
+
+
+def test_codecs_round_trip():
+    ("every codec should read back exactly what it wrote")
+
+    data = twilio_request(42)
+    for codec in [JSONCodec(), BinaryCodec(), ZlibJSONCodec()]:
+        Codecs(codec).load(codec.dump(data)).should.equal(data)
+
+
+def test_codecs_read_legacy_pretty_json():
+    ("Codecs.load() should read blobs written before codecs existed")
+
+    data = twilio_request(1)
+    raw = json.dumps(data, indent=2).encode("utf-8")
+    Codecs(BinaryCodec()).load(raw).should.equal(data)
+
+
+def test_trained_zdict_shrinks_blobs():
+    ("ZlibJSONCodec should write smaller blobs with a trained zdict")
+
+    zdict = train_zdict(twilio_request(index) for index in range(100))
+    plain = ZlibJSONCodec()
+    primed = ZlibJSONCodec(zdict)
+
+    data = twilio_request(1000)
+    len(primed.dump(data)).should.be.lower_than(len(plain.dump(data)))
+    Codecs(primed).load(primed.dump(data)).should.equal(data)
+
+    expect(Codecs(plain).load).when.called_with(
+        primed.dump(data)
+    ).should.throw(CodecError)
+
+
+def test_file_storage_reads_every_codec():
+    ("FileStorage should read blobs written with any codec")
+
+    with TemporaryDirectory() as path:
+        FileStorage(path, Codecs(JSONCodec(indent=2))).add(
+            "inbox", "1", twilio_request(1)
+        )
+        FileStorage(path, Codecs(BinaryCodec())).add(
+            "inbox", "2", twilio_request(2)
+        )
+
+        storage = FileStorage(path, Codecs(ZlibJSONCodec()))
+        storage.add("inbox", "3", twilio_request(3))
+
+        [k for k, _ in storage.scan("inbox")].should.equal(["1", "2", "3"])
+        storage.get("inbox", "2").should.equal(twilio_request(2))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from sure import expect
+
+from shortage.filesystem import FileStorage
+from shortage.sqlstorage import SQLiteStorage
+
+
+def message(sid, sender="+15550001", body="hello"):
+    return {"data": {"MessageSid": sid, "From": sender, "Body": body}}
+
+
+def test_sqlite_storage_batches_concurrent_adds():
+    ("SQLiteStorage.add() should insert concurrent messages in "
+     "shared transactions that get() and scan() read back")
+
+    with TemporaryDirectory() as path:
+        storage = SQLiteStorage(Path(path, "messages.db"), max_wait=0.05)
+        threads = [
+            threading.Thread(
+                target=storage.add,
+                args=("+18482259319", f"{1000 + index}.5", message(index)),
+            )
+            for index in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        expect(storage.count()).to.equal(20)
+        expect(storage.group_commit.stats()["batches"]).to.be.lower_than(20)
+        storage.keys().should.equal(["_18482259319"])
+        [k for k, _ in storage.scan("+18482259319")].should.equal(
+            [f"{1000 + index}.5" for index in range(20)]
+        )
+        storage.get("+18482259319", "1007.5").should.equal(message(7))
+        storage.get("+18482259319", "1.0").should.be.none
+
+
+def test_sqlite_storage_find_by_indexed_fields():
+    ("SQLiteStorage.find() should look messages up by sid and sender")
+
+    with TemporaryDirectory() as path:
+        storage = SQLiteStorage(Path(path, "messages.db"), max_wait=0)
+        storage.add("inbox", "100.0", message("SM1", sender="+1"))
+        storage.add("inbox", "200.0", message("SM2", sender="+2"))
+        storage.add("inbox", "300.0", message("SM3", sender="+1"))
+
+        [v for _, v, _ in storage.find(sid="SM2")].should.equal(["200.0"])
+        [v for _, v, _ in storage.find(sender="+1")].should.equal(
+            ["100.0", "300.0"]
+        )
+
+
+def test_sqlite_storage_migrates_file_storage():
+    ("SQLiteStorage.migrate() should bulk-load every blob of a "
+     "FileStorage tree and skip the ones that can't be decoded")
+
+    with TemporaryDirectory() as path:
+        source = FileStorage(Path(path, "data"))
+        source.base_path.mkdir()
+        for index in range(25):
+            source.add("inbox", str(1000 + index), message(f"SM{index}"))
+        source.add("outbox", "1.0", message("SMout"))
+        Path(path, "data", "inbox", "9999.json").write_bytes(b"{broken")
+
+        target = SQLiteStorage(Path(path, "messages.db"))
+        expect(target.migrate(source, batch_size=10)).to.equal(26)
+
+        target.keys().should.equal(["inbox", "outbox"])
+        target.get("inbox", "1003").should.equal(message("SM3"))
+        [v for _, v, _ in target.find(sid="SMout")].should.equal(["1.0"])
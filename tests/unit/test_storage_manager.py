@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+from collections import Counter
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from shortage.filesystem import DirectoryCache, FileStorage
+
+
+@contextmanager
+def count_syscalls(*names):
+    """counts calls to the given ``os`` functions"""
+    calls = Counter()
+    patches = []
+    for name in names:
+        original = getattr(os, name)
+
+        def counted(*args, __name=name, __original=original, **kw):
+            calls[__name] += 1
+            return __original(*args, **kw)
+
+        patches.append(mock.patch.object(os, name, counted))
+
+    for patch in patches:
+        patch.start()
+    try:
+        yield calls
+    finally:
+        for patch in patches:
+            patch.stop()
+
+
+def test_cached_directories_skip_mkdir():
+    ("FileStorage.add() should not mkdir() known keys, and only stat() "
+     "them relative to the base directory, when it has a "
+     "DirectoryCache")
+
+    with TemporaryDirectory() as path:
+        uncached = FileStorage(path)
+        with count_syscalls("stat", "lstat", "mkdir", "open") as before:
+            for index in range(10):
+                uncached.add("+18482259319", f"{index}.0", {"n": index})
+
+        cached = FileStorage(path, directories=DirectoryCache(path))
+        cached.add("+18482259319", "warm-up", {})
+        with count_syscalls("stat", "lstat", "mkdir", "open") as after:
+            for index in range(10):
+                cached.add("+18482259319", f"{index}.1", {"n": index})
+
+        (before["stat"] + before["mkdir"]).should.be.greater_than(10)
+        after["stat"].should.equal(10)
+        after["lstat"].should.equal(0)
+        after["mkdir"].should.equal(0)
+        after["open"].should.equal(10)
+
+        cached.get("+18482259319", "3.1").should.equal({"n": 3})
+
+
+def test_directory_cache_evicts_and_closes():
+    ("DirectoryCache should keep at most ``capacity`` directories open")
+
+    with TemporaryDirectory() as path:
+        directories = DirectoryCache(path, capacity=2)
+        storage = FileStorage(path, directories=directories)
+        for key in ["a", "b", "c"]:
+            storage.add(key, "1", {"key": key})
+
+        list(directories.entries).should.equal(["b", "c"])
+        storage.get("a", "1").should.equal({"key": "a"})
+        directories.close()
+        directories.entries.should.be.empty
+
+
+def test_directory_cache_follows_removed_directories():
+    ("DirectoryCache should not write into a key directory that was "
+     "removed or renamed since it was cached")
+
+    with TemporaryDirectory() as path:
+        storage = FileStorage(path, directories=DirectoryCache(path))
+        storage.add("a", "1", {"n": 1})
+
+        os.rename(os.path.join(path, "a"), os.path.join(path, "old"))
+        storage.add("a", "2", {"n": 2})
+        storage.get("a", "2").should.equal({"n": 2})
+
+        for name in os.listdir(os.path.join(path, "a")):
+            os.unlink(os.path.join(path, "a", name))
+        os.rmdir(os.path.join(path, "a"))
+        storage.add("a", "3", {"n": 3})
+        storage.get("a", "3").should.equal({"n": 3})